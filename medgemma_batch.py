@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Job batch MedGemma
+Manifest JSONL o glob di immagini -> risultati JSONL, con ripresa dopo interruzione
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from medgemma_dicom import split_frame
+
+DEFAULT_QUESTION = "Describe this medical image in detail"
+# Errori che una ripresa non può risolvere: le righe contano come completate
+PERMANENT_ERRORS = ("Record non valido:", "File non trovato:")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".dcm", ".dicom")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="test_medgemma.py batch",
+        description="Analizza un manifest JSONL {image, question} o un glob di immagini"
+    )
+    parser.add_argument("input", help="manifest .jsonl, cartella o glob (es. 'archivio/**/*.png')")
+    parser.add_argument("-o", "--output", help="file JSONL dei risultati (default results/<input>.results.jsonl)")
+    parser.add_argument("-q", "--question", default=DEFAULT_QUESTION, help="domanda per i record senza 'question'")
+    parser.add_argument("-b", "--batch-size", type=int, help="immagini per batch (default BATCH_SIZE)")
+    parser.add_argument("-w", "--workers", type=int, help="processi worker CPU (default WORKERS)")
+    parser.add_argument("--restart", action="store_true", help="ignora i risultati esistenti e ricomincia")
+    return parser.parse_args(argv)
+
+
+def iter_records(source, question=DEFAULT_QUESTION):
+    """Record {id, image, question} letti in streaming dalla sorgente
+
+    Le righe del manifest non valide (JSON errato, senza image) diventano
+    record con invalid: il job le scrive come errori e prosegue.
+    """
+    if source.endswith(".jsonl"):
+        with open(source, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield {"id": f"{source}:{number}", "question": question, "invalid": f"JSON non valido: {e}"}
+                    continue
+                if not isinstance(record, dict):
+                    yield {"id": f"{source}:{number}", "question": question, "invalid": "il record non è un oggetto"}
+                    continue
+                record.setdefault("question", question)
+                if not record.get("image"):
+                    record.setdefault("id", f"{source}:{number}")
+                    record["invalid"] = "campo 'image' mancante"
+                else:
+                    record.setdefault("id", f"{record['image']}|{record['question']}")
+                yield record
+        return
+
+    pattern = os.path.join(source, "**", "*") if os.path.isdir(source) else source
+    for path in glob.iglob(pattern, recursive=True):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            yield {"id": path, "image": path, "question": question}
+
+
+def default_output(source):
+    """results/<nome>.results.jsonl a partire da manifest o cartella"""
+    if source.endswith(".jsonl") or os.path.isdir(source):
+        name = Path(source.rstrip("/\\")).stem
+    else:
+        name = "batch"
+    return os.path.join("results", f"{name}.results.jsonl")
+
+
+def load_done_ids(output):
+    """Id già completati nel file di output
+
+    Le righe con errore non contano, salvo gli errori permanenti (record
+    non valido, file inesistente): alla ripresa quei record vengono
+    rianalizzati e la nuova riga segue quella fallita. Un'eventuale
+    ultima riga troncata (job ucciso durante la scrittura) viene rimossa
+    così il file resta JSONL valido.
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+
+    valid_bytes = 0
+    with open(output, "rb") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                error = result.get("error")
+                if error is None or error.startswith(PERMANENT_ERRORS):
+                    done.add(result["id"])
+            except (ValueError, KeyError, AttributeError):
+                break
+            valid_bytes += len(line)
+
+    if valid_bytes < os.path.getsize(output):
+        with open(output, "r+b") as f:
+            f.truncate(valid_bytes)
+
+    return done
+
+
+class BatchJob:
+    """Esegue un job batch con checkpoint incrementale"""
+
+    def __init__(self, medgemma, source, output, question=DEFAULT_QUESTION, batch_size=None, restart=False):
+        self.medgemma = medgemma
+        self.source = source
+        self.output = output
+        self.question = question
+        self.batch_size = batch_size or medgemma.batch_size
+        self.restart = restart
+        self.checkpoint_path = f"{output}.checkpoint.json"
+
+        self.processed = 0
+        self.errors = 0
+
+    def run(self):
+        Path(self.output).parent.mkdir(parents=True, exist_ok=True)
+        if self.restart and os.path.exists(self.output):
+            os.remove(self.output)
+
+        done = load_done_ids(self.output)
+        # Passata di solo conteggio per la stima del tempo residuo
+        total = sum(1 for _ in iter_records(self.source, self.question))
+        remaining = max(0, total - len(done))
+
+        print(f"Record: {total} | già completati: {len(done)} | da elaborare: {remaining}")
+        print(f"Output: {self.output}")
+
+        records = (r for r in iter_records(self.source, self.question) if r["id"] not in done)
+        self.start = time.perf_counter()
+
+        with open(self.output, "a", encoding="utf-8") as out:
+            if self.medgemma.worker_pool is not None:
+                self._run_pool(records, out, remaining)
+            else:
+                self._run_batches(records, out, remaining)
+
+        elapsed = time.perf_counter() - self.start
+        print(f"\nJob completato: {self.processed} elaborati ({self.errors} errori) in {elapsed:.0f}s")
+        return self.errors == 0
+
+    def _prefetch(self, records):
+        """Carica le immagini in anticipo mentre il batch corrente genera"""
+        depth = max(self.batch_size * 2, self.medgemma.prefetch)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.medgemma.preprocess_workers) as executor:
+            for record in records:
+                if "invalid" in record:
+                    pending.append((record, None))
+                else:
+                    pending.append((record, executor.submit(self.medgemma.load_image, record["image"])))
+                if len(pending) >= depth:
+                    yield self._resolve(*pending.popleft())
+            while pending:
+                yield self._resolve(*pending.popleft())
+
+    @staticmethod
+    def _resolve(record, future):
+        if future is None:
+            return record, None, ValueError(record["invalid"])
+        try:
+            return record, future.result(), None
+        except Exception as e:
+            return record, None, e
+
+    def _run_batches(self, records, out, remaining):
+        """Batch di batch_size immagini, caricate in anticipo"""
+        chunk = []
+        for record, image, error in self._prefetch(records):
+            chunk.append((record, image, error))
+            if len(chunk) >= self.batch_size:
+                self._process(chunk, out, remaining)
+                chunk = []
+        if chunk:
+            self._process(chunk, out, remaining)
+
+    def _run_pool(self, records, out, remaining):
+        """Con il pool ogni record parte appena un posto si libera
+
+        Restano in volo 2 x workers richieste: nessun worker aspetta il
+        più lento di un batch. I risultati sono scritti man mano che
+        arrivano; i worker caricano le immagini dai path.
+        """
+        pool = self.medgemma.worker_pool
+        window = 2 * pool.workers
+        pending = {}
+        records = iter(records)
+
+        while True:
+            for record in records:
+                if "invalid" in record:
+                    self._write(out, record, {"response": None, "error": f"Record non valido: {record['invalid']}"})
+                    continue
+                image = record["image"]
+                if not image.startswith(("http://", "https://")) and not os.path.exists(split_frame(image)[0]):
+                    self._write(out, record, {"response": None, "error": f"File non trovato: {image}"})
+                    continue
+                pending[pool.submit(image, record["question"])] = record
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                self._write(out, pending.pop(future), future.result())
+            self._commit(out, remaining)
+        # Righe di record non validi scritte dopo l'ultimo risultato
+        self._commit(out, remaining)
+
+    def _process(self, chunk, out, remaining):
+        """Analizza un batch, scrive i risultati e aggiorna il checkpoint"""
+        valid = [(record, image) for record, image, error in chunk if error is None]
+        items = [(image, record["question"]) for record, image in valid]
+        results = iter(self.medgemma.analyze_images(items))
+
+        for record, _, error in chunk:
+            if "invalid" in record:
+                result = {"response": None, "error": f"Record non valido: {error}"}
+            elif isinstance(error, FileNotFoundError):
+                result = {"response": None, "error": str(error)}
+            elif error is not None:
+                result = {"response": None, "error": f"Errore caricamento immagine: {error}"}
+            else:
+                result = next(results)
+            self._write(out, record, result)
+        self._commit(out, remaining)
+
+    def _write(self, out, record, result):
+        line = dict(record)
+        line.pop("invalid", None)
+        line.update(result)
+        out.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+        self.processed += 1
+        if result["error"] is not None:
+            self.errors += 1
+
+    def _commit(self, out, remaining):
+        # Il file di output è la fonte di verità per la ripresa
+        out.flush()
+        os.fsync(out.fileno())
+        self._write_checkpoint()
+        self._print_progress(remaining)
+
+    def _write_checkpoint(self):
+        checkpoint = {
+            "source": self.source,
+            "output": self.output,
+            "processed": self.processed,
+            "errors": self.errors,
+            "elapsed": time.perf_counter() - self.start,
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        tmp = f"{self.checkpoint_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(tmp, self.checkpoint_path)
+
+    def _print_progress(self, remaining):
+        elapsed = time.perf_counter() - self.start
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        left = remaining - self.processed
+        eta = left / rate if rate > 0 else 0
+
+        percent = self.processed / remaining if remaining else 1.0
+        print(f"[{self.processed}/{remaining}] {percent:5.1%} | {rate:.2f} img/s | "
+              f"errori {self.errors} | ETA {eta / 60:.1f} min")
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+Benchmark MedGemma
+Avvio a freddo, primo token, token/s, latenze e memoria, anche offline con un modello in miniatura
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from medgemma_tiny import ensure_tiny_model
+
+BENCH_QUESTION = "Describe this medical image in detail"
+TINY_MODEL_DIR = os.path.join("results", "tiny-medgemma")
+TINY_DRAFT_DIR = os.path.join("results", "tiny-medgemma-draft")
+DEFAULT_BASELINE = os.path.join("results", "bench_baseline.json")
+DEFAULT_OUTPUT = os.path.join("results", "bench_report.json")
+
+# Metriche confrontate con il baseline: True se più alto è meglio
+METRICS = {
+    "ttft": False,
+    "p50": False,
+    "p95": False,
+    "p99": False,
+    "tokens_per_second": True,
+    "throughput": True,
+    "peak_rss_mb": False,
+}
+
+_COLD_START_MARKER = "BENCH_COLD_START "
+_COLD_START_CODE = """
+import json, time
+start = time.perf_counter()
+from medgemma_bench import peak_rss_mb
+from test_medgemma import MedGemmaTest
+imported = time.perf_counter() - start
+medgemma = MedGemmaTest()
+medgemma.pipe
+print({marker!r} + json.dumps({{
+    "import": imported,
+    "total": time.perf_counter() - start,
+    "startup": medgemma.startup_timings,
+    "peak_rss_mb": peak_rss_mb(),
+}}))
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="test_medgemma.py bench",
+        description="Benchmark offline con modello in miniatura (o con il modello configurato)"
+    )
+    parser.add_argument("--real", action="store_true", help="usa MODEL_NAME del .env invece del modello in miniatura")
+    parser.add_argument("--model-dir", default=TINY_MODEL_DIR, help=f"cartella del modello in miniatura (default {TINY_MODEL_DIR})")
+    parser.add_argument("--batch-sizes", default="1,4", help="batch da misurare, separati da virgola (default 1,4)")
+    parser.add_argument("--image-sizes", default="512,2048", help="lati delle immagini sintetiche in pixel (default 512,2048)")
+    parser.add_argument("--requests", type=int, default=16, help="richieste misurate per configurazione (default 16)")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="token generati per richiesta (default 32)")
+    parser.add_argument("--cold-runs", type=int, default=3, help="avvii a freddo misurati (default 3, 0 per saltarli)")
+    parser.add_argument("--draft", action="store_true",
+                        help="decodifica assistita con verifica greedy (draft in miniatura, o DRAFT_MODEL_NAME con --real)")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help=f"report JSON (default {DEFAULT_OUTPUT})")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help=f"baseline per le regressioni (default {DEFAULT_BASELINE})")
+    parser.add_argument("--save-baseline", action="store_true", help="salva questo report come nuovo baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="peggioramento tollerato sul baseline (default 0.15)")
+    return parser.parse_args(argv)
+
+
+def peak_rss_mb():
+    """Picco di memoria residente del processo in MB"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss è in KB su Linux, in byte su macOS
+        return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        peak = getattr(psutil.Process().memory_info(), "peak_wset", None)
+        return peak / 1024**2 if peak is not None else None
+    except ImportError:
+        return None
+
+
+def reset_peak_rss():
+    """Azzera il picco di memoria residente del processo (Linux), False se non si può"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def window_peak_rss_mb():
+    """Picco di memoria residente dall'ultimo reset_peak_rss (VmHWM), in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def percentile(values, q):
+    """Percentile con interpolazione lineare (q tra 0 e 100)"""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def synthetic_images(directory, size, count, seed=0):
+    """PNG in scala di grigi deterministici, così la decodifica entra nella misura"""
+    rng = random.Random(f"{seed}-{size}")
+    paths = []
+    for index in range(count):
+        path = Path(directory) / f"bench_{size}_{index}.png"
+        if not path.exists():
+            # Tessera di rumore ripetuta: abbastanza variata, generata in fretta
+            tile = Image.frombytes("L", (64, 64), rng.randbytes(64 * 64))
+            image = Image.new("L", (size, size))
+            for x in range(0, size, 64):
+                for y in range(0, size, 64):
+                    image.paste(tile, (x, y))
+            image.convert("RGB").save(path)
+        paths.append(str(path))
+    return paths
+
+
+class _TokenClock:
+    """Streamer per generate(): istante del primo token e token generati"""
+
+    def __init__(self):
+        self.prompt_seen = False
+        self.first_token = None
+        self.tokens = 0
+
+    def put(self, value):
+        # La prima chiamata contiene il prompt
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.tokens += value.numel()
+
+    def end(self):
+        pass
+
+
+class Benchmark:
+    """Misura una configurazione di MedGemmaTest su immagini sintetiche"""
+
+    def __init__(self, medgemma, question=BENCH_QUESTION):
+        self.medgemma = medgemma
+        self.question = question
+
+    def run_single(self, paths):
+        """Richieste singole: primo token, token/s e latenza per richiesta"""
+        latencies, ttfts, assisted = [], [], []
+        tokens = 0
+        excluded = 0.0
+        start = time.perf_counter()
+        for path in paths:
+            request_start = time.perf_counter()
+            clock = _TokenClock()
+            self.medgemma.last_assisted = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                image = self.medgemma.load_image(path)
+                inputs = self.medgemma._prepare_request(image, self.question)
+                self.medgemma._generate(inputs, streamer=clock)
+            # La rigenerazione greedy di DRAFT_VERIFY non entra nelle latenze
+            baseline = self.medgemma.last_assisted.get("baseline_seconds", 0.0)
+            excluded += baseline
+            end = time.perf_counter() - baseline
+            latencies.append(end - request_start)
+            ttfts.append((clock.first_token or end) - request_start)
+            tokens += clock.tokens
+            if self.medgemma.last_assisted:
+                assisted.append(self.medgemma.last_assisted)
+        elapsed = time.perf_counter() - start - excluded
+        summary = self._summary(latencies, len(paths), tokens, elapsed, ttft=percentile(ttfts, 50))
+        if assisted:
+            summary["assisted"] = self._assisted_summary(assisted)
+        return summary
+
+    @staticmethod
+    def _assisted_summary(samples):
+        """Accettazione e speedup medi della decodifica assistita"""
+        proposed = sum(sample["proposed"] for sample in samples)
+        speedups = [sample["speedup"] for sample in samples if "speedup" in sample]
+        return {
+            "acceptance_rate": sum(sample["accepted"] for sample in samples) / proposed if proposed else 0.0,
+            "tokens_per_forward": sum(sample["tokens_per_forward"] for sample in samples) / len(samples),
+            "speedup": sum(speedups) / len(speedups) if speedups else None,
+            "identical": all(sample.get("identical", True) for sample in samples),
+        }
+
+    def run_batched(self, paths, batch_size):
+        """Batch via analyze_images: ogni richiesta termina con il suo batch"""
+        tokenizer = self.medgemma.pipe.processor.tokenizer
+        latencies = []
+        tokens = 0
+        start = time.perf_counter()
+        for offset in range(0, len(paths), batch_size):
+            chunk = paths[offset:offset + batch_size]
+            batch_start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                items = [(self.medgemma.load_image(path), self.question) for path in chunk]
+                results = self.medgemma.analyze_images(items, batch_size=batch_size)
+            latencies.extend([time.perf_counter() - batch_start] * len(chunk))
+            for result in results:
+                if result["error"] is not None:
+                    raise RuntimeError(result["error"])
+                # La pipeline restituisce testo: i token si ricontano
+                tokens += len(tokenizer(result["response"], add_special_tokens=False)["input_ids"])
+        elapsed = time.perf_counter() - start
+        return self._summary(latencies, len(paths), tokens, elapsed, ttft=None)
+
+    def run(self, paths, batch_size, warmup_paths=()):
+        """Una configurazione, preceduta da richieste di warmup non misurate
+
+        Il picco RSS è quello della sola configurazione (Linux: il picco
+        viene azzerato all'inizio); altrove resta None e il report ha solo
+        il picco dell'intera esecuzione.
+        """
+        runner = self.run_single if batch_size == 1 else lambda p: self.run_batched(p, batch_size)
+        measured = reset_peak_rss()
+        if warmup_paths:
+            runner(list(warmup_paths))
+        summary = runner(paths)
+        summary["peak_rss_mb"] = window_peak_rss_mb() if measured else None
+        return summary
+
+    @staticmethod
+    def _summary(latencies, requests, tokens, elapsed, ttft):
+        return {
+            "requests": requests,
+            "ttft": ttft,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "tokens": tokens,
+            "tokens_per_second": tokens / elapsed if elapsed > 0 else 0.0,
+            "throughput": requests / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def measure_cold_start(runs, env):
+    """Avvio completo in processi nuovi: import, configurazione e modello"""
+    workdir = Path(__file__).resolve().parent
+    code = _COLD_START_CODE.format(marker=_COLD_START_MARKER)
+    samples = []
+    for run in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+        lines = [line for line in completed.stdout.splitlines() if line.startswith(_COLD_START_MARKER)]
+        if completed.returncode != 0 or not lines:
+            raise RuntimeError(f"Avvio a freddo fallito:\n{completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+        samples.append(json.loads(lines[-1][len(_COLD_START_MARKER):]))
+        print(f"  avvio a freddo {run + 1}/{runs}: {samples[-1]['total']:.2f}s")
+
+    totals = [sample["total"] for sample in samples]
+    return {
+        "runs": runs,
+        "p50": percentile(totals, 50),
+        "min": min(totals),
+        "max": max(totals),
+        "import": percentile([sample["import"] for sample in samples], 50),
+        "peak_rss_mb": max(sample["peak_rss_mb"] or 0 for sample in samples) or None,
+        "samples": samples,
+    }
+
+
+def environment_info(medgemma):
+    import torch
+    import transformers
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        "model": medgemma.model_name,
+        "device": str(medgemma.pipe.model.device),
+        "dtype": medgemma.torch_dtype,
+        "compile": medgemma.compile_mode if medgemma.compile else None,
+        "compile_speedup": (medgemma.compile_report or {}).get("speedup"),
+        "attn_implementation": medgemma.attn_implementation,
+    }
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    """Regressioni oltre la tolleranza rispetto al baseline"""
+    regressions = []
+
+    def check(name, current, reference, higher_is_better):
+        if current is None or not reference:
+            return
+        change = (current - reference) / reference
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        if worse:
+            regressions.append({"metric": name, "baseline": reference, "current": current, "change": change})
+
+    check("cold_start", (report.get("cold_start") or {}).get("p50"),
+          (baseline.get("cold_start") or {}).get("p50"), False)
+    check("peak_rss_mb", report.get("peak_rss_mb"), baseline.get("peak_rss_mb"), False)
+
+    reference_results = {(r["batch_size"], r["image_size"]): r for r in baseline.get("results", [])}
+    for result in report["results"]:
+        reference = reference_results.get((result["batch_size"], result["image_size"]))
+        if reference is None:
+            continue
+        label = f"batch {result['batch_size']} / {result['image_size']}px"
+        for metric, higher_is_better in METRICS.items():
+            check(f"{label} {metric}", result.get(metric), reference.get(metric), higher_is_better)
+
+    return regressions
+
+
+def _bench_env(options):
+    """Variabili d'ambiente per il modello in prova (hanno la precedenza sul .env)"""
+    env = {
+        "DEBUG": "false",
+        "CACHE_ENABLED": "false",
+        "FAST_START": "false",
+        "WORKERS": "0",
+        "METRICS": "false",
+        "RESULTS_DB": "",
+        "MAX_NEW_TOKENS": str(options.max_new_tokens),
+        "DRAFT_VERIFY": "true" if options.draft else "false",
+    }
+    if not options.real:
+        env.update({
+            "MODEL_NAME": str(Path(options.model_dir).resolve()),
+            "OFFLINE_MODE": "true",
+            "SNAPSHOT_DIR": "",
+            "DRAFT_MODEL_NAME": str(Path(options.draft_dir).resolve()) if options.draft else "",
+        })
+    elif not options.draft:
+        env["DRAFT_MODEL_NAME"] = ""
+    return env
+
+
+def _format(value, unit=""):
+    return f"{value:.3f}{unit}" if isinstance(value, float) else "-"
+
+
+def run_benchmark(factory, options):
+    """Esegue tutte le configurazioni, salva il report e segnala le regressioni
+
+    factory() deve restituire un'istanza MedGemmaTest: viene chiamata
+    dopo aver impostato le variabili d'ambiente del benchmark.
+    Ritorna True se non ci sono regressioni.
+    """
+    batch_sizes = [int(value) for value in options.batch_sizes.split(",")]
+    image_sizes = [int(value) for value in options.image_sizes.split(",")]
+
+    options.draft_dir = TINY_DRAFT_DIR
+    if not options.real:
+        ensure_tiny_model(options.model_dir, draft_path=options.draft_dir if options.draft else None)
+    os.environ.update(_bench_env(options))
+
+    cold_start = None
+    if options.cold_runs > 0:
+        print(f"\nAvvio a freddo ({options.cold_runs} processi)...")
+        cold_start = measure_cold_start(options.cold_runs, dict(os.environ))
+
+    medgemma = factory()
+    benchmark = Benchmark(medgemma)
+    # L'azzeramento per configurazione altera anche ru_maxrss: il picco
+    # complessivo è il massimo fra caricamento e configurazioni
+    startup_peak = peak_rss_mb()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="medgemma-bench-") as directory:
+        for image_size in image_sizes:
+            count = options.requests + max(batch_sizes)
+            paths = synthetic_images(directory, image_size, count)
+            for batch_size in batch_sizes:
+                print(f"\nBatch {batch_size}, immagini {image_size}px: {options.requests} richieste...")
+                # Le prime immagini servono al warmup, le misure usano le altre
+                result = benchmark.run(paths[max(batch_sizes):], batch_size, warmup_paths=paths[:batch_size])
+                result.update({"batch_size": batch_size, "image_size": image_size})
+                results.append(result)
+                print(f"  p50 {_format(result['p50'], 's')} | p95 {_format(result['p95'], 's')} | "
+                      f"{result['tokens_per_second']:.1f} token/s | {result['throughput']:.2f} img/s")
+                if "assisted" in result:
+                    assisted = result["assisted"]
+                    print(f"  assistita: accettati {assisted['acceptance_rate']:.0%} | "
+                          f"speedup {_format(assisted['speedup'], 'x')} | "
+                          f"output {'identico' if assisted['identical'] else 'DIVERSO'} dal greedy")
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": environment_info(medgemma),
+        "config": {
+            "real_model": options.real,
+            "requests": options.requests,
+            "max_new_tokens": options.max_new_tokens,
+            "batch_sizes": batch_sizes,
+            "image_sizes": image_sizes,
+            "prefix_cache": medgemma.prefix_caching,
+            "preprocess": medgemma.preprocess,
+            "draft_model": medgemma.draft_model_name if medgemma.draft is not None else None,
+        },
+        "cold_start": cold_start,
+        "results": results,
+        "peak_rss_mb": max(
+            [value for value in [startup_peak, peak_rss_mb()] + [r["peak_rss_mb"] for r in results] if value],
+            default=None
+        ),
+    }
+
+    regressions = []
+    if options.save_baseline:
+        Path(options.baseline).parent.mkdir(parents=True, exist_ok=True)
+        Path(options.baseline).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"\nBaseline salvato in {options.baseline}")
+    elif os.path.exists(options.baseline):
+        baseline = json.loads(Path(options.baseline).read_text(encoding="utf-8"))
+        if baseline.get("environment", {}).get("model") != report["environment"]["model"]:
+            print("\nATTENZIONE: il baseline è stato misurato con un altro modello")
+        regressions = compare_with_baseline(report, baseline, options.tolerance)
+        report["baseline"] = options.baseline
+    report["regressions"] = regressions
+
+    Path(options.output).parent.mkdir(parents=True, exist_ok=True)
+    Path(options.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    print("\nREPORT BENCHMARK")
+    print("=" * 50)
+    if cold_start is not None:
+        print(f"Avvio a freddo: {cold_start['p50']:.2f}s (import {cold_start['import']:.2f}s)")
+    print(f"{'batch':>5} {'px':>6} {'TTFT':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'token/s':>9} {'img/s':>7} {'RSS MB':>7}")
+    for r in results:
+        rss = f"{r['peak_rss_mb']:7.0f}" if r["peak_rss_mb"] is not None else f"{'-':>7}"
+        print(f"{r['batch_size']:>5} {r['image_size']:>6} {_format(r['ttft']):>8} {_format(r['p50']):>8} "
+              f"{_format(r['p95']):>8} {_format(r['p99']):>8} {r['tokens_per_second']:9.1f} {r['throughput']:7.2f} {rss}")
+    if report["peak_rss_mb"] is not None:
+        print(f"Picco RSS: {report['peak_rss_mb']:.0f} MB")
+
+    if regressions:
+        print(f"\nREGRESSIONI (tolleranza {options.tolerance:.0%}):")
+        for regression in regressions:
+            print(f"  {regression['metric']}: {regression['baseline']:.3f} -> "
+                  f"{regression['current']:.3f} ({regression['change']:+.0%})")
+    elif "baseline" in report:
+        print(f"\nNessuna regressione rispetto a {options.baseline}")
+    print(f"\nReport salvato in {options.output}")
+
+    if any(not r.get("assisted", {}).get("identical", True) for r in results):
+        print("\nERRORE: la decodifica assistita non coincide con la greedy")
+        return False
+    return not regressions
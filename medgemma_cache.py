@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Cache risposte MedGemma
+LRU in memoria + archivio su disco, indicizzati per contenuto
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def image_digest(image):
+    """Hash SHA-256 dei pixel decodificati di un'immagine PIL"""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def make_key(image, question, digest=None, **settings):
+    """Chiave di cache: pixel + prompt + impostazioni di generazione
+
+    digest è image_digest(image) se già calcolato dal chiamante.
+    """
+    payload = json.dumps(
+        {"image": digest or image_digest(image), "question": question, "settings": settings},
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Cache a due livelli per risposte deterministiche"""
+
+    def __init__(self, cache_dir="results/cache", memory_bytes=64 * 1024**2, disk_bytes=512 * 1024**2):
+        self.cache_dir = Path(cache_dir)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = None
+        self._lock = threading.Lock()
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key):
+        """Ritorna la risposta salvata o None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            response = json.loads(path.read_text(encoding="utf-8"))["response"]
+            # Aggiorna mtime: l'eviction su disco rimuove i meno usati
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits_disk += 1
+            self._remember(key, response)
+        return response
+
+    def put(self, key, response):
+        """Salva una risposta in entrambi i livelli"""
+        data = json.dumps({"key": key, "response": response}, ensure_ascii=False)
+
+        with self._lock:
+            self._remember(key, response)
+
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                old_size = path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            self._write_atomic(path, data.encode("utf-8"))
+        except OSError as e:
+            print(f"Errore scrittura cache: {e}")
+            return
+
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = self._scan_disk_usage()
+            else:
+                # Una chiave riscritta sostituisce il file precedente
+                self._disk_used += len(data.encode("utf-8")) - old_size
+            if self._disk_used > self.disk_bytes:
+                self._evict_disk()
+
+    def stats(self):
+        """Contatori hit/miss e occupazione"""
+        with self._lock:
+            hits = self.hits_memory + self.hits_disk
+            total = hits + self.misses
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_bytes": self._disk_used if self._disk_used is not None else self._scan_disk_usage(),
+            }
+
+    def _path(self, key):
+        # Due livelli di directory per non avere migliaia di file in una cartella
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key, response):
+        """Inserisce in LRU memoria ed esegue eviction per dimensione"""
+        size = len(response.encode("utf-8"))
+        if size > self.memory_bytes:
+            return
+
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key).encode("utf-8"))
+
+        self._memory[key] = response
+        self._memory_used += size
+
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted.encode("utf-8"))
+
+    def _write_atomic(self, path, data):
+        # File temporaneo univoco: più processi possono condividere CACHE_DIR
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _scan_disk_usage(self):
+        return sum(p.stat().st_size for p in self.cache_dir.glob("*/*.json"))
+
+    def _evict_disk(self):
+        """Rimuove i file meno usati finché si rientra nel limite"""
+        entries = []
+        for p in self.cache_dir.glob("*/*.json"):
+            try:
+                st = p.stat()
+                entries.append((st.st_mtime, st.st_size, p))
+            except OSError:
+                continue
+
+        entries.sort()
+        used = sum(size for _, size, _ in entries)
+        # Scende al 90% del limite per non ripetere la scansione a ogni put
+        target = self.disk_bytes * 0.9
+
+        for _, size, p in entries:
+            if used <= target:
+                break
+            try:
+                p.unlink()
+                used -= size
+            except OSError:
+                continue
+
+        self._disk_used = used
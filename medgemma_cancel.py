@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Cancellazione MedGemma
+Deadline e token di annullamento controllati tra un passo di decodifica e l'altro
+"""
+
+import contextlib
+import threading
+import time
+
+# Motivi di interruzione e testo mostrato nelle risposte troncate
+REASONS = {
+    "deadline": "tempo massimo superato",
+    "interrupted": "interrotta dall'utente",
+    "disconnected": "client disconnesso",
+    "cancelled": "richiesta annullata",
+}
+
+_local = threading.local()
+
+
+class CancelToken:
+    """Annullamento cooperativo di una richiesta
+
+    deadline è un istante time.time() (confrontabile anche fra processi);
+    check è una funzione opzionale che ritorna True se la richiesta va
+    annullata (es. un flag condiviso con il processo padre). Dopo la
+    generazione truncated contiene il motivo se la risposta è parziale e
+    reduced_budget i token di risposta usati se un OOM li ha ridotti.
+    """
+
+    def __init__(self, deadline=None, check=None):
+        self.deadline = deadline
+        self.truncated = None
+        self.reduced_budget = None
+        self._check = check
+        self._reason = None
+        self._callbacks = []
+
+    @classmethod
+    def with_timeout(cls, seconds):
+        """Token che scade dopo seconds (0 o None = nessuna deadline)"""
+        return cls(time.time() + seconds if seconds and seconds > 0 else None)
+
+    def cancel(self, reason="cancelled"):
+        if self._reason is not None:
+            return
+        self._reason = reason
+        for callback in self._callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """callback() alla chiamata di cancel (non alla scadenza della deadline)"""
+        if self._reason is not None:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    @property
+    def reason(self):
+        """Motivo dell'interruzione, None se la richiesta è ancora valida"""
+        if self._reason is None:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self._reason = "deadline"
+            elif self._check is not None and self._check():
+                self._reason = "cancelled"
+        return self._reason
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def remaining(self):
+        """Secondi alla deadline, None se non c'è"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+
+def describe(reason):
+    return REASONS.get(reason, reason)
+
+
+def truncation_note(reason):
+    """Segnalazione in coda alle risposte restituite come testo"""
+    return f"\n\n[Risposta incompleta: {describe(reason)}]"
+
+
+def current():
+    """Token della richiesta attiva nel thread corrente"""
+    return getattr(_local, "token", None)
+
+
+@contextlib.contextmanager
+def activate(token):
+    """Rende token la richiesta attiva nel thread corrente"""
+    previous = current()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+class CancelCriteria:
+    """Stopping criteria per generate(): ferma la riga i quando tokens[i] è annullato
+
+    Viene valutato a ogni passo di decodifica; in un batch le altre righe
+    proseguono e generate termina appena tutte sono finite. stopped[i]
+    contiene il motivo se la riga i è stata interrotta prima della fine
+    naturale (EOS o padding).
+    """
+
+    def __init__(self, tokens, finished_ids=()):
+        self.tokens = list(tokens)
+        self.finished_ids = {token_id for token_id in finished_ids if token_id is not None}
+        self.stopped = [None] * len(self.tokens)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        last = input_ids[:, -1].tolist()
+        flags = []
+        for i, token in enumerate(self.tokens):
+            reason = token.reason if token is not None else None
+            if reason is not None and self.stopped[i] is None and last[i] not in self.finished_ids:
+                self.stopped[i] = reason
+            flags.append(reason is not None)
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
+    @property
+    def active(self):
+        return any(token is not None for token in self.tokens)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Esecuzione compilata MedGemma
+torch.compile del passo di decodifica con KV cache statica, cache di compilazione su disco
+"""
+
+import json
+import os
+import statistics
+import time
+from pathlib import Path
+
+ATTN_IMPLEMENTATIONS = ("auto", "sdpa", "eager", "flash_attention_2")
+COMPILE_MODES = ("default", "reduce-overhead", "max-autotune", "max-autotune-no-cudagraphs")
+
+WARMUP_QUESTION = "Describe this medical image in detail, listing every visible structure, " * 4
+ARTIFACTS_FILE = "artifacts.bin"
+REPORT_FILE = "compile_report.json"
+
+
+def configure_cache_dir(cache_dir):
+    """Cache persistente di Inductor: va impostata prima dell'import di torch
+
+    Con la cache FX/AOT i grafi compilati in un avvio precedente vengono
+    riletti da disco invece di essere ricompilati.
+    """
+    path = Path(cache_dir).resolve()
+    path.mkdir(parents=True, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(path / "inductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    os.environ.setdefault("TRITON_CACHE_DIR", str(path / "triton"))
+    return path
+
+
+def load_cache_artifacts(cache_dir):
+    """Precarica gli artefatti salvati (torch >= 2.6), True se presenti"""
+    import torch
+
+    path = Path(cache_dir) / ARTIFACTS_FILE
+    if not path.exists() or not hasattr(torch.compiler, "load_cache_artifacts"):
+        return False
+    try:
+        torch.compiler.load_cache_artifacts(path.read_bytes())
+        return True
+    except Exception as e:
+        print(f"Artefatti di compilazione non validi, ricompilo: {e}")
+        return False
+
+
+def save_cache_artifacts(cache_dir):
+    """Salva gli artefatti della sessione in un unico file (torch >= 2.6)"""
+    import torch
+
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return False
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return False
+    path = Path(cache_dir) / ARTIFACTS_FILE
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(artifacts[0])
+    tmp.replace(path)
+    return True
+
+
+def supports_compile():
+    """generate() compila il passo di decodifica da transformers 4.51"""
+    from transformers import GenerationConfig
+
+    try:
+        from transformers import CompileConfig  # noqa: F401
+    except ImportError:
+        return False
+    return hasattr(GenerationConfig(), "disable_compile")
+
+
+def enable_compile(model, mode="default"):
+    """Decodifica compilata con KV cache statica
+
+    Il prefill (lunghezza variabile) resta eager; i passi di decodifica,
+    con forme fisse grazie alla cache statica, usano il forward compilato.
+    Ritorna gli argomenti da passare a generate(): la configurazione del
+    modello non cambia, così le chiamate con una DynamicCache propria
+    (sessioni, conversazioni, decodifica assistita) restano valide.
+    """
+    from transformers import CompileConfig
+
+    cache_implementation = model.generation_config.cache_implementation
+    if cache_implementation not in ("static", "hybrid", "sliding_window"):
+        cache_implementation = "static"
+
+    compile_config = CompileConfig(mode=mode, fullgraph=False, dynamic=False)
+    # generate() compila automaticamente solo su CUDA: anche su CPU conviene
+    compile_config._compile_all_devices = True
+    model.generation_config.disable_compile = False
+    return {"cache_implementation": cache_implementation, "compile_config": compile_config}
+
+
+class _StepTimer:
+    """Streamer per generate(): istante di ogni token generato"""
+
+    def __init__(self):
+        self.prompt_seen = False
+        self.times = []
+
+    def put(self, value):
+        # La prima chiamata contiene il prompt
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        self.times.append(time.perf_counter())
+
+    def end(self):
+        pass
+
+    def per_token_ms(self):
+        """Mediana fra token consecutivi: latenza di un passo a regime"""
+        steps = [b - a for a, b in zip(self.times, self.times[1:])]
+        return statistics.median(steps) * 1000 if steps else None
+
+
+def _stop_after(tokens, input_len):
+    from transformers import StoppingCriteria
+
+    class StopAfter(StoppingCriteria):
+        # max_new_tokens resta quello configurato: la cache statica viene
+        # allocata alla dimensione delle richieste reali e poi riusata
+        def __call__(self, input_ids, scores, **kwargs):
+            return input_ids.shape[1] - input_len >= tokens
+
+    return StopAfter()
+
+
+def _timed_generate(model, inputs, compile_kwargs, max_new_tokens, tokens, disable_compile):
+    from transformers import StoppingCriteriaList
+
+    timer = _StepTimer()
+    model.generate(
+        **inputs,
+        **compile_kwargs,
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        streamer=timer,
+        stopping_criteria=StoppingCriteriaList([_stop_after(tokens, inputs["input_ids"].shape[1])]),
+        disable_compile=disable_compile,
+    )
+    return timer.per_token_ms()
+
+
+def warmup(model, inputs, max_new_tokens, compile_kwargs, tokens=16, cache_dir=None, compare=True):
+    """Compila (o rilegge dalla cache) e misura la decodifica
+
+    compile_kwargs sono gli argomenti di generate() di enable_compile.
+    Ritorna il report: tempo di warmup, ms per token compilati e, con
+    compare, eager e speedup sulla stessa richiesta.
+    """
+    report = {"tokens": tokens}
+
+    if compare:
+        _timed_generate(model, inputs, compile_kwargs, max_new_tokens, 2, disable_compile=True)
+        report["eager_ms_per_token"] = _timed_generate(model, inputs, compile_kwargs, max_new_tokens, tokens, disable_compile=True)
+
+    start = time.perf_counter()
+    _timed_generate(model, inputs, compile_kwargs, max_new_tokens, 2, disable_compile=False)
+    report["warmup_seconds"] = time.perf_counter() - start
+
+    report["compiled_ms_per_token"] = _timed_generate(model, inputs, compile_kwargs, max_new_tokens, tokens, disable_compile=False)
+
+    eager, compiled = report.get("eager_ms_per_token"), report["compiled_ms_per_token"]
+    if eager and compiled:
+        report["speedup"] = eager / compiled
+
+    if cache_dir is not None:
+        report["artifacts_saved"] = save_cache_artifacts(cache_dir)
+        report["created"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        (Path(cache_dir) / REPORT_FILE).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    return report
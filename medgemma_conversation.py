@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Conversazioni MedGemma
+Sessioni a più turni che conservano cronologia e KV cache: ogni turno fa il prefill solo dei token nuovi
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from medgemma_cache import image_digest
+from medgemma_cancel import CancelToken, activate as activate_token, current as current_token, truncation_note
+from medgemma_engine import common_prefix_length
+from medgemma_vision import PLACEHOLDER_IMAGE
+
+
+def cache_nbytes(cache):
+    """Memoria occupata dai tensori chiave/valore di una KV cache"""
+    if cache is None:
+        return 0
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        tensors = [getattr(layer, name, None) for layer in layers for name in ("keys", "values")]
+    else:
+        tensors = list(getattr(cache, "key_cache", ())) + list(getattr(cache, "value_cache", ()))
+    return sum(t.numel() * t.element_size() for t in tensors if hasattr(t, "numel"))
+
+
+class Conversation:
+    """Dialogo a più turni su un'immagine (o solo testo)
+
+    Il prompt di ogni turno è la cronologia completa, ma la KV cache del
+    turno precedente copre già la parte comune: il prefill elabora solo
+    la nuova domanda. Se la cache è stata liberata (limite di memoria) il
+    turno successivo ricalcola la cronologia e riparte da lì.
+    """
+
+    def __init__(self, medgemma, image=None, name=None, store=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.medgemma = medgemma
+        self.name = name or ("immagine" if image is not None else "testo")
+        self.store = store
+        self.image = image
+        # Un solo hash dei pixel per cache delle feature e archivio
+        self.image_hash = image_digest(image) if image is not None else None
+        self.features = medgemma.image_features(image, digest=self.image_hash) if image is not None else None
+        self.messages = []
+        self.cache = None
+        self.cached_ids = None
+        self.cache_bytes = 0
+        self.turns = 0
+        self.prefilled_tokens = 0
+        self.reused_tokens = 0
+        self.created = time.time()
+        self.last_used = self.created
+        self._lock = threading.Lock()
+
+    def turn(self, question):
+        """Un turno della conversazione: dict con response, error, truncated e turn"""
+        with self.medgemma.metrics.trace("conversation") as trace, self.medgemma._cancel_scope() as token:
+            try:
+                response = self._turn(question, trace)
+            except Exception as e:
+                trace.fail(e)
+                return {"response": None, "error": f"Errore durante analisi: {e}", "truncated": None, "turn": self.turns}
+            return {"response": response, "error": None, "truncated": token.truncated, "turn": self.turns}
+
+    def ask(self, question):
+        """Risposta come testo, con la segnalazione se incompleta"""
+        result = self.turn(question)
+        if result["error"] is not None:
+            return result["error"]
+        if result["truncated"]:
+            return result["response"] + truncation_note(result["truncated"])
+        return result["response"]
+
+    def ask_stream(self, question):
+        """Come ask, ma restituisce il testo a pezzi (tempi in medgemma.last_timings)"""
+        metrics = self.medgemma.metrics
+        start = time.perf_counter()
+        self.medgemma.last_timings = {}
+
+        outer = metrics.current()
+        trace = outer or metrics.begin("conversation")
+        try:
+            yield from self._stream(question, trace, start)
+        finally:
+            if outer is None:
+                metrics.record(trace)
+
+    def _stream(self, question, trace, start):
+        try:
+            from transformers import TextIteratorStreamer
+
+            streamer = TextIteratorStreamer(
+                self.medgemma.pipe.processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+            )
+        except Exception as e:
+            trace.fail(e)
+            yield f"Errore durante analisi: {e}"
+            return
+
+        errors = []
+        token = current_token() or CancelToken.with_timeout(self.medgemma.request_timeout)
+
+        def generate():
+            try:
+                with self.medgemma.metrics.activate(trace), activate_token(token):
+                    self._turn(question, trace, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+
+        ttft = None
+        try:
+            for chunk in streamer:
+                if not chunk:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                yield chunk
+        except GeneratorExit:
+            token.cancel("disconnected")
+            raise
+        thread.join()
+
+        self.medgemma.last_timings = {"ttft": ttft, "total": time.perf_counter() - start, "cached": False}
+        trace.attrs["ttft"] = ttft
+        if errors:
+            trace.fail(errors[0])
+            yield f"Errore durante analisi: {errors[0]}"
+        elif token.truncated:
+            yield truncation_note(token.truncated)
+
+    def _turn(self, question, trace, streamer=None):
+        medgemma = self.medgemma
+        with self._lock:
+            self.last_used = time.time()
+            messages = self.messages + self._new_messages(question)
+
+            with trace.stage("prompt"):
+                inputs = medgemma._prepare_inputs(messages)
+                if self.features is not None:
+                    inputs.pop("pixel_values", None)
+            input_ids = inputs["input_ids"]
+            input_len = input_ids.shape[1]
+
+            if self.cache is not None:
+                # L'ultimo token del prompt va sempre elaborato da generate
+                start = min(common_prefix_length(self.cached_ids.tolist(), input_ids[0].tolist()), input_len - 1)
+                cache = self.cache
+            else:
+                cache, start = medgemma._start_cache(input_ids)
+            if cache is None:
+                from transformers import DynamicCache
+                cache = DynamicCache()
+            # Fino al termine del turno la cache è in uso (e può essere incompleta)
+            self.cache, self.cached_ids, self.cache_bytes = None, None, 0
+
+            kwargs = {"streamer": streamer} if streamer is not None else {}
+            output_ids = medgemma._generate(
+                inputs, image_features=self.features, cache=cache, cache_start=start, **kwargs
+            )
+
+            # La cache copre prompt e risposta tranne l'ultimo token generato
+            length = min(cache.get_seq_length(), output_ids.shape[1] - 1)
+            cache.crop(length)
+            self.cache, self.cached_ids = cache, output_ids[0, :length]
+            self.cache_bytes = cache_nbytes(cache)
+
+            with trace.stage("detokenize"):
+                response = medgemma.pipe.processor.decode(output_ids[0, input_len:], skip_special_tokens=True)
+
+            self.messages = messages + [{"role": "assistant", "content": [{"type": "text", "text": response}]}]
+            self.turns += 1
+            self.prefilled_tokens += input_len - start
+            self.reused_tokens += start
+            self.last_used = time.time()
+            trace.attrs["conversation"] = self.id
+            trace.attrs["turn"] = self.turns
+            token = current_token()
+            medgemma._store_result(
+                "conversation", trace, self.image, question,
+                {
+                    "response": response,
+                    "truncated": token.truncated if token is not None else None,
+                    "reduced_budget": token.reduced_budget if token is not None else None,
+                },
+                image_hash=self.image_hash
+            )
+
+        if self.store is not None:
+            self.store.enforce_memory(active=self)
+        return response
+
+    def _new_messages(self, question):
+        if self.messages:
+            return [{"role": "user", "content": [{"type": "text", "text": question}]}]
+
+        # Primo turno: prompt di sistema e immagine; con le feature già
+        # calcolate basta il segnaposto per i token immagine
+        image = self.image
+        if image is not None and self.features is not None:
+            image = PLACEHOLDER_IMAGE
+        return self.medgemma._build_messages(image, question)
+
+    def drop_cache(self):
+        """Libera la KV cache mantenendo la cronologia; False se il turno è in corso"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.cache, self.cached_ids, self.cache_bytes = None, None, 0
+            return True
+        finally:
+            self._lock.release()
+
+    def info(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "turns": self.turns,
+            "cached_tokens": len(self.cached_ids) if self.cached_ids is not None else 0,
+            "cache_mb": round(self.cache_bytes / 1024**2, 1),
+            "prefilled_tokens": self.prefilled_tokens,
+            "reused_tokens": self.reused_tokens,
+            "idle_seconds": round(time.time() - self.last_used),
+        }
+
+
+class ConversationStore:
+    """Conversazioni aperte con scadenza per inattività e limite di memoria
+
+    Le conversazioni inattive da più di idle_seconds vengono chiuse. Oltre
+    max_mb di KV cache si libera la cache di quelle usate meno di recente
+    (la cronologia resta: il turno successivo rifà il prefill); oltre
+    max_sessions si chiude la meno recente.
+    """
+
+    def __init__(self, idle_seconds=1800, max_mb=1024, max_sessions=16):
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_mb * 1024**2
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+        self.closed = 0
+
+    def add(self, conversation):
+        conversation.store = self
+        with self._lock:
+            self._expire()
+            self._sessions[conversation.id] = conversation
+            while len(self._sessions) > max(1, self.max_sessions):
+                _, oldest = self._sessions.popitem(last=False)
+                oldest.drop_cache()
+                self.closed += 1
+        return conversation
+
+    def get(self, conversation_id):
+        """Conversazione attiva con quell'id, None se chiusa o scaduta"""
+        with self._lock:
+            self._expire()
+            conversation = self._sessions.get(conversation_id)
+            if conversation is not None:
+                self._sessions.move_to_end(conversation_id)
+            return conversation
+
+    def remove(self, conversation_id):
+        with self._lock:
+            conversation = self._sessions.pop(conversation_id, None)
+        if conversation is not None:
+            conversation.drop_cache()
+        return conversation is not None
+
+    def expire(self):
+        with self._lock:
+            return self._expire()
+
+    def _expire(self):
+        if not self.idle_seconds or self.idle_seconds <= 0:
+            return 0
+        limit = time.time() - self.idle_seconds
+        idle = [key for key, conversation in self._sessions.items() if conversation.last_used < limit]
+        for key in idle:
+            self._sessions.pop(key).drop_cache()
+        self.expired += len(idle)
+        return len(idle)
+
+    def enforce_memory(self, active=None):
+        """Libera le KV cache meno recenti finché il totale rientra nel limite"""
+        with self._lock:
+            if active is not None and active.id in self._sessions:
+                self._sessions.move_to_end(active.id)
+            total = sum(conversation.cache_bytes for conversation in self._sessions.values())
+            for conversation in list(self._sessions.values()):
+                if total <= self.max_bytes:
+                    break
+                if conversation is active or conversation.cache is None:
+                    continue
+                size = conversation.cache_bytes
+                if conversation.drop_cache():
+                    total -= size
+                    self.evicted += 1
+
+    def list(self):
+        with self._lock:
+            self._expire()
+            return [conversation.info() for conversation in reversed(self._sessions.values())]
+
+    def stats(self):
+        with self._lock:
+            cache_bytes = sum(conversation.cache_bytes for conversation in self._sessions.values())
+            return {
+                "sessions": len(self._sessions),
+                "cache_mb": round(cache_bytes / 1024**2, 1),
+                "max_mb": self.max_bytes // 1024**2,
+                "expired": self.expired,
+                "evicted_caches": self.evicted,
+                "closed": self.closed,
+            }
+
+    def __len__(self):
+        return len(self._sessions)
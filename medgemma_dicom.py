@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Input DICOM MedGemma
+Header senza pixel, pixel in memory-map, windowing e selezione di frame/slice
+"""
+
+import os
+import threading
+
+from PIL import Image
+
+DICOM_EXTENSIONS = (".dcm", ".dicom")
+
+# Finestre standard per TC (centro, ampiezza) in HU
+WINDOW_PRESETS = {
+    "lung": (-600, 1500),
+    "mediastinum": (40, 400),
+    "abdomen": (40, 400),
+    "liver": (60, 160),
+    "bone": (400, 1800),
+    "brain": (40, 80),
+}
+
+# Elementi più grandi di così non vengono letti da dcmread (solo posizione)
+DEFER_SIZE = 4096
+
+PIXEL_DATA = 0x7FE00010
+
+
+def _require_pydicom():
+    try:
+        import pydicom
+    except ImportError:
+        raise ImportError("Installa pydicom per leggere file DICOM: pip install pydicom") from None
+    return pydicom
+
+
+def split_frame(source):
+    """'esame.dcm#12' -> ('esame.dcm', 12); senza suffisso il frame è None"""
+    path, separator, frame = source.rpartition("#")
+    if separator and (frame.isdigit() or frame == "middle") and os.path.exists(path):
+        return path, int(frame) if frame.isdigit() else frame
+    return source, None
+
+
+def is_dicom(path):
+    """True per file .dcm/.dicom o con il marcatore 'DICM' dopo il preambolo"""
+    if path.lower().endswith(DICOM_EXTENSIONS):
+        return True
+    try:
+        with open(path, "rb") as f:
+            f.seek(128)
+            return f.read(4) == b"DICM"
+    except OSError:
+        return False
+
+
+def is_dicom_source(source):
+    """File DICOM (anche con #frame) o cartella con una serie DICOM"""
+    path, _ = split_frame(source)
+    if os.path.isdir(path):
+        return any(is_dicom(entry.path) for entry in _files(path))
+    return os.path.isfile(path) and is_dicom(path)
+
+
+def _files(directory):
+    return sorted((entry for entry in os.scandir(directory) if entry.is_file()), key=lambda e: e.name)
+
+
+def _frame_index(frame, count):
+    if frame is None or frame == "middle":
+        return count // 2
+    if not 0 <= frame < count:
+        raise ValueError(f"Frame {frame} fuori intervallo (0-{count - 1})")
+    return frame
+
+
+def _first(value):
+    """Primo valore di un attributo multi-valore (es. WindowCenter)"""
+    if value is None:
+        return None
+    try:
+        return float(value[0])
+    except TypeError:
+        return float(value)
+
+
+def _functional_group(ds, index, sequence, attribute):
+    """Attributo dai functional group di un DICOM enhanced (per frame o condivisi)"""
+    for groups, position in (("PerFrameFunctionalGroupsSequence", index), ("SharedFunctionalGroupsSequence", 0)):
+        items = getattr(ds, groups, None)
+        if not items or position >= len(items):
+            continue
+        nested = getattr(items[position], sequence, None)
+        if nested and attribute in nested[0]:
+            return getattr(nested[0], attribute)
+    return None
+
+
+class DicomLoader:
+    """Converte un frame DICOM in un'immagine PIL pronta per il modello
+
+    Legge solo l'header: i pixel non compressi sono mappati in memoria e
+    del file viene letto solo il frame scelto. I formati compressi sono
+    decodificati da pydicom, un frame alla volta se la versione lo consente.
+    """
+
+    def __init__(self, window="auto", frame="middle"):
+        self.window = window
+        self.frame = frame
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def load(self, source, target_size=None):
+        """Immagine da file DICOM, 'file.dcm#frame' o cartella di serie ('serie#slice')"""
+        pydicom = _require_pydicom()
+
+        path, frame = split_frame(source)
+        if frame is None:
+            frame = self.frame
+        if os.path.isdir(path):
+            path = self.select_slice(path, frame)
+            frame = None
+
+        ds = pydicom.dcmread(path, defer_size=DEFER_SIZE)
+        index = _frame_index(frame, int(getattr(ds, "NumberOfFrames", 1) or 1))
+        pixels = self._frame_pixels(ds, index, path=path)
+        return self._to_image(ds, index, self._downsample(pixels, target_size))
+
+    def load_bytes(self, data, target_size=None):
+        """Come load, per un DICOM già in memoria (es. upload HTTP)"""
+        import io
+
+        pydicom = _require_pydicom()
+
+        ds = pydicom.dcmread(io.BytesIO(data))
+        index = _frame_index(self.frame, int(getattr(ds, "NumberOfFrames", 1) or 1))
+        pixels = self._frame_pixels(ds, index)
+        return self._to_image(ds, index, self._downsample(pixels, target_size))
+
+    def select_slice(self, directory, slice_index=None):
+        """Path della slice scelta in una serie, ordinata per posizione
+
+        Legge solo gli header; l'ordine è calcolato una volta per cartella.
+        """
+        paths = self._sorted_series(directory)
+        if not paths:
+            raise FileNotFoundError(f"Nessun file DICOM in {directory}")
+        return paths[_frame_index(slice_index, len(paths))]
+
+    def info(self, source):
+        """Metadati principali senza leggere i pixel"""
+        pydicom = _require_pydicom()
+
+        path, _ = split_frame(source)
+        slices = None
+        if os.path.isdir(path):
+            slices = len(self._sorted_series(path))
+            path = self.select_slice(path, "middle")
+
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+        syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+        return {
+            "path": path,
+            "modality": getattr(ds, "Modality", None),
+            "description": getattr(ds, "SeriesDescription", None) or getattr(ds, "StudyDescription", None),
+            "size": (getattr(ds, "Columns", None), getattr(ds, "Rows", None)),
+            "frames": int(getattr(ds, "NumberOfFrames", 1) or 1),
+            "slices": slices,
+            "bits": getattr(ds, "BitsStored", None),
+            "photometric": getattr(ds, "PhotometricInterpretation", None),
+            "transfer_syntax": syntax.name if syntax is not None else None,
+            "window": (_first(getattr(ds, "WindowCenter", None)), _first(getattr(ds, "WindowWidth", None))),
+            "rescale": (getattr(ds, "RescaleSlope", None), getattr(ds, "RescaleIntercept", None)),
+        }
+
+    def _sorted_series(self, directory):
+        pydicom = _require_pydicom()
+
+        key = (os.path.abspath(directory), os.stat(directory).st_mtime)
+        with self._lock:
+            if key in self._series:
+                return self._series[key]
+
+        tags = ["ImagePositionPatient", "ImageOrientationPatient", "InstanceNumber"]
+        entries = []
+        for entry in _files(directory):
+            if not is_dicom(entry.path):
+                continue
+            ds = pydicom.dcmread(entry.path, stop_before_pixels=True, specific_tags=tags)
+            entries.append((self._slice_position(ds), entry.path))
+
+        paths = [path for _, path in sorted(entries)]
+        with self._lock:
+            self._series[key] = paths
+        return paths
+
+    @staticmethod
+    def _slice_position(ds):
+        """Posizione lungo la normale al piano, altrimenti InstanceNumber"""
+        position = getattr(ds, "ImagePositionPatient", None)
+        orientation = getattr(ds, "ImageOrientationPatient", None)
+        if position is not None and orientation is not None and len(orientation) == 6:
+            row, column = [float(v) for v in orientation[:3]], [float(v) for v in orientation[3:]]
+            normal = (
+                row[1] * column[2] - row[2] * column[1],
+                row[2] * column[0] - row[0] * column[2],
+                row[0] * column[1] - row[1] * column[0],
+            )
+            return (0, sum(float(p) * n for p, n in zip(position, normal)))
+        return (1, int(getattr(ds, "InstanceNumber", 0) or 0))
+
+    def _frame_pixels(self, ds, index, path=None):
+        """Array del frame index, senza leggere gli altri frame"""
+        import numpy as np
+
+        syntax = ds.file_meta.TransferSyntaxUID
+        bits = int(ds.BitsAllocated)
+        element = ds.get_item(PIXEL_DATA)
+        if element is None:
+            raise ValueError("Il file DICOM non contiene pixel")
+
+        if syntax.is_compressed or getattr(syntax, "is_deflated", False) or bits not in (8, 16, 32):
+            return self._decode_frame(ds, index, path)
+
+        rows, columns = int(ds.Rows), int(ds.Columns)
+        samples = int(getattr(ds, "SamplesPerPixel", 1) or 1)
+        dtype = np.dtype(f"{'i' if getattr(ds, 'PixelRepresentation', 0) else 'u'}{bits // 8}")
+        dtype = dtype.newbyteorder("<" if syntax.is_little_endian else ">")
+        count = rows * columns * samples
+        offset = index * count * dtype.itemsize
+
+        if element.value is None:
+            # Valore rinviato da dcmread: posizione nel file, pixel mai letti
+            pixels = np.memmap(path, dtype=dtype, mode="r", offset=element.value_tell + offset, shape=(count,))
+        else:
+            pixels = np.frombuffer(element.value, dtype=dtype, count=count, offset=offset)
+
+        if samples == 1:
+            pixels = pixels.reshape(rows, columns)
+        elif int(getattr(ds, "PlanarConfiguration", 0) or 0) == 1:
+            pixels = pixels.reshape(samples, rows, columns).transpose(1, 2, 0)
+        else:
+            pixels = pixels.reshape(rows, columns, samples)
+
+        stored = int(getattr(ds, "BitsStored", bits) or bits)
+        if stored < bits:
+            # I bit alti possono contenere overlay: si tengono solo quelli memorizzati
+            shift = bits - stored
+            pixels = (pixels << shift) >> shift if dtype.kind == "i" else pixels & ((1 << stored) - 1)
+        return pixels
+
+    @staticmethod
+    def _decode_frame(ds, index, path):
+        """Decodifica tramite pydicom per sintassi compresse"""
+        try:
+            from pydicom.pixels import pixel_array
+        except ImportError:
+            pixel_array = None
+
+        if pixel_array is not None and path is not None:
+            # pydicom >= 3: decodifica solo il frame richiesto
+            return pixel_array(path, index=index)
+
+        pixels = ds.pixel_array
+        frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+        return pixels[index] if frames > 1 else pixels
+
+    @staticmethod
+    def _downsample(pixels, target_size):
+        """Sottocampionamento intero, mai sotto la risoluzione del modello"""
+        if target_size is None:
+            return pixels
+        step = min(pixels.shape[0] // target_size[1], pixels.shape[1] // target_size[0])
+        return pixels[::step, ::step] if step >= 2 else pixels
+
+    def _to_image(self, ds, index, pixels):
+        import numpy as np
+
+        photometric = str(getattr(ds, "PhotometricInterpretation", "MONOCHROME2"))
+
+        if pixels.ndim == 3:
+            if pixels.dtype != np.uint8:
+                pixels = (pixels.astype(np.float32) * (255.0 / max(float(pixels.max()), 1.0))).astype(np.uint8)
+            mode = "YCbCr" if photometric.startswith("YBR") else "RGB"
+            return Image.fromarray(np.ascontiguousarray(pixels), mode).convert("RGB")
+
+        values = pixels.astype(np.float32)
+
+        slope = _first(getattr(ds, "RescaleSlope", None) or _functional_group(
+            ds, index, "PixelValueTransformationSequence", "RescaleSlope"))
+        intercept = _first(getattr(ds, "RescaleIntercept", None) or _functional_group(
+            ds, index, "PixelValueTransformationSequence", "RescaleIntercept"))
+        if slope not in (None, 1.0):
+            values *= slope
+        if intercept:
+            values += intercept
+
+        center, width = self._window_for(ds, index, values)
+
+        # Funzione VOI LUT lineare dello standard DICOM (PS3.3 C.11.2.1.2)
+        values -= center - 0.5
+        values *= 255.0 / max(width - 1, 1)
+        values += 127.5
+        np.clip(values, 0, 255, out=values)
+
+        if photometric == "MONOCHROME1":
+            # Valori alti = scuro: si inverte per avere l'aspetto consueto
+            np.subtract(255, values, out=values)
+
+        return Image.fromarray(values.astype(np.uint8), "L")
+
+    def _window_for(self, ds, index, values):
+        """(centro, ampiezza) da configurazione, header o distribuzione dei valori"""
+        import numpy as np
+
+        window = (self.window or "auto").lower()
+        if window in WINDOW_PRESETS:
+            return WINDOW_PRESETS[window]
+        if "," in window:
+            center, width = (float(part) for part in window.split(","))
+            return center, width
+
+        if window == "auto":
+            center = _first(getattr(ds, "WindowCenter", None) or _functional_group(
+                ds, index, "FrameVOILUTSequence", "WindowCenter"))
+            width = _first(getattr(ds, "WindowWidth", None) or _functional_group(
+                ds, index, "FrameVOILUTSequence", "WindowWidth"))
+            if center is not None and width:
+                return center, width
+
+        # Nessuna finestra nell'header (o WINDOW=minmax): percentili robusti
+        low, high = np.percentile(values[::4, ::4], (0.5, 99.5))
+        return (low + high) / 2, max(high - low, 1.0) + 1
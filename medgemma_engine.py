@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Generazione diretta MedGemma
+Riuso della KV cache: prefisso di sistema calcolato una volta per modello
+"""
+
+import copy
+import hashlib
+import threading
+import time
+
+
+def common_prefix_length(a, b):
+    """Numero di token iniziali uguali tra due sequenze di id"""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def prefill(model, input_ids, attention_mask, past_key_values, start, token_type_ids=None,
+            pixel_values=None, inputs_embeds=None):
+    """Forward dei token input_ids[:, start:-1] su una cache che copre [0, start)
+
+    L'ultimo token resta fuori: generate() lo elabora come primo passo
+    e trova nella cache tutto il resto, immagine compresa (per Gemma 3
+    generate() passa pixel_values solo se la cache è vuota, quindi la
+    parte con l'immagine va elaborata qui).
+    """
+    import torch
+
+    end = input_ids.shape[1] - 1
+    if end <= start:
+        return past_key_values
+
+    kwargs = {
+        "attention_mask": attention_mask[:, :end],
+        "past_key_values": past_key_values,
+        "cache_position": torch.arange(start, end, device=input_ids.device),
+        "use_cache": True,
+    }
+    if inputs_embeds is not None:
+        kwargs["inputs_embeds"] = inputs_embeds[:, start:end]
+    else:
+        kwargs["input_ids"] = input_ids[:, start:end]
+    if token_type_ids is not None:
+        kwargs["token_type_ids"] = token_type_ids[:, start:end]
+    if pixel_values is not None:
+        kwargs["pixel_values"] = pixel_values
+
+    with torch.no_grad():
+        model(**kwargs)
+    return past_key_values
+
+
+class PrefixCache:
+    """KV cache del prefisso costante (prompt di sistema)
+
+    Calcolata una volta per coppia modello/prompt di sistema e copiata
+    per ogni richiesta; si ricalcola da sola se uno dei due cambia.
+    """
+
+    def __init__(self):
+        self._key = None
+        self.ids = None
+        self.cache = None
+        self.build_time = 0.0
+        self.hits = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, model, processor, build_messages):
+        """Prefisso aggiornato per il modello e i messaggi correnti
+
+        build_messages(testo) deve produrre una conversazione con quel
+        testo come domanda: il prefisso costante è la parte comune a due
+        conversazioni con domande diverse.
+        """
+        system_text = str(build_messages("")[0])
+        key = (id(model), getattr(model.config, "_name_or_path", ""),
+               hashlib.sha256(system_text.encode()).hexdigest())
+
+        with self._lock:
+            if key != self._key:
+                self._build(model, processor, build_messages)
+                self._key = key
+            return self
+
+    def _build(self, model, processor, build_messages):
+        import torch
+        from transformers import DynamicCache
+
+        probes = [
+            processor.apply_chat_template(
+                build_messages(text), add_generation_prompt=True, tokenize=True
+            )
+            for text in ("A", "B")
+        ]
+        probes = [p[0] if p and isinstance(p[0], list) else p for p in probes]
+
+        # Un token di margine: la fusione BPE al confine può cambiare l'ultimo
+        length = common_prefix_length(*probes) - 1
+        self.ids = torch.tensor([probes[0][:length]], device=model.device)
+
+        start = time.perf_counter()
+        self.cache = DynamicCache()
+        with torch.no_grad():
+            model(input_ids=self.ids, past_key_values=self.cache, use_cache=True)
+        self.build_time = time.perf_counter() - start
+
+        self.hits = 0
+        self.saved_seconds = 0.0
+        print(f"Prefisso di sistema in cache: {length} token, prefill {self.build_time:.2f}s")
+
+    def matches(self, input_ids):
+        """True se la richiesta inizia con il prefisso in cache"""
+        length = self.ids.shape[1]
+        return input_ids.shape[1] > length + 1 and bool((input_ids[0, :length] == self.ids[0]).all())
+
+    def copy_cache(self):
+        """Copia privata della cache per una richiesta"""
+        cache = copy.deepcopy(self.cache)
+        self.hits += 1
+        self.saved_seconds += self.build_time
+        return cache
+
+    def stats(self):
+        return {
+            "tokens": self.ids.shape[1] if self.ids is not None else 0,
+            "build_time": self.build_time,
+            "hits": self.hits,
+            "saved_seconds": self.saved_seconds,
+        }
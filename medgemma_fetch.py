@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Download immagini MedGemma
+Sessione HTTP condivisa, limiti di tempo e dimensione, download paralleli
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    """Download rifiutato (dimensione, stato HTTP, ...)"""
+
+
+class ImageFetcher:
+    """Scarica immagini riusando le connessioni (keep-alive)
+
+    La sessione può essere passata dall'esterno, ad esempio per puntare
+    a un server HTTP locale di prova. La cache su disco resta entro
+    cache_bytes eliminando i download usati meno di recente.
+    """
+
+    def __init__(self, connect_timeout=5.0, read_timeout=30.0, max_bytes=50 * 1024**2,
+                 concurrency=8, cache_dir=None, user_agent="MedGemma-Test/1.0", session=None,
+                 cache_bytes=1024 * 1024**2):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+        self.concurrency = max(1, concurrency)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.cache_bytes = cache_bytes
+        self._cache_used = None
+        self._cache_lock = threading.Lock()
+
+        self.session = session or self._create_session(user_agent)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="medgemma-fetch")
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _create_session(self, user_agent):
+        """Sessione con pool di connessioni dimensionato sulla concorrenza"""
+        session = requests.Session()
+        retry = Retry(
+            total=2,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=("GET",)
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.concurrency,
+            pool_maxsize=self.concurrency,
+            max_retries=retry
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = user_agent
+        return session
+
+    def fetch(self, url):
+        """Scarica il contenuto di un URL come bytes"""
+        cached = self._cache_lookup(url)
+        headers = {}
+        if cached is not None:
+            meta = cached[1]
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304 and cached is not None:
+                data = cached[0].read_bytes()
+                # Aggiorna mtime: l'eviction rimuove i download meno usati
+                os.utime(cached[0])
+                return data
+            response.raise_for_status()
+
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                raise FetchError(f"Immagine troppo grande: {int(length)} byte (max {self.max_bytes})")
+
+            # Il limite è applicato anche durante lo streaming: Content-Length può mancare
+            data = bytearray()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                data.extend(chunk)
+                if len(data) > self.max_bytes:
+                    raise FetchError(f"Immagine troppo grande: oltre {self.max_bytes} byte")
+
+            self._cache_store(url, response.headers, data)
+
+        return bytes(data)
+
+    def fetch_image(self, url):
+        """Scarica e apre un'immagine PIL"""
+        return Image.open(io.BytesIO(self.fetch(url)))
+
+    def fetch_many(self, urls):
+        """Scarica più URL in parallelo con concorrenza limitata
+
+        Generatore di tuple (url, bytes, errore) nello stesso ordine
+        dell'input; al massimo 2 x concurrency download in volo.
+        """
+        pending = deque()
+        urls = iter(urls)
+        limit = self.concurrency * 2
+
+        for url in urls:
+            pending.append((url, self._executor.submit(self.fetch, url)))
+            if len(pending) >= limit:
+                break
+
+        while pending:
+            url, future = pending.popleft()
+
+            next_url = next(urls, None)
+            if next_url is not None:
+                pending.append((next_url, self._executor.submit(self.fetch, next_url)))
+
+            try:
+                yield url, future.result(), None
+            except Exception as e:
+                yield url, None, e
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def _cache_paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self.cache_dir / f"{key}.bin", self.cache_dir / f"{key}.json"
+
+    def _cache_lookup(self, url):
+        """Ritorna (path contenuto, metadati) se l'URL è in cache"""
+        if self.cache_dir is None:
+            return None
+
+        body_path, meta_path = self._cache_paths(url)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        try:
+            size = body_path.stat().st_size
+        except OSError:
+            return None
+        if meta.get("url") != url or meta.get("size") != size:
+            return None
+        return body_path, meta
+
+    def _cache_store(self, url, headers, data):
+        """Salva solo risposte con validatori (ETag / Last-Modified)"""
+        if self.cache_dir is None:
+            return
+
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+
+        if len(data) > self.cache_bytes:
+            return
+
+        body_path, meta_path = self._cache_paths(url)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "size": len(data)}
+        try:
+            # Contenuto prima dei metadati: una lookup vede solo coppie complete
+            self._write_atomic(body_path, bytes(data))
+            self._write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        except OSError as e:
+            print(f"Errore scrittura cache download: {e}")
+            return
+
+        with self._cache_lock:
+            if self._cache_used is None:
+                self._cache_used = self._scan_cache_usage()
+            else:
+                self._cache_used += len(data)
+            if self._cache_used > self.cache_bytes:
+                self._cache_used = self._evict_cache()
+
+    def _write_atomic(self, path, data):
+        # File temporaneo univoco: più thread possono scaricare lo stesso URL
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _scan_cache_usage(self):
+        return sum(p.stat().st_size for p in self.cache_dir.glob("*.bin"))
+
+    def _evict_cache(self):
+        """Rimuove i download meno usati fino al 90% del limite, ritorna l'occupazione"""
+        entries = []
+        for body_path in self.cache_dir.glob("*.bin"):
+            try:
+                st = body_path.stat()
+                entries.append((st.st_mtime, st.st_size, body_path))
+            except OSError:
+                continue
+
+        entries.sort()
+        used = sum(size for _, size, _ in entries)
+        target = self.cache_bytes * 0.9
+
+        for _, size, body_path in entries:
+            if used <= target:
+                break
+            try:
+                body_path.unlink()
+                used -= size
+                body_path.with_suffix(".json").unlink(missing_ok=True)
+            except OSError:
+                continue
+        return used
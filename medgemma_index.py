@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Indice casi simili MedGemma
+Embedding del vision encoder in una matrice float16 su disco (memory-map), ricerca top-k e cluster opzionali
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from medgemma_batch import iter_records
+from medgemma_cache import image_digest
+from medgemma_vision import encode_image
+
+EMBEDDINGS_FILE = "embeddings.f16"
+RECORDS_FILE = "records.jsonl"
+OFFSETS_FILE = "records.offsets"
+CENTROIDS_FILE = "centroids.f32"
+ASSIGNMENTS_FILE = "clusters.i32"
+META_FILE = "index.json"
+
+# Righe per blocco di ricerca: in float32 ~80 MB con la dimensione di MedGemma 4B
+SEARCH_CHUNK = 8192
+
+# Vettori campionati per addestrare i cluster
+KMEANS_SAMPLE = 32768
+KMEANS_ITERATIONS = 20
+
+
+def parse_index_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="test_medgemma.py index",
+        description="Aggiunge all'indice dei casi simili le immagini di un manifest JSONL, cartella o glob"
+    )
+    parser.add_argument("input", help="manifest .jsonl {image}, cartella o glob (es. 'archivio/**/*.dcm')")
+    parser.add_argument("--index", help="cartella dell'indice (default INDEX_DIR)")
+    parser.add_argument("-b", "--batch-size", type=int, help="immagini per batch del vision encoder (default BATCH_SIZE)")
+    parser.add_argument("--clusters", help="numero di cluster o 'auto' (4*sqrt(N)): ricostruisce l'indice a cluster")
+    return parser.parse_args(argv)
+
+
+def parse_similar_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="test_medgemma.py similar",
+        description="Studi dell'indice più simili a un'immagine"
+    )
+    parser.add_argument("image", help="path o URL dell'immagine di riferimento")
+    parser.add_argument("-k", type=int, default=10, help="risultati (default 10)")
+    parser.add_argument("--index", help="cartella dell'indice (default INDEX_DIR)")
+    parser.add_argument("--nprobe", type=int, help="cluster visitati (default INDEX_NPROBE)")
+    parser.add_argument("--exact", action="store_true", help="scansione completa anche con i cluster")
+    return parser.parse_args(argv)
+
+
+def embed_images(model, processor, images):
+    """Embedding (N, D) float32 normalizzati: media dei token visivi proiettati"""
+    import torch
+
+    pixel_values = processor.image_processor(images=images, return_tensors="pt")["pixel_values"]
+    features = encode_image(model, pixel_values.to(model.device, dtype=model.dtype))
+    pooled = torch.nn.functional.normalize(features.float().mean(dim=1), dim=-1)
+    return pooled.cpu().numpy()
+
+
+def _normalize(vectors):
+    import numpy as np
+
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors, clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    """K-means sferico (similarità coseno) su vettori normalizzati float32"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=clusters)
+        empty = counts == 0
+        # Cluster vuoti ripartono da vettori a caso
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class EmbeddingIndex:
+    """Matrice di embedding float16 su disco con i record delle immagini
+
+    embeddings.f16 contiene le righe una dopo l'altra e viene letto in
+    memory-map: la ricerca scorre blocchi di SEARCH_CHUNK righe senza
+    caricare l'indice in RAM. index.json, scritto per ultimo in modo
+    atomico, dice quante righe sono valide: dopo un'interruzione le
+    righe in più vengono scartate all'append successivo.
+
+    Con i cluster (k-means sui vettori) ogni riga ha un cluster e la
+    ricerca approssimata visita solo gli nprobe più vicini alla query.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.meta = {"count": 0, "dim": None, "model": None, "records_bytes": 0, "clusters": 0}
+        meta_path = self.path / META_FILE
+        if meta_path.exists():
+            self.meta.update(json.loads(meta_path.read_text(encoding="utf-8")))
+        self._matrix = None
+        self._assignments = None
+        self._centroids = None
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    @property
+    def dim(self):
+        return self.meta["dim"]
+
+    def matrix(self):
+        """Embedding (count, dim) float16 in memory-map"""
+        import numpy as np
+
+        if self._matrix is None and self.count:
+            self._matrix = np.memmap(
+                self.path / EMBEDDINGS_FILE, dtype=np.float16, mode="r", shape=(self.count, self.dim)
+            )
+        return self._matrix
+
+    def paths(self):
+        """Sorgenti già indicizzate, per saltarle negli append successivi"""
+        if not self.count:
+            return set()
+        paths = set()
+        with open(self.path / RECORDS_FILE, "rb") as f:
+            for _, line in zip(range(self.count), f):
+                paths.add(json.loads(line)["path"])
+        return paths
+
+    def records(self, rows):
+        """Record dei numeri di riga indicati, letti per offset"""
+        import numpy as np
+
+        offsets = np.memmap(self.path / OFFSETS_FILE, dtype=np.int64, mode="r", shape=(self.count,))
+        result = []
+        with open(self.path / RECORDS_FILE, "rb") as f:
+            for row in rows:
+                f.seek(int(offsets[row]))
+                result.append(json.loads(f.readline()))
+        return result
+
+    def append(self, vectors, records, model=None):
+        """Aggiunge righe (vettori normalizzati) e i relativi record"""
+        import numpy as np
+
+        vectors = np.asarray(vectors, dtype=np.float16)
+        if self.dim is None:
+            self.meta["dim"] = int(vectors.shape[1])
+            self.meta["model"] = model
+            self.meta["created"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding di dimensione {vectors.shape[1]}, l'indice usa {self.dim}")
+        if model and self.meta["model"] and model != self.meta["model"]:
+            raise ValueError(f"Indice creato con {self.meta['model']}, il modello attuale è {model}")
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        count = self.count
+        records_bytes = self.meta["records_bytes"]
+
+        with open(self.path / EMBEDDINGS_FILE, "ab") as f:
+            f.truncate(count * self.dim * 2)
+            f.write(vectors.tobytes())
+
+        offsets = []
+        with open(self.path / RECORDS_FILE, "ab") as f:
+            f.truncate(records_bytes)
+            for record in records:
+                offsets.append(records_bytes)
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                records_bytes += len(line)
+
+        with open(self.path / OFFSETS_FILE, "ab") as f:
+            f.truncate(count * 8)
+            f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+
+        if self.meta["clusters"]:
+            labels = np.argmax(vectors.astype(np.float32) @ self.centroids().T, axis=1).astype(np.int32)
+            with open(self.path / ASSIGNMENTS_FILE, "ab") as f:
+                f.truncate(count * 4)
+                f.write(labels.tobytes())
+
+        self.meta["count"] = count + len(vectors)
+        self.meta["records_bytes"] = records_bytes
+        self._save_meta()
+        self._matrix = None
+        self._assignments = None
+
+    def build_clusters(self, clusters=None):
+        """Addestra i cluster su un campione e assegna tutte le righe"""
+        import numpy as np
+
+        if not self.count:
+            raise ValueError("Indice vuoto")
+        if clusters in (None, "auto"):
+            clusters = int(4 * math.sqrt(self.count))
+        clusters = max(1, min(int(clusters), self.count))
+
+        matrix = self.matrix()
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(self.count, min(self.count, KMEANS_SAMPLE), replace=False))
+        centroids = kmeans(matrix[sample].astype(np.float32), clusters)
+
+        labels = np.empty(self.count, dtype=np.int32)
+        for start in range(0, self.count, SEARCH_CHUNK):
+            block = matrix[start:start + SEARCH_CHUNK].astype(np.float32)
+            labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        (self.path / CENTROIDS_FILE).write_bytes(centroids.tobytes())
+        (self.path / ASSIGNMENTS_FILE).write_bytes(labels.tobytes())
+        self.meta["clusters"] = clusters
+        self._save_meta()
+        self._centroids = centroids
+        self._assignments = None
+        return clusters
+
+    def centroids(self):
+        import numpy as np
+
+        if self._centroids is None:
+            data = np.fromfile(self.path / CENTROIDS_FILE, dtype=np.float32)
+            self._centroids = data.reshape(self.meta["clusters"], self.dim)
+        return self._centroids
+
+    def assignments(self):
+        import numpy as np
+
+        if self._assignments is None:
+            self._assignments = np.fromfile(self.path / ASSIGNMENTS_FILE, dtype=np.int32, count=self.count)
+        return self._assignments
+
+    def search(self, query, k=10, nprobe=None):
+        """Top-k per similarità coseno: lista di (riga, punteggio) decrescente
+
+        Con nprobe e i cluster costruiti si valutano solo le righe dei
+        nprobe cluster più vicini, altrimenti la scansione è completa.
+        """
+        import numpy as np
+
+        if not self.count:
+            return []
+        query = _normalize(np.asarray(query, dtype=np.float32).ravel())
+        matrix = self.matrix()
+
+        rows = None
+        if nprobe and self.meta["clusters"]:
+            probes = np.argsort(self.centroids() @ query)[::-1][:nprobe]
+            rows = np.flatnonzero(np.isin(self.assignments(), probes))
+        total = self.count if rows is None else len(rows)
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, total, SEARCH_CHUNK):
+            if rows is None:
+                block_rows = np.arange(start, min(start + SEARCH_CHUNK, total))
+                block = matrix[start:start + SEARCH_CHUNK]
+            else:
+                block_rows = rows[start:start + SEARCH_CHUNK]
+                block = matrix[block_rows]
+            scores = block.astype(np.float32) @ query
+
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                block_rows, scores = block_rows[top], scores[top]
+            best_rows = np.concatenate([best_rows, block_rows])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_scores) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+
+        order = np.argsort(-best_scores)
+        return [(int(best_rows[i]), float(best_scores[i])) for i in order]
+
+    def stats(self):
+        size = self.count * (self.dim or 0) * 2
+        return {
+            "path": str(self.path),
+            "images": self.count,
+            "dim": self.dim,
+            "model": self.meta["model"],
+            "size_mb": round(size / 1024**2, 1),
+            "clusters": self.meta["clusters"],
+            "updated": self.meta.get("updated"),
+        }
+
+    def _save_meta(self):
+        self.meta["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        tmp = self.path / f"{META_FILE}.tmp"
+        tmp.write_text(json.dumps(self.meta, indent=2), encoding="utf-8")
+        os.replace(tmp, self.path / META_FILE)
+
+
+class IndexJob:
+    """Indicizza una sorgente in batch, saltando le immagini già presenti"""
+
+    def __init__(self, medgemma, source, index, batch_size=None):
+        self.medgemma = medgemma
+        self.source = source
+        self.index = index
+        self.batch_size = batch_size or medgemma.batch_size
+        self.added = 0
+        self.errors = 0
+
+    def run(self):
+        done = self.index.paths()
+        paths = []
+        for record in iter_records(self.source):
+            if "invalid" in record:
+                self.errors += 1
+                print(f"Record {record['id']} non valido: {record['invalid']}")
+            elif record["image"] not in done:
+                paths.append(record["image"])
+        print(f"Immagini nell'indice: {self.index.count} | da aggiungere: {len(paths)}")
+
+        self.start = time.perf_counter()
+        chunk = []
+        for path, image, error in self._prefetch(paths):
+            if error is not None:
+                self.errors += 1
+                print(f"Errore caricamento {path}: {error}")
+                continue
+            chunk.append((path, image))
+            if len(chunk) >= self.batch_size:
+                self._process(chunk, len(paths))
+                chunk = []
+        if chunk:
+            self._process(chunk, len(paths))
+
+        elapsed = time.perf_counter() - self.start
+        print(f"\nIndicizzate {self.added} immagini ({self.errors} errori) in {elapsed:.0f}s")
+        return self.errors == 0
+
+    def _prefetch(self, paths):
+        """Decodifica le immagini successive mentre il vision encoder lavora"""
+        depth = max(self.batch_size * 2, self.medgemma.prefetch)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.medgemma.preprocess_workers) as executor:
+            for path in paths:
+                pending.append((path, executor.submit(self.medgemma.load_image, path)))
+                if len(pending) >= depth:
+                    yield self._resolve(*pending.popleft())
+            while pending:
+                yield self._resolve(*pending.popleft())
+
+    @staticmethod
+    def _resolve(path, future):
+        try:
+            return path, future.result(), None
+        except Exception as e:
+            return path, None, e
+
+    def _process(self, chunk, total):
+        vectors = self.medgemma.image_embeddings([image for _, image in chunk])
+        records = [{"path": path, "digest": image_digest(image)} for path, image in chunk]
+        self.index.append(vectors, records, model=self.medgemma.model_name)
+        self.added += len(chunk)
+
+        elapsed = time.perf_counter() - self.start
+        rate = self.added / elapsed if elapsed > 0 else 0.0
+        print(f"[{self.added}/{total}] {rate:.2f} img/s")
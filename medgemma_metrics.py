@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Metriche MedGemma
+Tempi per fase di ogni richiesta, log JSON, formato Prometheus e tracce delle richieste lente
+"""
+
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Limiti superiori (secondi) degli istogrammi Prometheus
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Ogni quanto riscrivere al massimo il file Prometheus
+PROMETHEUS_INTERVAL = 5.0
+
+
+class Trace:
+    """Una richiesta: fasi con inizio e durata, conteggi e attributi"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind):
+        self.id = f"{os.getpid()}-{next(self._ids)}"
+        self.kind = kind
+        self.status = "ok"
+        self.error = None
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.total = None
+        self.stages = {}
+        self.timeline = []
+        self.counts = {}
+        self.attrs = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Misura il blocco come fase name (più blocchi con lo stesso nome si sommano)"""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - start, start=start)
+
+    def add(self, name, seconds, start=None):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            offset = (start if start is not None else time.perf_counter() - seconds) - self.start
+            self.timeline.append({"stage": name, "offset": offset, "seconds": seconds})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def fail(self, error):
+        self.status = "error"
+        self.error = str(error)
+
+    def finish(self):
+        if self.total is None:
+            self.total = time.perf_counter() - self.start
+        return self
+
+    def to_dict(self, timeline=False):
+        data = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "total": self.total,
+            "stages": dict(self.stages),
+            "counts": dict(self.counts),
+        }
+        if self.attrs:
+            data["attrs"] = dict(self.attrs)
+        if self.error is not None:
+            data["error"] = self.error
+        if timeline:
+            data["timeline"] = list(self.timeline)
+        return data
+
+
+class StepClock:
+    """Logits processor che non modifica nulla: segna l'istante di ogni passo
+
+    Il primo passo di generate() arriva a prefill concluso, quindi separa
+    il prefill dalla decodifica token per token.
+    """
+
+    def __init__(self):
+        self.first = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.steps += 1
+        return scores
+
+
+class Metrics:
+    """Registro delle richieste completate
+
+    Le fasi si registrano sulla richiesta attiva nel thread corrente
+    (vedi trace/activate); senza richiesta attiva stage e count non fanno
+    nulla. Con enabled=False le richieste sono misurate ma non registrate.
+    """
+
+    def __init__(self, enabled=True, log_path=None, prometheus_path=None, slow_ms=0, slow_path=None):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.slow_seconds = slow_ms / 1000 if slow_ms else None
+        self.slow_path = slow_path
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._tokens = {}
+        self._histograms = {}
+        self._last_export = 0.0
+
+    # Richiesta attiva
+
+    def current(self):
+        return getattr(self._local, "trace", None)
+
+    @contextlib.contextmanager
+    def activate(self, trace):
+        """Rende trace la richiesta attiva nel thread corrente"""
+        previous = self.current()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    def begin(self, kind):
+        """Nuova richiesta non attiva: va passata a activate e poi a record"""
+        return Trace(kind)
+
+    @contextlib.contextmanager
+    def trace(self, kind):
+        """Richiesta misurata; se ce n'è già una attiva il blocco vi si unisce"""
+        current = self.current()
+        if current is not None:
+            yield current
+            return
+
+        trace = self.begin(kind)
+        with self.activate(trace):
+            try:
+                yield trace
+            except BaseException as e:
+                trace.fail(e)
+                raise
+            finally:
+                self.record(trace)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        trace = self.current()
+        if trace is None:
+            yield None
+            return
+        with trace.stage(name):
+            yield trace
+
+    def count(self, name, value=1):
+        trace = self.current()
+        if trace is not None:
+            trace.count(name, value)
+
+    def fail(self, error):
+        trace = self.current()
+        if trace is not None:
+            trace.fail(error)
+
+    # Registrazione ed esportazione
+
+    def record(self, trace):
+        """Aggiorna contatori e istogrammi, scrive il log e l'eventuale traccia lenta"""
+        if not self.enabled:
+            return
+        trace.finish()
+
+        with self._lock:
+            key = (trace.kind, trace.status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for name in ("input_tokens", "output_tokens"):
+                self._tokens[name] = self._tokens.get(name, 0) + trace.counts.get(name, 0)
+            self._observe("request", trace.total)
+            for name, seconds in trace.stages.items():
+                self._observe(name, seconds)
+
+        if self.log_path:
+            self._append(self.log_path, trace.to_dict())
+
+        if self.slow_seconds is not None and trace.total >= self.slow_seconds:
+            print(f"Richiesta lenta {trace.id}: {trace.total:.2f}s "
+                  + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in trace.stages.items()))
+            if self.slow_path:
+                self._append(self.slow_path, trace.to_dict(timeline=True))
+
+        if self.prometheus_path and time.monotonic() - self._last_export >= PROMETHEUS_INTERVAL:
+            self.write_prometheus()
+
+    def _observe(self, name, seconds):
+        histogram = self._histograms.setdefault(name, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0})
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+    @staticmethod
+    def _append(path, data):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Una sola write in append: righe intere anche con più processi
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+    def render_prometheus(self, gauges=None):
+        """Testo nel formato di esposizione Prometheus"""
+        lines = [
+            "# HELP medgemma_requests_total Richieste completate per tipo ed esito",
+            "# TYPE medgemma_requests_total counter",
+        ]
+        with self._lock:
+            for (kind, status), value in sorted(self._requests.items()):
+                lines.append(f'medgemma_requests_total{{kind="{kind}",status="{status}"}} {value}')
+
+            lines += [
+                "# HELP medgemma_tokens_total Token di prompt (input) e generati (output)",
+                "# TYPE medgemma_tokens_total counter",
+            ]
+            for name, value in sorted(self._tokens.items()):
+                lines.append(f'medgemma_tokens_total{{direction="{name.split("_")[0]}"}} {value}')
+
+            lines += [
+                "# HELP medgemma_stage_seconds Durata delle fasi di una richiesta (stage=request: totale)",
+                "# TYPE medgemma_stage_seconds histogram",
+            ]
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, value in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(f'medgemma_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {value}')
+                lines.append(f'medgemma_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'medgemma_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]:.6f}')
+                lines.append(f'medgemma_stage_seconds_count{{stage="{name}"}} {histogram["count"]}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE medgemma_{name} gauge")
+            lines.append(f"medgemma_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        """Scrive il file per il textfile collector (sostituzione atomica)"""
+        path = path or self.prometheus_path
+        if not path:
+            return
+        self._last_export = time.monotonic()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp, path)
+
+    def summary(self):
+        """Media per fase, per il comando interattivo"""
+        with self._lock:
+            return {
+                name: {"count": h["count"], "mean": h["sum"] / h["count"] if h["count"] else 0.0}
+                for name, h in self._histograms.items()
+            }
+
+    def instrument_vision(self, model):
+        """Misura il vision encoder come fase 'vision' della richiesta attiva
+
+        Il tempo della fase vision è compreso anche in prefill.
+        """
+        tower = next((module for name, module in model.named_modules() if name.endswith("vision_tower")), None)
+        if tower is None:
+            return False
+
+        def synchronize(tensor):
+            if getattr(tensor, "is_cuda", False):
+                import torch
+                torch.cuda.synchronize(tensor.device)
+
+        def before(module, args, kwargs):
+            if self.current() is not None:
+                value = kwargs.get("pixel_values", args[0] if args else None)
+                synchronize(value)
+                self._local.vision_start = time.perf_counter()
+
+        def after(module, args, kwargs, output):
+            start = getattr(self._local, "vision_start", None)
+            trace = self.current()
+            if start is None or trace is None:
+                return
+            synchronize(getattr(output, "last_hidden_state", None))
+            trace.add("vision", time.perf_counter() - start, start=start)
+            self._local.vision_start = None
+
+        tower.register_forward_pre_hook(before, with_kwargs=True)
+        tower.register_forward_hook(after, with_kwargs=True)
+        return True
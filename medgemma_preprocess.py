@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Preprocessing immagini MedGemma
+Decodifica a risoluzione ridotta e prefetch in parallelo
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from medgemma_dicom import is_dicom_source
+
+# Risoluzione di input di Gemma 3 (SigLIP 896x896)
+DEFAULT_TARGET_SIZE = (896, 896)
+
+
+def processor_target_size(processor):
+    """Risoluzione a cui il processor del modello porta le immagini"""
+    image_processor = getattr(processor, "image_processor", None)
+    size = getattr(image_processor, "size", None) or {}
+
+    if "height" in size and "width" in size:
+        return (size["width"], size["height"])
+    if "shortest_edge" in size:
+        return (size["shortest_edge"], size["shortest_edge"])
+    return DEFAULT_TARGET_SIZE
+
+
+class ImagePreprocessor:
+    """Porta le immagini alla risoluzione del modello una sola volta
+
+    max_pixels è il limite di pixel da decodificare che la memoria
+    consente (piano risorse): controllato dopo la riduzione JPEG, prima
+    della decodifica completa.
+    """
+
+    def __init__(self, target_size=DEFAULT_TARGET_SIZE, workers=4, prefetch=4, dicom=None, max_pixels=None):
+        self.target_size = tuple(target_size)
+        self.max_pixels = max_pixels
+        self.prefetch_depth = max(1, prefetch)
+        self.dicom = dicom
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="medgemma-decode")
+
+    def prepare(self, image):
+        """Decodifica ridotta, conversione RGB e resize al target"""
+        # Per i JPEG il decoder scala già in DCT (1/2, 1/4, 1/8) restando >= target
+        if image.format == "JPEG":
+            image.draft("RGB", self.target_size)
+
+        width, height = image.size
+        if self.max_pixels and width * height > self.max_pixels:
+            raise ValueError(
+                f"Immagine di {width}x{height} pixel oltre il limite di memoria "
+                f"({self.max_pixels / 1e6:.0f} Mpx): riducila o usa il comando tiles"
+            )
+
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        if image.size != self.target_size:
+            # Stesso resample bilineare del processor Gemma 3
+            image = image.resize(self.target_size, Image.BILINEAR)
+
+        image.load()
+        return image
+
+    def load(self, path):
+        """Apre e prepara un'immagine da file (DICOM compresi, vedi DicomLoader)"""
+        if self.dicom is not None and is_dicom_source(path):
+            return self.prepare(self.dicom.load(path, target_size=self.target_size))
+
+        with Image.open(path) as image:
+            return self.prepare(image)
+
+    def submit(self, path):
+        """Avvia il caricamento in background, ritorna un Future"""
+        return self._executor.submit(self.load, path)
+
+    def prefetch(self, paths):
+        """Carica le immagini in ordine tenendo in volo le successive N
+
+        Generatore di tuple (path, immagine, errore): mentre il chiamante
+        elabora un'immagine le prossime vengono già decodificate.
+        """
+        pending = deque()
+        paths = iter(paths)
+
+        for path in paths:
+            pending.append((path, self.submit(path)))
+            if len(pending) >= self.prefetch_depth:
+                break
+
+        while pending:
+            path, future = pending.popleft()
+
+            # Mantiene piena la coda di prefetch
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, self.submit(next_path)))
+
+            try:
+                yield path, future.result(), None
+            except Exception as e:
+                yield path, None, e
+
+    def close(self):
+        self._executor.shutdown(wait=False)
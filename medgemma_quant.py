@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Quantizzazione CPU MedGemma
+Modalità int8 dinamiche e report accuratezza/velocità rispetto al float
+"""
+
+import difflib
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Valori di TORCH_DTYPE che attivano la quantizzazione dinamica su CPU
+QUANTIZED_DTYPES = {
+    "int8": "tutti i Linear in int8",
+    "int8-text": "solo i Linear del modello di linguaggio in int8 (vision tower in float32)",
+}
+
+REPORT_QUESTION = "Describe this medical image in detail"
+
+
+def is_quantized(dtype_name):
+    return dtype_name in QUANTIZED_DTYPES
+
+
+def quantize_model(model, dtype_name):
+    """Quantizzazione dinamica int8 dei layer Linear, in place
+
+    I pesi sono convertiti una volta in int8, le attivazioni vengono
+    quantizzate al volo a ogni forward: nessuna calibrazione richiesta.
+    """
+    import torch
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+    skip_vision = dtype_name == "int8-text"
+    spec = {
+        name: default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not (skip_vision and "vision_tower" in name)
+    }
+
+    quantize_dynamic(model, qconfig_spec=spec, dtype=torch.qint8, inplace=True)
+    return len(spec)
+
+
+_MODE_MARKER = "QUANT_REPORT "
+_MODE_CODE = """
+import json, sys
+from medgemma_quant import measure_mode
+print({marker!r} + json.dumps(measure_mode(json.loads(sys.argv[1]), sys.argv[2])))
+"""
+
+
+def _rss_mb():
+    """Memoria residente attuale del processo in MB"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024**2
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def measure_mode(image_paths, question):
+    """Eseguita in un processo nuovo: carica il modello con il TORCH_DTYPE
+    dell'ambiente e risponde alle immagini
+
+    load_peak_mb è il picco del caricamento (per int8 i pesi float32
+    prima della quantizzazione), rss_mb la memoria a regime dopo le
+    risposte.
+    """
+    from medgemma_bench import peak_rss_mb
+    from test_medgemma import MedGemmaTest
+
+    start = time.perf_counter()
+    medgemma = MedGemmaTest()
+    medgemma.pipe
+    load_time = time.perf_counter() - start
+    load_peak = peak_rss_mb()
+
+    answers, latencies = [], []
+    for path in image_paths:
+        image = medgemma._open_image_file(path)
+        start = time.perf_counter()
+        answers.append(medgemma.analyze_image(image, question))
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "load_time": load_time,
+        "load_peak_mb": load_peak,
+        "rss_mb": _rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+        "mean_latency": sum(latencies) / len(latencies),
+        "latencies": latencies,
+        "answers": answers,
+    }
+
+
+def _run_mode(dtype_name, image_paths, question, env):
+    workdir = Path(__file__).resolve().parent
+    completed = subprocess.run(
+        [sys.executable, "-c", _MODE_CODE.format(marker=_MODE_MARKER),
+         json.dumps([str(p) for p in image_paths]), question],
+        cwd=workdir, env={**os.environ, **env, "TORCH_DTYPE": dtype_name}, capture_output=True, text=True
+    )
+    lines = [line for line in completed.stdout.splitlines() if line.startswith(_MODE_MARKER)]
+    if completed.returncode != 0 or not lines:
+        raise RuntimeError(f"Modalità {dtype_name} fallita:\n{completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+    return json.loads(lines[-1][len(_MODE_MARKER):])
+
+
+def run_quant_report(image_paths, baseline="float32", modes=("int8",), question=REPORT_QUESTION,
+                     output="results/quant_report.json", env=None):
+    """Confronta le risposte quantizzate con il baseline float
+
+    Ogni modalità gira in un processo nuovo con TORCH_DTYPE impostato
+    (più le variabili di env): memoria e tempi non risentono dei
+    modelli caricati prima.
+    """
+    report = {"question": question, "baseline": baseline, "images": [str(p) for p in image_paths], "modes": {}}
+    baseline_answers = None
+
+    for dtype_name in (baseline,) + tuple(modes):
+        print(f"\nREPORT: modalità {dtype_name} (processo dedicato)...")
+        entry = _run_mode(dtype_name, image_paths, question, env or {})
+        print(f"  caricamento {entry['load_time']:.1f}s | latenza media {entry['mean_latency']:.2f}s")
+
+        if baseline_answers is None:
+            baseline_answers = entry["answers"]
+            baseline_latency = entry["mean_latency"]
+        else:
+            answers = entry["answers"]
+            similarities = [
+                difflib.SequenceMatcher(None, reference, answer).ratio()
+                for reference, answer in zip(baseline_answers, answers)
+            ]
+            entry["speedup"] = baseline_latency / entry["mean_latency"]
+            entry["exact_match"] = sum(a == b for a, b in zip(baseline_answers, answers)) / len(answers)
+            entry["similarity"] = sum(similarities) / len(similarities)
+            entry["similarities"] = similarities
+
+        report["modes"][dtype_name] = entry
+
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    Path(output).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    print("\nREPORT QUANTIZZAZIONE")
+    print("=" * 50)
+    print(f"{'modalità':<12} {'latenza':>9} {'speedup':>8} {'identiche':>10} {'similarità':>11} "
+          f"{'picco car.':>11} {'RSS MB':>8}")
+    for dtype_name, entry in report["modes"].items():
+        rss = f"{entry['rss_mb']:.0f}" if entry["rss_mb"] is not None else "-"
+        load_peak = f"{entry['load_peak_mb']:.0f}" if entry["load_peak_mb"] is not None else "-"
+        if dtype_name == baseline:
+            print(f"{dtype_name:<12} {entry['mean_latency']:8.2f}s {'1.00x':>8} {'-':>10} {'-':>11} "
+                  f"{load_peak:>11} {rss:>8}")
+        else:
+            print(f"{dtype_name:<12} {entry['mean_latency']:8.2f}s {entry['speedup']:7.2f}x "
+                  f"{entry['exact_match']:9.0%} {entry['similarity']:10.1%} {load_peak:>11} {rss:>8}")
+    print(f"\nReport salvato in {output}")
+
+    return report
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Pianificazione risorse MedGemma
+Dtype, device, batch e risoluzione scelti dalla memoria misurata, recupero dagli out of memory
+"""
+
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Parametri di MedGemma 4B (linguaggio + SigLIP) se non leggibili dai file
+DEFAULT_PARAMETERS = 4.3e9
+
+# Byte per parametro dei pesi; int8-text lascia la vision tower in float32
+BYTES_PER_PARAMETER = {"float32": 4.0, "bfloat16": 2.0, "float16": 2.0, "int8": 1.1, "int8-text": 1.3}
+
+# I dtype int8 si caricano in float32 e vengono quantizzati dopo: il picco
+# di caricamento è quello float32, non quello dei pesi finali
+LOAD_DTYPES = {"int8": "float32", "int8-text": "float32"}
+
+# Dtype CPU scelti da "auto": bfloat16, il default storico. float32 (doppia
+# RAM, risposte diverse) e int8 (picco di caricamento float32) restano
+# scelte esplicite di TORCH_DTYPE
+CPU_DTYPES = ("bfloat16",)
+
+# Memoria per richiesta in un batch a 16 bit: KV cache, attivazioni vision, buffer
+REQUEST_GB = 0.6
+
+# Quota della memoria libera che il piano si concede
+HEADROOM = 0.85
+
+# Sotto questo limite di token di risposta non si riprova dopo un OOM
+MIN_NEW_TOKENS = 64
+
+# Byte per pixel durante decodifica e conversioni (RGB + copie intermedie)
+BYTES_PER_PIXEL = 12
+MIN_IMAGE_PIXELS = 16_000_000
+MAX_IMAGE_PIXELS = 178_956_970  # Limite bomba di decompressione di PIL (x2)
+
+_OOM_MESSAGES = ("out of memory", "can't allocate memory", "cannot allocate memory", "not enough memory")
+
+
+def system_memory():
+    """(totale, disponibile) in GB, None se non misurabile"""
+    try:
+        import psutil
+        memory = psutil.virtual_memory()
+        return memory.total / 1024**3, memory.available / 1024**3
+    except ImportError:
+        pass
+
+    try:
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                values[name] = int(value.split()[0]) * 1024
+        return values["MemTotal"] / 1024**3, values.get("MemAvailable", values["MemFree"]) / 1024**3
+    except (OSError, KeyError, ValueError):
+        pass
+
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+        return total, total
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def gpu_memory():
+    """(totale, libera) in GB della prima GPU CUDA, None se assente
+
+    Usa torch se già importato, altrimenti nvidia-smi: la configurazione
+    resta veloce senza importare torch.
+    """
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        if not torch.cuda.is_available():
+            return None
+        free, total = torch.cuda.mem_get_info(0)
+        return total / 1024**3, free / 1024**3
+
+    if shutil.which("nvidia-smi") is None:
+        return None
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "--query-gpu=memory.total,memory.free", "--format=csv,noheader,nounits", "-i", "0"],
+            capture_output=True, text=True, timeout=10, check=True
+        ).stdout
+        total, free = (float(value) for value in output.strip().splitlines()[0].split(","))
+        return total / 1024, free / 1024
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+def model_parameters(path):
+    """Numero di parametri dall'indice safetensors di una cartella locale"""
+    if not path or not os.path.isdir(path):
+        return DEFAULT_PARAMETERS
+
+    index = Path(path) / "model.safetensors.index.json"
+    try:
+        total_size = json.loads(index.read_text())["metadata"]["total_size"]
+        # I checkpoint MedGemma sono salvati a 16 bit
+        return total_size / 2
+    except (OSError, KeyError, ValueError):
+        pass
+
+    files = list(Path(path).glob("*.safetensors"))
+    if files:
+        return sum(f.stat().st_size for f in files) / 2
+    return DEFAULT_PARAMETERS
+
+
+def is_oom(error):
+    """True per errori di memoria esaurita (CUDA, allocatore CPU, MemoryError)"""
+    if isinstance(error, MemoryError):
+        return True
+    torch = sys.modules.get("torch")
+    if torch is not None and isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and any(text in message for text in _OOM_MESSAGES)
+
+
+def release_memory():
+    """Libera quanto possibile dopo un OOM prima di riprovare"""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ResourcePlan:
+    """Configurazione scelta dal planner"""
+
+    def __init__(self, dtype, device, max_memory, batch_size, token_budget, max_image_pixels):
+        self.dtype = dtype
+        self.device = device
+        self.max_memory = max_memory
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.max_image_pixels = max_image_pixels
+        self.notes = []
+
+    def to_dict(self):
+        return {
+            "dtype": self.dtype,
+            "device": self.device,
+            "max_memory": self.max_memory,
+            "batch_size": self.batch_size,
+            "token_budget": self.token_budget,
+            "max_image_pixels": self.max_image_pixels,
+            "notes": self.notes,
+        }
+
+
+class ResourcePlanner:
+    """Sceglie dtype, device e limiti dalla memoria disponibile
+
+    I valori espliciti del .env sono rispettati (con un avviso se non
+    entrano in memoria); "auto" viene risolto qui. A runtime registra
+    ogni riduzione fatta dopo un out of memory.
+    """
+
+    def __init__(self, parameters=DEFAULT_PARAMETERS, image_tokens=256):
+        self.parameters = parameters
+        self.image_tokens = image_tokens
+        self.ram = system_memory()
+        self.gpu = None
+        self.downgrades = []
+
+    def weights_gb(self, dtype):
+        return self.parameters * BYTES_PER_PARAMETER.get(dtype, 2.0) / 1024**3
+
+    def load_gb(self, dtype):
+        """Picco di memoria durante il caricamento (int8 passa da float32)"""
+        return self.weights_gb(LOAD_DTYPES.get(dtype, dtype))
+
+    def _request_gb(self, dtype):
+        # KV cache e attivazioni seguono il dtype di calcolo (int8 calcola in float32)
+        return REQUEST_GB * (2.0 if dtype in ("float32", "int8", "int8-text") else 1.0)
+
+    def plan(self, dtype="auto", device="auto", batch_size=4, token_budget=8192, max_new_tokens=500,
+             preferred_dtype=None):
+        """Piano per la configurazione richiesta; preferred_dtype è quello di uno snapshot locale"""
+        if device != "cpu":
+            self.gpu = gpu_memory()
+        use_gpu = self.gpu is not None and device != "cpu"
+
+        if use_gpu:
+            plan = self._plan_gpu(dtype, device, preferred_dtype)
+            free = self.gpu[1] * HEADROOM
+        else:
+            plan = self._plan_cpu(dtype, "cpu" if device == "auto" else device, preferred_dtype)
+            free = self.ram[1] * HEADROOM if self.ram else None
+
+        if free is None:
+            plan.batch_size, plan.token_budget = batch_size, token_budget
+            plan.notes.append("memoria non misurabile: batch e budget dal .env")
+            return plan
+
+        spare = free - (0 if plan.max_memory else self.weights_gb(plan.dtype))
+        fit = max(1, int(spare // self._request_gb(plan.dtype)))
+        plan.batch_size = min(batch_size, fit)
+        if plan.batch_size < batch_size:
+            plan.notes.append(f"batch {batch_size} -> {plan.batch_size} ({spare:.1f} GB liberi dopo i pesi)")
+
+        per_request = self.image_tokens + 128 + max_new_tokens
+        plan.token_budget = min(token_budget, plan.batch_size * per_request)
+
+        # La decodifica delle immagini usa la RAM anche con il modello su GPU
+        ram_free = (self.ram[1] * HEADROOM - (0 if use_gpu else self.weights_gb(plan.dtype))) if self.ram else spare
+        pixels = int(max(ram_free, 0) * 0.1 * 1024**3 / BYTES_PER_PIXEL)
+        plan.max_image_pixels = max(MIN_IMAGE_PIXELS, min(MAX_IMAGE_PIXELS, pixels))
+        return plan
+
+    def _plan_gpu(self, dtype, device, preferred_dtype):
+        total, free = self.gpu
+        usable = free * HEADROOM
+        if dtype == "auto":
+            dtype = preferred_dtype if preferred_dtype in ("bfloat16", "float16", "float32") else "bfloat16"
+
+        plan = ResourcePlan(dtype, device, None, 1, 0, MAX_IMAGE_PIXELS)
+        weights = self.weights_gb(dtype)
+        if weights + self._request_gb(dtype) > usable:
+            # Offload su CPU dei layer che non entrano in VRAM (accelerate)
+            plan.device = "auto"
+            plan.max_memory = self.offload_memory()
+            plan.notes.append(f"pesi {weights:.1f} GB > VRAM libera {usable:.1f} GB: offload parziale su CPU")
+        plan.notes.append(f"GPU {total:.1f} GB ({free:.1f} liberi), {dtype}")
+        return plan
+
+    def _plan_cpu(self, dtype, device, preferred_dtype):
+        available = self.ram[1] * HEADROOM if self.ram else None
+
+        if dtype == "auto":
+            candidates = ([preferred_dtype] if preferred_dtype in BYTES_PER_PARAMETER else []) + list(CPU_DTYPES)
+            dtype = candidates[-1]
+            if available is not None:
+                for candidate in candidates:
+                    if self.load_gb(candidate) + self._request_gb(candidate) <= available:
+                        dtype = candidate
+                        break
+            else:
+                dtype = candidates[0]
+
+        plan = ResourcePlan(dtype, device, None, 1, 0, MAX_IMAGE_PIXELS)
+        weights = self.weights_gb(dtype)
+        if available is not None:
+            plan.notes.append(f"RAM {self.ram[0]:.1f} GB ({self.ram[1]:.1f} disponibili), {dtype} ~{weights:.1f} GB")
+            peak = self.load_gb(dtype)
+            if peak > available:
+                plan.notes.append(f"ATTENZIONE: {dtype} richiede ~{peak:.1f} GB al caricamento, disponibili {available:.1f} GB")
+        return plan
+
+    def offload_memory(self):
+        """max_memory per device_map=auto: VRAM libera e il resto in RAM"""
+        memory = {}
+        if self.gpu is not None:
+            memory[0] = f"{self.gpu[1] * HEADROOM:.1f}GiB"
+        if self.ram is not None:
+            memory["cpu"] = f"{self.ram[1] * HEADROOM:.1f}GiB"
+        return memory or None
+
+    def fallbacks(self, dtype, device, max_memory):
+        """Configurazioni via via più leggere da provare se il caricamento va in OOM"""
+        chain = []
+        if device != "cpu":
+            if self.gpu is not None and max_memory is None:
+                chain.append((dtype, "auto", self.offload_memory()))
+            chain.extend((candidate, "cpu", None) for candidate in CPU_DTYPES)
+        else:
+            current = self.load_gb(dtype)
+            chain.extend((candidate, "cpu", None) for candidate in CPU_DTYPES if self.load_gb(candidate) < current)
+        return chain
+
+    def downgrade(self, what, old, new, error=None):
+        """Registra e stampa una riduzione dovuta alla memoria"""
+        event = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "what": what, "from": old, "to": new}
+        if error is not None:
+            event["error"] = str(error).splitlines()[0][:200]
+        self.downgrades.append(event)
+        print(f"Memoria insufficiente: {what} {old} -> {new}")
+        return event
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Server HTTP MedGemma
+Coda asyncio con micro-batching davanti a un unico modello caricato
+"""
+
+import asyncio
+import functools
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from PIL import Image
+
+from medgemma_cancel import CancelToken, activate as activate_token, describe
+from medgemma_dicom import split_frame
+
+DEFAULT_QUESTION = "Describe this medical image in detail"
+
+
+class InferenceServer:
+    """API HTTP locale che condivide un'istanza MedGemmaTest"""
+
+    def __init__(self, medgemma, host="127.0.0.1", port=8000, max_queue=64,
+                 batch_wait_ms=10, max_upload_mb=50):
+        self.medgemma = medgemma
+        self.host = host
+        self.port = port
+        self.max_queue = max_queue
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_upload_mb = max_upload_mb
+
+        self.queue = None
+        self.processed = 0
+        self.rejected = 0
+        self.expired = 0
+
+        # Un solo thread: il pipeline esegue un batch alla volta
+        self._model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="medgemma-model")
+        self._io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="medgemma-io")
+
+    def create_app(self):
+        """Costruisce l'applicazione aiohttp"""
+        app = web.Application(client_max_size=self.max_upload_mb * 1024**2)
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.router.add_post("/analyze", self.handle_analyze)
+        app.router.add_post("/conversations", self.handle_conversation_create)
+        app.router.add_get("/conversations", self.handle_conversation_list)
+        app.router.add_post("/conversations/{id}", self.handle_conversation_turn)
+        app.router.add_delete("/conversations/{id}", self.handle_conversation_close)
+        app.on_startup.append(self._start_scheduler)
+        app.on_cleanup.append(self._stop_scheduler)
+        return app
+
+    def run(self):
+        """Avvia il server (bloccante)"""
+        print(f"Server MedGemma su http://{self.host}:{self.port}")
+        print("  POST /analyze  - multipart (image, question, timeout) o JSON {path, question, timeout}")
+        print("  POST /conversations       - nuova conversazione: multipart (image) o JSON {path}, anche senza immagine")
+        print("  POST /conversations/{id}  - turno: JSON {question, timeout}")
+        print("  GET  /conversations       - conversazioni aperte")
+        print("  DELETE /conversations/{id} - chiude la conversazione")
+        print("  GET  /health   - stato del server")
+        print("  GET  /metrics  - metriche in formato Prometheus")
+        # Da aiohttp 3.9 un client disconnesso non annulla più l'handler:
+        # senza cancellazione la richiesta resterebbe in coda fino alla fine
+        web.run_app(self.create_app(), host=self.host, port=self.port, print=None, handler_cancellation=True)
+
+    async def handle_health(self, request):
+        return web.json_response({
+            "status": "ok",
+            "model": self.medgemma.model_name,
+            "queue": self.queue.qsize(),
+            "max_queue": self.max_queue,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "conversations": len(self.medgemma.conversations),
+        })
+
+    async def handle_metrics(self, request):
+        text = self.medgemma.metrics.render_prometheus(gauges={
+            "queue_depth": self.queue.qsize(),
+            "queue_rejected_total": self.rejected,
+            "queue_expired_total": self.expired,
+            "server_processed_total": self.processed,
+            "conversations_open": len(self.medgemma.conversations),
+            "conversation_caches_evicted_total": self.medgemma.conversations.evicted,
+        })
+        return web.Response(text=text, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def handle_analyze(self, request):
+        try:
+            # La deadline parte all'arrivo: comprende attesa in coda e upload
+            token = CancelToken.with_timeout(self._timeout(request.query.get("timeout")))
+            image, question, timeout = await self._parse_request(request)
+            if timeout is not None:
+                token.deadline = CancelToken.with_timeout(self._timeout(timeout)).deadline
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            return web.json_response({"error": f"Richiesta non valida: {e}"}, status=400)
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((image, question, future, token))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.json_response(
+                {"error": "Coda piena, riprova più tardi"},
+                status=429,
+                headers={"Retry-After": "1"}
+            )
+
+        try:
+            result = await future
+        except asyncio.CancelledError:
+            # Client disconnesso: la generazione si ferma al passo successivo
+            token.cancel("disconnected")
+            raise
+
+        if result["error"] is None:
+            status = 200
+        elif result.get("truncated") == "deadline":
+            status = 504
+        else:
+            status = 500
+        return web.json_response(result, status=status)
+
+    async def handle_conversation_create(self, request):
+        try:
+            image, _, _ = await self._parse_request(request, require_image=False)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            return web.json_response({"error": f"Richiesta non valida: {e}"}, status=400)
+
+        # Le feature visive si calcolano sul thread del modello
+        loop = asyncio.get_running_loop()
+        try:
+            conversation = await loop.run_in_executor(
+                self._model_executor, self.medgemma.start_conversation, image
+            )
+        except Exception as e:
+            return web.json_response({"error": f"Errore apertura conversazione: {e}"}, status=500)
+        return web.json_response(conversation.info(), status=201)
+
+    async def handle_conversation_list(self, request):
+        return web.json_response({
+            "conversations": self.medgemma.conversations.list(),
+            "stats": self.medgemma.conversations.stats(),
+        })
+
+    async def handle_conversation_turn(self, request):
+        conversation = self.medgemma.conversations.get(request.match_info["id"])
+        if conversation is None:
+            return web.json_response({"error": "Conversazione non trovata (chiusa o scaduta)"}, status=404)
+        try:
+            token = CancelToken.with_timeout(self._timeout(request.query.get("timeout")))
+            body = await request.json()
+            question = (body.get("question") or "").strip()
+            if not question:
+                raise ValueError("campo 'question' mancante")
+            if body.get("timeout") is not None:
+                token.deadline = CancelToken.with_timeout(self._timeout(body["timeout"])).deadline
+        except Exception as e:
+            return web.json_response({"error": f"Richiesta non valida: {e}"}, status=400)
+
+        # Stesso thread dei batch: un solo forward alla volta sul modello
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self._model_executor, functools.partial(self._conversation_turn, conversation, question, token)
+            )
+        except asyncio.CancelledError:
+            token.cancel("disconnected")
+            raise
+
+        result["id"] = conversation.id
+        if result["error"] is None:
+            status = 200
+        elif result.get("truncated") == "deadline":
+            status = 504
+        else:
+            status = 500
+        return web.json_response(result, status=status)
+
+    def _conversation_turn(self, conversation, question, token):
+        with activate_token(token):
+            if token.cancelled:
+                return {
+                    "response": None,
+                    "error": f"Richiesta annullata in coda: {describe(token.reason)}",
+                    "truncated": token.reason,
+                    "turn": conversation.turns,
+                }
+            return conversation.turn(question)
+
+    async def handle_conversation_close(self, request):
+        if not self.medgemma.conversations.remove(request.match_info["id"]):
+            return web.json_response({"error": "Conversazione non trovata (chiusa o scaduta)"}, status=404)
+        return web.json_response({"closed": request.match_info["id"]})
+
+    def _timeout(self, value):
+        """Timeout in secondi della richiesta, default REQUEST_TIMEOUT
+
+        ValueError (risposta 400) se non è un numero finito >= 0.
+        """
+        if value in (None, ""):
+            return self.medgemma.request_timeout
+        if isinstance(value, bool):
+            raise ValueError(f"timeout non valido: {value}")
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"timeout non valido: {value}") from None
+        if not math.isfinite(seconds) or seconds < 0:
+            raise ValueError(f"timeout non valido: {value}")
+        return seconds
+
+    async def _parse_request(self, request, require_image=True):
+        """Estrae immagine e domanda da multipart o JSON
+
+        Con require_image=False l'immagine è facoltativa (None se assente).
+        """
+        loop = asyncio.get_running_loop()
+
+        if request.content_type.startswith("multipart/"):
+            question = DEFAULT_QUESTION
+            timeout = None
+            data = None
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == "image":
+                    data = await part.read()
+                elif part.name == "question":
+                    question = (await part.text()).strip() or DEFAULT_QUESTION
+                elif part.name == "timeout":
+                    timeout = (await part.text()).strip() or None
+            if data is None:
+                if require_image:
+                    raise ValueError("campo 'image' mancante")
+                return None, question, timeout
+            image = await loop.run_in_executor(self._io_executor, self._decode_bytes, data)
+            return image, question, timeout
+
+        body = await request.json() if request.can_read_body or require_image else {}
+        path = body.get("path")
+        if not path:
+            if not require_image:
+                return None, body.get("question") or DEFAULT_QUESTION, body.get("timeout")
+            raise ValueError("campo 'path' mancante")
+        if not os.path.exists(split_frame(path)[0]):
+            raise web.HTTPNotFound(text=f"File non trovato: {path}")
+        image = await loop.run_in_executor(self._io_executor, self._decode_file, path)
+        return image, body.get("question") or DEFAULT_QUESTION, body.get("timeout")
+
+    async def _start_scheduler(self, app):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._scheduler_task = asyncio.create_task(self._scheduler())
+
+    async def _stop_scheduler(self, app):
+        self._scheduler_task.cancel()
+        self._model_executor.shutdown(wait=False)
+        self._io_executor.shutdown(wait=False)
+
+    def _drop_if_dead(self, entry):
+        """Scarta le richieste abbandonate o scadute in coda, rispondendo subito"""
+        _, _, future, token = entry
+        if future.done():
+            # Client che ha già chiuso la connessione
+            return True
+        if token.cancelled:
+            self.expired += 1
+            future.set_result({
+                "response": None,
+                "error": f"Richiesta annullata in coda: {describe(token.reason)}",
+                "truncated": token.reason,
+            })
+            return True
+        return False
+
+    async def _collect_batch(self):
+        """Attende una richiesta e raccoglie le successive per pochi ms
+
+        Le richieste scadute o abbandonate vengono scartate senza
+        occupare posti nel batch.
+        """
+        loop = asyncio.get_running_loop()
+        batch = []
+        while not batch:
+            entry = await self.queue.get()
+            if not self._drop_if_dead(entry):
+                batch.append(entry)
+        deadline = loop.time() + self.batch_wait
+
+        while len(batch) < self.medgemma.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                entry = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not self._drop_if_dead(entry):
+                batch.append(entry)
+
+        return batch
+
+    async def _scheduler(self):
+        """Alimenta il modello con micro-batch dalla coda"""
+        loop = asyncio.get_running_loop()
+        pool = self.medgemma.worker_pool
+        if pool is not None:
+            await self._dispatch(pool)
+            return
+
+        while True:
+            batch = await self._collect_batch()
+            # Salta le richieste scadute o abbandonate durante la raccolta
+            batch = [entry for entry in batch if not self._drop_if_dead(entry)]
+            if not batch:
+                continue
+
+            items = [(image, question) for image, question, _, _ in batch]
+            tokens = [token for _, _, _, token in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._model_executor,
+                    functools.partial(self.medgemma.analyze_images, items, tokens=tokens)
+                )
+            except Exception as e:
+                results = [{"response": None, "error": f"Errore durante analisi: {e}", "truncated": None}] * len(batch)
+
+            for (_, _, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.processed += len(batch)
+
+    async def _dispatch(self, pool):
+        """Con il pool ogni richiesta va al worker meno carico appena arriva
+
+        Restano in volo al massimo 2 x workers richieste (le altre
+        attendono nella coda HTTP, che applica il limite max_queue); ogni
+        risposta è inviata al completamento della sua richiesta.
+        """
+        slots = asyncio.Semaphore(2 * pool.workers)
+        while True:
+            await slots.acquire()
+            entry = await self.queue.get()
+            if self._drop_if_dead(entry):
+                slots.release()
+                continue
+
+            image, question, future, token = entry
+            try:
+                pool_future = pool.submit(image, question, deadline=token.deadline)
+            except Exception as e:
+                slots.release()
+                if not future.done():
+                    future.set_result({"response": None, "error": f"Errore durante analisi: {e}", "truncated": None})
+                continue
+            token.on_cancel(lambda pool_future=pool_future: pool.cancel(pool_future))
+            asyncio.wrap_future(pool_future).add_done_callback(
+                functools.partial(self._pool_done, future, slots)
+            )
+
+    def _pool_done(self, future, slots, pool_future):
+        slots.release()
+        self.processed += 1
+        if future.done():
+            # Client già disconnesso
+            return
+        if pool_future.cancelled() or pool_future.exception() is not None:
+            error = "annullata" if pool_future.cancelled() else pool_future.exception()
+            future.set_result({"response": None, "error": f"Errore durante analisi: {error}", "truncated": None})
+        else:
+            future.set_result(pool_future.result())
+
+    def _decode_bytes(self, data):
+        if data[128:132] == b"DICM":
+            preprocessor = getattr(self.medgemma, "preprocessor", None)
+            target_size = preprocessor.target_size if preprocessor is not None else None
+            return self._prepare(self.medgemma.dicom.load_bytes(data, target_size=target_size))
+        image = Image.open(io.BytesIO(data))
+        return self._prepare(image)
+
+    def _decode_file(self, path):
+        # Stesso caricamento della CLI: DICOM, path#frame e cartelle di serie
+        return self.medgemma.load_image(path)
+
+    def _prepare(self, image):
+        """Usa lo stesso preprocessing dell'istanza MedGemma"""
+        preprocessor = getattr(self.medgemma, "preprocessor", None)
+        if preprocessor is not None:
+            return preprocessor.prepare(image)
+        image.load()
+        return image
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Snapshot locale MedGemma
+Esporta il modello già convertito e lo ricarica in memory-map
+"""
+
+import json
+import mmap
+import re
+import struct
+import time
+from pathlib import Path
+
+MANIFEST_NAME = "medgemma_snapshot.json"
+
+# Tipi dell'header safetensors -> nomi dtype torch
+SAFETENSORS_DTYPES = {
+    "BF16": "bfloat16",
+    "F16": "float16",
+    "F32": "float32",
+    "F64": "float64",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool",
+}
+
+
+def read_manifest(path):
+    """Metadati dello snapshot o None se la cartella non è uno snapshot"""
+    try:
+        return json.loads((Path(path) / MANIFEST_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def export_snapshot(pipe, path, source_model, dtype_name):
+    """Salva modello e processor in safetensors nel dtype corrente"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    pipe.model.save_pretrained(path, safe_serialization=True)
+    pipe.processor.save_pretrained(path)
+
+    manifest = {
+        "source_model": source_model,
+        "dtype": dtype_name,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    (path / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def mmap_safetensors(path):
+    """Tensori di un file safetensors come viste su una mappatura del file
+
+    La mappatura è copy-on-write (ACCESS_COPY): finché i pesi non vengono
+    scritti le pagine restano quelle della page cache, condivise tra i
+    processi che caricano lo stesso snapshot.
+    """
+    import torch
+
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+
+        dtype = getattr(torch, SAFETENSORS_DTYPES[info["dtype"]])
+        start, end = info["data_offsets"]
+        shape = info["shape"]
+
+        if end == start:
+            tensors[name] = torch.empty(shape, dtype=dtype)
+            continue
+
+        count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + start).view(shape)
+
+    return tensors
+
+
+def load_snapshot(path, device_map="cpu", attn_implementation=None):
+    """Ricostruisce il pipeline da uno snapshot esportato
+
+    Su CPU i pesi sono assegnati direttamente dalle mappature del file,
+    senza copie private; su GPU si usa il caricamento standard perché il
+    trasferimento in VRAM copia comunque i pesi.
+    """
+    attn_kwargs = {"attn_implementation": attn_implementation} if attn_implementation else {}
+    import torch
+    from transformers import AutoConfig, AutoModelForImageTextToText, AutoProcessor, pipeline
+
+    path = Path(path)
+    manifest = read_manifest(path)
+    torch_dtype = getattr(torch, manifest["dtype"])
+    processor = AutoProcessor.from_pretrained(path)
+
+    if device_map not in ("cpu", "auto") or (device_map == "auto" and torch.cuda.is_available()):
+        model = AutoModelForImageTextToText.from_pretrained(
+            path, torch_dtype=torch_dtype, device_map=device_map, **attn_kwargs
+        )
+        return pipeline("image-text-to-text", model=model, processor=processor)
+
+    try:
+        from transformers.modeling_utils import no_init_weights
+    except ImportError:
+        from transformers.initialization import no_init_weights
+
+    # Scheletro senza inizializzazione casuale: i parametri vengono sostituiti
+    config = AutoConfig.from_pretrained(path)
+    with no_init_weights():
+        model = AutoModelForImageTextToText.from_config(config, torch_dtype=torch_dtype, **attn_kwargs)
+
+    state_dict = {}
+    for shard in sorted(path.glob("*.safetensors")):
+        state_dict.update(mmap_safetensors(shard))
+    state_dict = {_convert_key(model, key): tensor for key, tensor in state_dict.items()}
+
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    # I soli pesi assenti ammessi sono quelli legati (es. lm_head -> embed_tokens)
+    loaded = {tensor.data_ptr() for tensor in state_dict.values()}
+    current = model.state_dict()
+    missing = [name for name in missing if current[name].data_ptr() not in loaded]
+    if missing or unexpected:
+        raise RuntimeError(f"Snapshot incompleto: mancanti {missing[:5]}, inattesi {unexpected[:5]}")
+
+    model.eval()
+    return pipeline("image-text-to-text", model=model, processor=processor)
+
+
+def _convert_key(model, key):
+    """Applica la stessa rinomina chiavi di from_pretrained
+
+    save_pretrained può salvare i nomi nel formato storico del checkpoint
+    (es. language_model.model.* per Gemma 3).
+    """
+    mapping = getattr(model, "_checkpoint_conversion_mapping", None) or {}
+    for pattern, replacement in mapping.items():
+        key, count = re.subn(pattern, replacement, key)
+        if count:
+            break
+    return key
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Decodifica assistita MedGemma
+Un modello draft piccolo propone i token, il modello principale li verifica in un solo forward
+"""
+
+import time
+
+
+def remap_out_of_vocab(model, replacement_id=0):
+    """Sostituisce gli id fuori dal vocabolario del draft (es. token immagine)
+
+    Il draft è un modello di solo testo: i token segnaposto delle
+    immagini del modello principale non hanno un embedding.
+    """
+    import torch
+
+    embeddings = model.get_input_embeddings()
+    size = embeddings.num_embeddings
+
+    def hook(module, args):
+        input_ids = args[0]
+        if bool((input_ids >= size).any()):
+            return (torch.where(input_ids >= size, torch.full_like(input_ids, replacement_id), input_ids),) + args[1:]
+        return None
+
+    return embeddings.register_forward_pre_hook(hook)
+
+
+def check_tokenizers(tokenizer, draft_tokenizer, samples=2000):
+    """True se i due tokenizer assegnano gli stessi id ai token di testo"""
+    size = min(len(tokenizer), len(draft_tokenizer))
+    step = max(1, size // samples)
+    ids = list(range(0, size, step))
+    return tokenizer.convert_ids_to_tokens(ids) == draft_tokenizer.convert_ids_to_tokens(ids)
+
+
+def load_draft_model(name, reference_model, tokenizer):
+    """Carica il draft sullo stesso device e dtype del modello principale"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    dtype = reference_model.dtype
+    if dtype not in (torch.float16, torch.bfloat16, torch.float32):
+        # Modello principale quantizzato: il draft resta in float32
+        dtype = torch.float32
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(name)
+    if not check_tokenizers(tokenizer, draft_tokenizer):
+        raise ValueError(f"Il tokenizer di {name} non è compatibile con quello del modello principale")
+
+    draft = AutoModelForCausalLM.from_pretrained(name, torch_dtype=dtype).to(reference_model.device).eval()
+    remap_out_of_vocab(draft, replacement_id=tokenizer.pad_token_id or 0)
+    return draft
+
+
+def _forward(model, tokens, cache, start):
+    """Forward di tokens su una cache che copre [0, start); logits per posizione"""
+    import torch
+
+    device = model.device
+    input_ids = torch.tensor([tokens], device=device)
+    end = start + len(tokens)
+    with torch.no_grad():
+        output = model(
+            input_ids=input_ids,
+            attention_mask=torch.ones((1, end), dtype=torch.long, device=device),
+            past_key_values=cache,
+            cache_position=torch.arange(start, end, device=device),
+            use_cache=True,
+        )
+    return output.logits[0]
+
+
+def speculative_generate(model, draft, input_ids, cache, max_new_tokens, draft_tokens=5,
+                         eos_token_ids=(), streamer=None, clock=None, should_stop=None):
+    """Decodifica greedy assistita, batch 1
+
+    cache contiene già il prompt tranne l'ultimo token (come dopo
+    engine.prefill). A ogni passo il draft propone fino a draft_tokens
+    token e il modello principale li valuta tutti in un forward: si
+    tengono quelli uguali alla sua scelta greedy più il suo token
+    successivo, quindi il testo coincide con la decodifica greedy.
+    should_stop() viene controllata prima di ogni passo (cancellazione).
+    Ritorna (id prompt + risposta, statistiche).
+    """
+    import torch
+    from transformers import DynamicCache
+
+    sequence = input_ids[0].tolist()
+    prompt_length = len(sequence)
+    eos_token_ids = set(eos_token_ids)
+
+    main_length = prompt_length - 1
+    draft_cache = DynamicCache()
+    draft_length = 0
+
+    generated = 0
+    proposed = accepted = forwards = 0
+    draft_seconds = 0.0
+    stopped = False
+
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    while generated < max_new_tokens:
+        if should_stop is not None and should_stop():
+            stopped = True
+            break
+
+        # Ultimo token sempre dal modello principale: massimo draft_tokens + 1 nuovi
+        budget = min(draft_tokens, max_new_tokens - generated - 1)
+
+        proposals = []
+        if budget > 0:
+            draft_start = time.perf_counter()
+            feed = sequence[draft_length:]
+            for _ in range(budget):
+                logits = _forward(draft, feed, draft_cache, draft_length)
+                draft_length += len(feed)
+                token = int(logits[-1].argmax())
+                proposals.append(token)
+                if token in eos_token_ids:
+                    break
+                feed = [token]
+            draft_seconds += time.perf_counter() - draft_start
+
+        feed = sequence[main_length:] + proposals
+        logits = _forward(model, feed, cache, main_length)
+        forwards += 1
+        predictions = logits[-(len(proposals) + 1):].argmax(dim=-1).tolist()
+
+        matched = 0
+        while matched < len(proposals) and proposals[matched] == predictions[matched]:
+            matched += 1
+        proposed += len(proposals)
+        accepted += matched
+
+        # Le cache tengono solo i token confermati
+        main_length = len(sequence) + matched
+        cache.crop(main_length)
+        draft_length = min(draft_length, len(sequence) + matched)
+        draft_cache.crop(draft_length)
+
+        new_tokens = proposals[:matched] + [predictions[matched]]
+        new_tokens = new_tokens[:max_new_tokens - generated]
+        for position, token in enumerate(new_tokens):
+            if token in eos_token_ids:
+                new_tokens = new_tokens[:position + 1]
+                break
+
+        if clock is not None and generated == 0:
+            clock(None, None)
+        sequence.extend(new_tokens)
+        generated += len(new_tokens)
+        if streamer is not None:
+            streamer.put(torch.tensor(new_tokens))
+
+        if new_tokens[-1] in eos_token_ids:
+            break
+
+    if streamer is not None:
+        streamer.end()
+
+    stats = {
+        "tokens": generated,
+        "proposed": proposed,
+        "accepted": accepted,
+        "acceptance_rate": accepted / proposed if proposed else 0.0,
+        "main_forwards": forwards,
+        "tokens_per_forward": generated / forwards if forwards else 0.0,
+        "draft_seconds": draft_seconds,
+        "stopped": stopped,
+    }
+    return torch.tensor([sequence], device=input_ids.device), stats
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Archivio risultati MedGemma
+Analisi salvate in SQLite (WAL) da un thread scrittore che raggruppa gli insert in transazioni
+"""
+
+import argparse
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from medgemma_cache import image_digest
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    request_id TEXT,
+    kind TEXT,
+    source TEXT,
+    image_hash TEXT,
+    question TEXT,
+    model TEXT NOT NULL,
+    settings TEXT,
+    answer TEXT,
+    error TEXT,
+    truncated TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    total_seconds REAL,
+    stages TEXT,
+    input_tokens INTEGER,
+    output_tokens INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_results_image_hash ON results (image_hash);
+CREATE INDEX IF NOT EXISTS idx_results_model_created ON results (model, created_at);
+CREATE INDEX IF NOT EXISTS idx_results_created ON results (created_at);
+"""
+
+COLUMNS = (
+    "created_at", "request_id", "kind", "source", "image_hash", "question", "model", "settings",
+    "answer", "error", "truncated", "cached", "total_seconds", "stages", "input_tokens", "output_tokens",
+)
+
+INSERT = f"INSERT INTO results ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+# Raggruppamenti del comando results --group-by
+GROUPS = {
+    "model": "model",
+    "kind": "kind",
+    "day": "date(created_at, 'unixepoch', 'localtime')",
+    "image": "image_hash",
+    "question": "question",
+}
+
+
+def connect(path):
+    """Connessione con WAL: i lettori non bloccano lo scrittore"""
+    connection = sqlite3.connect(str(path), timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class ResultStore:
+    """Archivio persistente delle analisi
+
+    put() accoda il record e ritorna subito: l'inferenza non attende mai
+    il disco. Il thread scrittore inserisce fino a batch_size record (o
+    quelli arrivati entro flush_seconds) in un'unica transazione. Con la
+    coda piena i record in eccesso sono scartati e contati in dropped.
+    """
+
+    def __init__(self, path, batch_size=256, flush_seconds=1.0, max_pending=10000):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Schema e WAL subito: gli errori (permessi, disco) emergono all'avvio
+        connect(self.path).close()
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, daemon=True, name="medgemma-results")
+        self._thread.start()
+
+    def put(self, record):
+        """Accoda un record (dict con le chiavi di COLUMNS)
+
+        Di norma image_hash arriva già calcolato (lo stesso della cache);
+        con la sola chiave image (PIL) l'hash è calcolato qui, così
+        l'immagine non resta in coda. Un hash non calcolabile è contato
+        in failed e il record è salvato senza.
+        """
+        if self._closed:
+            return
+        image = record.pop("image", None)
+        if image is not None and not record.get("image_hash"):
+            try:
+                record["image_hash"] = image_digest(image)
+            except Exception as e:
+                self.failed += 1
+                print(f"Hash immagine non calcolabile per l'archivio: {e}")
+        record.setdefault("created_at", time.time())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Attende che i record accodati siano scritti"""
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+
+    def stats(self):
+        return {
+            "path": str(self.path),
+            "written": self.written,
+            "pending": self._queue.qsize(),
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def _writer(self):
+        connection = connect(self.path)
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            records = [record for record in batch if record is not None]
+            # Un record o un batch non validi non devono fermare il thread:
+            # flush() attende task_done per ogni elemento accodato
+            rows = []
+            for record in records:
+                try:
+                    rows.append(_row(record))
+                except Exception as e:
+                    self.failed += 1
+                    print(f"Record archivio risultati scartato: {e}")
+            if rows:
+                try:
+                    with connection:
+                        connection.executemany(INSERT, rows)
+                    self.written += len(rows)
+                except Exception as e:
+                    self.failed += len(rows)
+                    print(f"Errore archivio risultati: {e}")
+            for _ in batch:
+                self._queue.task_done()
+        connection.close()
+
+
+def _row(record):
+    values = []
+    for column in COLUMNS:
+        value = record.get(column)
+        if column in ("settings", "stages") and value is not None:
+            value = json.dumps(value, sort_keys=True)
+        elif column == "cached":
+            value = int(bool(value))
+        values.append(value)
+    return values
+
+
+def parse_time(value):
+    """Istante da 'YYYY-MM-DD[ HH:MM[:SS]]' o relativo ('30m', '24h', '7d')"""
+    match = re.fullmatch(r"(\d+)([mhd])", value.strip())
+    if match:
+        seconds = {"m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return time.time() - int(match.group(1)) * seconds
+    for layout in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value.strip(), layout))
+        except ValueError:
+            continue
+    raise ValueError(f"Data non valida: {value} (usa YYYY-MM-DD[ HH:MM] o 30m/24h/7d)")
+
+
+def _filters(image_hash=None, model=None, source=None, question=None, since=None, until=None, errors=False):
+    clauses, params = [], []
+    if image_hash:
+        # Basta un prefisso dell'hash, come per git
+        clauses.append("image_hash >= ? AND image_hash < ?")
+        image_hash = image_hash.lower()
+        params += [image_hash, image_hash + "g"]
+    if model:
+        clauses.append("model = ?")
+        params.append(model)
+    if source:
+        clauses.append("source LIKE ?")
+        params.append(f"%{source}%")
+    if question:
+        clauses.append("question LIKE ?")
+        params.append(f"%{question}%")
+    if since is not None:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("created_at < ?")
+        params.append(until)
+    if errors:
+        clauses.append("error IS NOT NULL")
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def query(path, limit=20, **filters):
+    """Record più recenti che soddisfano i filtri, come dict"""
+    where, params = _filters(**filters)
+    connection = connect(path)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(
+            f"SELECT * FROM results{where} ORDER BY created_at DESC LIMIT ?", params + [limit]
+        ).fetchall()
+    finally:
+        connection.close()
+
+    results = []
+    for row in rows:
+        record = dict(row)
+        for column in ("settings", "stages"):
+            if record[column]:
+                record[column] = json.loads(record[column])
+        results.append(record)
+    return results
+
+
+def aggregate(path, group_by="model", limit=20, **filters):
+    """Conteggi e tempi medi per gruppo (modello, tipo, giorno, immagine, domanda)"""
+    key = GROUPS[group_by]
+    where, params = _filters(**filters)
+    connection = connect(path)
+    try:
+        rows = connection.execute(
+            f"""
+            SELECT {key} AS key,
+                   COUNT(*),
+                   SUM(error IS NOT NULL),
+                   SUM(truncated IS NOT NULL),
+                   SUM(cached),
+                   AVG(CASE WHEN cached = 0 THEN total_seconds END),
+                   AVG(json_extract(stages, '$.prefill')),
+                   AVG(json_extract(stages, '$.decode')),
+                   AVG(output_tokens)
+            FROM results{where}
+            GROUP BY key
+            ORDER BY COUNT(*) DESC
+            LIMIT ?
+            """,
+            params + [limit]
+        ).fetchall()
+    finally:
+        connection.close()
+
+    names = ("count", "errors", "truncated", "cached", "mean_seconds", "mean_prefill", "mean_decode",
+             "mean_output_tokens")
+    return [{"key": row[0], **dict(zip(names, row[1:]))} for row in rows]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="test_medgemma.py results",
+        description="Interroga l'archivio SQLite delle analisi"
+    )
+    parser.add_argument("--db", help="database (default RESULTS_DB)")
+    parser.add_argument("--hash", dest="image_hash", help="hash dei pixel (anche solo il prefisso)")
+    parser.add_argument("--model", help="nome esatto del modello")
+    parser.add_argument("--source", help="path o URL contenente il testo")
+    parser.add_argument("--question", help="domanda contenente il testo")
+    parser.add_argument("--since", help="dal (YYYY-MM-DD[ HH:MM] o relativo: 30m, 24h, 7d)")
+    parser.add_argument("--until", help="fino al (stesso formato di --since)")
+    parser.add_argument("--errors", action="store_true", help="solo le analisi fallite")
+    parser.add_argument("--group-by", choices=sorted(GROUPS), help="aggrega invece di elencare")
+    parser.add_argument("-n", "--limit", type=int, default=20, help="righe mostrate (default 20)")
+    parser.add_argument("--json", action="store_true", help="output JSONL")
+    return parser.parse_args(argv)
+
+
+def run_query(options, db_path):
+    """Comando results: elenco o aggregati a terminale"""
+    if not Path(db_path).exists():
+        print(f"Archivio non trovato: {db_path}")
+        return False
+
+    filters = {
+        "image_hash": options.image_hash,
+        "model": options.model,
+        "source": options.source,
+        "question": options.question,
+        "since": parse_time(options.since) if options.since else None,
+        "until": parse_time(options.until) if options.until else None,
+        "errors": options.errors,
+    }
+
+    if options.group_by:
+        rows = aggregate(db_path, options.group_by, limit=options.limit, **filters)
+        if options.json:
+            for row in rows:
+                print(json.dumps(row, ensure_ascii=False))
+            return True
+        print(f"{options.group_by:<24} {'analisi':>8} {'errori':>7} {'tronc.':>7} {'cache':>6} "
+              f"{'media':>8} {'prefill':>8} {'decode':>8} {'token':>6}")
+        for row in rows:
+            print(
+                f"{str(row['key'])[:24]:<24} {row['count']:>8} {row['errors']:>7} {row['truncated']:>7} "
+                f"{row['cached']:>6} {_seconds(row['mean_seconds'])} {_seconds(row['mean_prefill'])} "
+                f"{_seconds(row['mean_decode'])} {row['mean_output_tokens'] or 0:>6.0f}"
+            )
+        return True
+
+    rows = query(db_path, limit=options.limit, **filters)
+    for row in rows:
+        if options.json:
+            print(json.dumps(row, ensure_ascii=False))
+            continue
+        created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["created_at"]))
+        status = "ERRORE" if row["error"] else ("troncata" if row["truncated"] else "ok")
+        if row["cached"]:
+            status += " (cache)"
+        print(f"\n[{created}] {row['kind']} {status} | {row['model']} | {(row['image_hash'] or '-')[:12]}"
+              f" | {_seconds(row['total_seconds']).strip()}")
+        if row["source"]:
+            print(f"  Sorgente: {row['source']}")
+        print(f"  Domanda: {row['question']}")
+        text = row["error"] or row["answer"] or ""
+        print(f"  Risposta: {text[:300]}{'...' if len(text) > 300 else ''}")
+    if not options.json:
+        print(f"\n{len(rows)} analisi mostrate")
+    return True
+
+
+def _seconds(value):
+    return f"{value:7.2f}s" if value is not None else f"{'-':>8}"
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Analisi a tile MedGemma
+Immagini molto grandi (vetrini istologici, TIFF piramidali) lette a regioni, solo i tile con tessuto
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+TILE_QUESTION = ("Describe any abnormal findings in this tile of a larger histology image. "
+                 "If the tissue looks normal, say so briefly.")
+OVERVIEW_QUESTION = "This is a low-resolution overview of a whole slide. Describe the tissue and any visible abnormalities."
+SUMMARY_QUESTION = ("The following are findings from individual tiles of the same slide, with their position. "
+                    "Write a single concise report: main findings, where they are, and limitations.")
+
+OPENSLIDE_EXTENSIONS = (".svs", ".ndpi", ".mrxs", ".scn", ".vms", ".vmu", ".bif", ".svslide")
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+# Pixel del thumbnail per lato di ogni tile nel filtro
+CELL_PIXELS = 8
+
+# Soglie di default: frazione di tessuto o entropia normalizzata
+MIN_SCORE = {"tissue": 0.25, "entropy": 0.4}
+
+# Limite dell'immagine decodificata per intero da PILSource (~3 GB in RGB):
+# oltre servono OpenSlide o tifffile
+PIL_MAX_PIXELS = 1_000_000_000
+
+# Image.MAX_IMAGE_PIXELS è globale: un'apertura alla volta lo modifica
+_pil_limit_lock = threading.Lock()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="test_medgemma.py tiles",
+        description="Analizza un'immagine molto grande a tile, saltando lo sfondo"
+    )
+    parser.add_argument("path", help="vetrino (.svs, .ndpi, ...), TIFF piramidale o immagine grande")
+    parser.add_argument("-q", "--question", default=TILE_QUESTION, help="domanda per ogni tile")
+    parser.add_argument("--level", type=int, default=0, help="livello della piramide (0 = risoluzione piena)")
+    parser.add_argument("--tile-size", type=int, help="lato del tile in pixel (default risoluzione del modello)")
+    parser.add_argument("--max-tiles", type=int, default=64, help="tile analizzati al massimo, i più ricchi di tessuto (default 64)")
+    parser.add_argument("--filter", choices=sorted(MIN_SCORE), default="tissue",
+                        help="tissue: colore su vetro chiaro (istologia); entropy: tile con contenuto")
+    parser.add_argument("--min-score", type=float, help="soglia del filtro (default 0.25 tissue, 0.4 entropy)")
+    parser.add_argument("-b", "--batch-size", type=int, help="tile per batch (default BATCH_SIZE)")
+    parser.add_argument("-o", "--output", help="report JSON (default results/tiles/<nome>.tiles.json)")
+    return parser.parse_args(argv)
+
+
+class RegionSource(ABC):
+    """Sorgente che legge regioni senza decodificare l'immagine intera
+
+    levels: lista di (larghezza, altezza) dal più dettagliato; le
+    coordinate di read_region sono nel livello richiesto.
+    """
+
+    levels = []
+
+    @abstractmethod
+    def read_region(self, level, x, y, width, height):
+        """Regione RGB di width x height pixel, bianca fuori dall'immagine"""
+
+    def thumbnail(self, max_side):
+        """Miniatura dal livello più piccolo, ricomposta a regioni se serve"""
+        level = len(self.levels) - 1
+        width, height = self.levels[level]
+        scale = min(1.0, max_side / max(width, height))
+        thumb = Image.new("RGB", (max(1, round(width * scale)), max(1, round(height * scale))), "white")
+
+        step = 2048
+        for y in range(0, height, step):
+            for x in range(0, width, step):
+                region = self.read_region(level, x, y, min(step, width - x), min(step, height - y))
+                size = (max(1, round(region.width * scale)), max(1, round(region.height * scale)))
+                thumb.paste(region.resize(size, Image.BILINEAR), (round(x * scale), round(y * scale)))
+        return thumb
+
+    def close(self):
+        pass
+
+
+class OpenSlideSource(RegionSource):
+    """Vetrini digitali tramite OpenSlide (piramide e tile nativi)"""
+
+    def __init__(self, path):
+        try:
+            import openslide
+        except ImportError:
+            raise ImportError("Installa OpenSlide per i vetrini digitali: pip install openslide-python openslide-bin") from None
+
+        self.slide = openslide.OpenSlide(path)
+        self.levels = list(self.slide.level_dimensions)
+        self.downsamples = list(self.slide.level_downsamples)
+
+    def read_region(self, level, x, y, width, height):
+        scale = self.downsamples[level]
+        region = self.slide.read_region((int(x * scale), int(y * scale)), level, (width, height))
+        # Fuori dal vetrino i pixel sono trasparenti: diventano vetro bianco
+        background = Image.new("RGB", region.size, "white")
+        background.paste(region, mask=region.getchannel("A"))
+        return background
+
+    def thumbnail(self, max_side):
+        return self.slide.get_thumbnail((max_side, max_side)).convert("RGB")
+
+    def close(self):
+        self.slide.close()
+
+
+class TiffSource(RegionSource):
+    """TIFF (anche piramidali) letti tile per tile con tifffile"""
+
+    def __init__(self, path):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("Installa tifffile per i TIFF di grandi dimensioni: pip install tifffile imagecodecs") from None
+
+        self._tif = tifffile.TiffFile(path)
+        series = self._tif.series[0]
+        self._pages = [level.keyframe for level in getattr(series, "levels", None) or [series]]
+        self.levels = [(page.imagewidth, page.imagelength) for page in self._pages]
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    def read_region(self, level, x, y, width, height):
+        import numpy as np
+
+        page = self._pages[level]
+        out = np.full((height, width, 3), 255, dtype=np.uint8)
+
+        if not page.is_tiled and page.is_memmappable:
+            array = self._untiled(level)
+            y1, x1 = min(y + height, page.imagelength), min(x + width, page.imagewidth)
+            out[:y1 - y, :x1 - x] = self._rgb(array[y:y1, x:x1])
+            return Image.fromarray(out)
+
+        if not page.is_tiled:
+            # TIFF a strip compresso: si decodificano solo le strip della regione
+            rows = min(page.rowsperstrip or page.imagelength, page.imagelength)
+            x1 = min(x + width, page.imagewidth)
+            for strip in range(y // rows, min(math.ceil((y + height) / rows), math.ceil(page.imagelength / rows))):
+                top = strip * rows
+                y0, y1 = max(y, top), min(y + height, top + rows, page.imagelength)
+                if y0 >= y1 or x >= x1:
+                    continue
+                length = min(rows, page.imagelength - top)
+                data = self._segment(page, strip, length, page.imagewidth)
+                out[y0 - y:y1 - y, :x1 - x] = self._rgb(data[y0 - top:y1 - top, x:x1])
+            return Image.fromarray(out)
+
+        tile_width, tile_length = page.tilewidth, page.tilelength
+        across = math.ceil(page.imagewidth / tile_width)
+        down = math.ceil(page.imagelength / tile_length)
+
+        for row in range(y // tile_length, min(math.ceil((y + height) / tile_length), down)):
+            for column in range(x // tile_width, min(math.ceil((x + width) / tile_width), across)):
+                top, left = row * tile_length, column * tile_width
+                y0, y1 = max(y, top), min(y + height, top + tile_length, page.imagelength)
+                x0, x1 = max(x, left), min(x + width, left + tile_width, page.imagewidth)
+                if y0 >= y1 or x0 >= x1:
+                    continue
+                tile = self._segment(page, row * across + column, tile_length, tile_width)
+                out[y0 - y:y1 - y, x0 - x:x1 - x] = self._rgb(tile[y0 - top:y1 - top, x0 - left:x1 - left])
+
+        return Image.fromarray(out)
+
+    def _segment(self, page, index, length, width):
+        """Legge e decodifica un solo tile (o strip) del file"""
+        import numpy as np
+
+        handle = self._tif.filehandle
+        with self._lock:
+            handle.seek(page.dataoffsets[index])
+            data = handle.read(page.databytecounts[index])
+
+        if not data:
+            # Segmento assente (sparse): sfondo
+            return np.full((length, width, 3), 255, dtype=np.uint8)
+        segment, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+        segment = np.asarray(segment)
+        # L'ultima strip può arrivare piena (rowsperstrip righe) o già troncata
+        return segment.reshape(-1, width, segment.shape[-1])[:length]
+
+    def _untiled(self, level):
+        """TIFF a strip non compresso: memory-map, nessuna decodifica"""
+        with self._lock:
+            if level not in self._arrays:
+                self._arrays[level] = self._pages[level].asarray(out="memmap")
+            return self._arrays[level]
+
+    @staticmethod
+    def _rgb(array):
+        import numpy as np
+
+        if array.ndim == 2:
+            array = array[..., None]
+        if array.dtype != np.uint8:
+            array = (array.astype(np.float32) * (255.0 / max(float(array.max()), 1.0))).astype(np.uint8)
+        if array.shape[-1] == 1:
+            return np.repeat(array, 3, axis=-1)
+        return array[..., :3]
+
+    def close(self):
+        self._tif.close()
+
+
+class PILSource(RegionSource):
+    """Ripiego per formati senza accesso a regioni: l'immagine è decodificata una volta"""
+
+    def __init__(self, path):
+        # Le immagini grandi superano il limite anti "decompression bomb" di
+        # PIL: alzato solo durante l'apertura, il limite vero è PIL_MAX_PIXELS
+        with _pil_limit_lock:
+            previous = Image.MAX_IMAGE_PIXELS
+            if previous is not None:
+                Image.MAX_IMAGE_PIXELS = max(previous, PIL_MAX_PIXELS)
+            try:
+                image = Image.open(path)
+            finally:
+                Image.MAX_IMAGE_PIXELS = previous
+
+        with image:
+            # Image.open legge solo l'intestazione: il controllo precede la decodifica
+            if image.width * image.height > PIL_MAX_PIXELS:
+                raise ValueError(
+                    f"Immagine di {image.width}x{image.height} pixel troppo grande per PIL "
+                    f"(max {PIL_MAX_PIXELS}): usa un TIFF piramidale o un formato OpenSlide"
+                )
+            self.image = image.convert("RGB")
+        self.levels = [self.image.size]
+
+    def read_region(self, level, x, y, width, height):
+        region = Image.new("RGB", (width, height), "white")
+        region.paste(self.image.crop((x, y, min(x + width, self.image.width), min(y + height, self.image.height))))
+        return region
+
+    def thumbnail(self, max_side):
+        thumb = self.image.copy()
+        thumb.thumbnail((max_side, max_side), Image.BILINEAR)
+        return thumb
+
+
+def open_source(path):
+    """Sorgente più adatta al file: OpenSlide, tifffile o PIL"""
+    lower = path.lower()
+    if lower.endswith(OPENSLIDE_EXTENSIONS):
+        return OpenSlideSource(path)
+    if lower.endswith(TIFF_EXTENSIONS):
+        try:
+            return TiffSource(path)
+        except ImportError as e:
+            print(f"{e} (uso PIL, l'immagine verrà caricata per intero)")
+    return PILSource(path)
+
+
+def tile_scores(thumbnail, rows, columns, mode="tissue"):
+    """Punteggio per tile calcolato sul thumbnail, vettoriale
+
+    tissue: frazione di pixel colorati e non troppo chiari (vetro) né
+    neri (bordi, pennarello); entropy: entropia normalizzata dei grigi.
+    """
+    import numpy as np
+
+    grid = thumbnail.resize((columns * CELL_PIXELS, rows * CELL_PIXELS), Image.BILINEAR)
+    pixels = np.asarray(grid, dtype=np.int16)
+
+    if mode == "tissue":
+        saturation = pixels.max(axis=-1) - pixels.min(axis=-1)
+        gray = pixels.mean(axis=-1)
+        mask = (saturation > 20) & (gray < 220) & (gray > 25)
+        return mask.reshape(rows, CELL_PIXELS, columns, CELL_PIXELS).mean(axis=(1, 3))
+
+    bins = 16
+    levels = (pixels.mean(axis=-1) * bins / 256).astype(np.int64).clip(0, bins - 1)
+    cells = levels.reshape(rows, CELL_PIXELS, columns, CELL_PIXELS).transpose(0, 2, 1, 3).reshape(rows * columns, -1)
+    counts = np.zeros((rows * columns, bins))
+    np.add.at(counts, (np.repeat(np.arange(rows * columns), cells.shape[1]), cells.ravel()), 1)
+    p = counts / cells.shape[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = -np.nansum(p * np.log2(p), axis=1) / math.log2(bins)
+    return entropy.reshape(rows, columns)
+
+
+class TiledAnalysis:
+    """Analisi di un'immagine grande: filtro, tile in batch e report unico"""
+
+    def __init__(self, medgemma, path, question=TILE_QUESTION, level=0, tile_size=None, max_tiles=64,
+                 filter_mode="tissue", min_score=None, batch_size=None):
+        self.medgemma = medgemma
+        self.path = path
+        self.question = question
+        self.level = level
+        preprocessor = medgemma.preprocessor
+        self.tile_size = tile_size or (preprocessor.target_size[0] if preprocessor is not None else 896)
+        self.max_tiles = max_tiles
+        self.filter_mode = filter_mode
+        self.min_score = MIN_SCORE[filter_mode] if min_score is None else min_score
+        self.batch_size = batch_size or medgemma.batch_size
+
+    def run(self):
+        """Esegue l'analisi e ritorna il report (dict)"""
+        start = time.perf_counter()
+        source = open_source(self.path)
+        try:
+            if not 0 <= self.level < len(source.levels):
+                raise ValueError(f"Livello {self.level} non disponibile (0-{len(source.levels) - 1})")
+
+            width, height = source.levels[self.level]
+            columns, rows = math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+            print(f"Immagine {width}x{height} (livello {self.level}): {rows * columns} tile da {self.tile_size}px")
+
+            thumbnail = source.thumbnail(max(1024, CELL_PIXELS * max(rows, columns)))
+            scores = tile_scores(self._pad_to_grid(thumbnail, width, rows, columns), rows, columns, self.filter_mode)
+            tiles = self._select(scores)
+            print(f"Tile con contenuto: {int((scores >= self.min_score).sum())} | analizzati: {len(tiles)}")
+
+            overview = self.medgemma.analyze_image(self._prepare(thumbnail), OVERVIEW_QUESTION)
+            findings = self._analyze_tiles(source, tiles)
+        finally:
+            source.close()
+
+        summary = self._summarize(overview, findings)
+        return {
+            "source": self.path,
+            "size": [width, height],
+            "level": self.level,
+            "tile_size": self.tile_size,
+            "filter": self.filter_mode,
+            "min_score": self.min_score,
+            "tiles_total": rows * columns,
+            "tiles_with_content": int((scores >= self.min_score).sum()),
+            "tiles_analyzed": len(findings),
+            "overview": overview,
+            "summary": summary,
+            "findings": findings,
+            "elapsed": time.perf_counter() - start,
+        }
+
+    def _pad_to_grid(self, thumbnail, width, rows, columns):
+        """Thumbnail esteso con vetro bianco fino ai bordi dei tile parziali"""
+        scale = thumbnail.width / width
+        size = (max(1, round(columns * self.tile_size * scale)), max(1, round(rows * self.tile_size * scale)))
+        if size == thumbnail.size:
+            return thumbnail
+        canvas = Image.new("RGB", size, "white")
+        canvas.paste(thumbnail, (0, 0))
+        return canvas
+
+    def _select(self, scores):
+        """Tile sopra soglia, i più ricchi di contenuto, in ordine di lettura"""
+        candidates = [
+            (float(scores[row, column]), row, column)
+            for row, column in zip(*(scores >= self.min_score).nonzero())
+        ]
+        candidates.sort(reverse=True)
+        return sorted(candidates[:self.max_tiles], key=lambda tile: (tile[1], tile[2]))
+
+    def _prepare(self, image):
+        preprocessor = self.medgemma.preprocessor
+        return preprocessor.prepare(image) if preprocessor is not None else image
+
+    def _read(self, source, row, column):
+        x, y = column * self.tile_size, row * self.tile_size
+        return self._prepare(source.read_region(self.level, x, y, self.tile_size, self.tile_size))
+
+    def _analyze_tiles(self, source, tiles):
+        """Legge i tile in anticipo mentre il batch corrente genera"""
+        findings = []
+        pending = deque()
+        depth = max(self.batch_size * 2, self.medgemma.prefetch)
+
+        with ThreadPoolExecutor(max_workers=self.medgemma.preprocess_workers) as executor:
+            queue = iter(tiles)
+            chunk = []
+
+            def refill():
+                while len(pending) < depth:
+                    tile = next(queue, None)
+                    if tile is None:
+                        return
+                    pending.append((tile, executor.submit(self._read, source, tile[1], tile[2])))
+
+            refill()
+            while pending:
+                tile, future = pending.popleft()
+                refill()
+                chunk.append((tile, future.result()))
+                if len(chunk) >= self.batch_size or not pending:
+                    findings.extend(self._analyze_chunk(chunk))
+                    print(f"[{len(findings)}/{len(tiles)}] tile analizzati")
+                    chunk = []
+
+        return findings
+
+    def _analyze_chunk(self, chunk):
+        results = self.medgemma.analyze_images([(image, self.question) for _, image in chunk], batch_size=self.batch_size)
+        findings = []
+        for ((score, row, column), _), result in zip(chunk, results):
+            findings.append({
+                "row": int(row),
+                "column": int(column),
+                "x": int(column) * self.tile_size,
+                "y": int(row) * self.tile_size,
+                "level": self.level,
+                "score": round(score, 3),
+                "response": result["response"],
+                "error": result["error"],
+            })
+        return findings
+
+    def _summarize(self, overview, findings):
+        """Sintesi testuale dei risultati per tile in un unico report"""
+        lines = [f"Overview: {overview}"]
+        for finding in findings:
+            if finding["response"]:
+                lines.append(f"- tile ({finding['x']}, {finding['y']}): {finding['response'][:400]}")
+        if len(lines) == 1:
+            return overview
+        return self.medgemma.analyze_text(f"{SUMMARY_QUESTION}\n\n" + "\n".join(lines))
+
+
+def default_output(path):
+    return os.path.join("results", "tiles", f"{Path(path).stem}.tiles.json")
+
+
+def save_report(report, output):
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    Path(output).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
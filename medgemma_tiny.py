@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Modello MedGemma in miniatura
+Gemma 3 image-text-to-text con pesi casuali, creato offline per benchmark e prove
+"""
+
+import json
+from pathlib import Path
+
+IMAGE_SIZE = 64
+PATCH_SIZE = 8
+IMAGE_TOKENS = 16
+
+SPECIAL_TOKENS = [
+    "<pad>", "<eos>", "<bos>", "<unk>",
+    "<start_of_turn>", "<end_of_turn>",
+    "<start_of_image>", "<end_of_image>", "<image_soft_token>",
+]
+
+# Stessa struttura del template Gemma 3: il sistema apre il primo turno utente
+CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{%- if messages[0]['role'] == 'system' -%}"
+    "{%- set system = messages[0]['content'][0]['text'] + '\\n\\n' -%}"
+    "{%- set messages = messages[1:] -%}"
+    "{%- else -%}{%- set system = '' -%}{%- endif -%}"
+    "{%- for message in messages -%}"
+    "{%- set role = 'model' if message['role'] == 'assistant' else message['role'] -%}"
+    "<start_of_turn>{{ role }}\n"
+    "{%- if loop.first %}{{ system }}{% endif -%}"
+    "{%- if message['content'] is string -%}{{ message['content'] }}"
+    "{%- else -%}{%- for item in message['content'] -%}"
+    "{%- if item['type'] == 'image' -%}<start_of_image>"
+    "{%- elif item['type'] == 'text' -%}{{ item['text'] }}{%- endif -%}"
+    "{%- endfor -%}{%- endif -%}"
+    "<end_of_turn>\n"
+    "{%- endfor -%}"
+    "{%- if add_generation_prompt -%}<start_of_turn>model\n{%- endif -%}"
+)
+
+
+def _build_tokenizer():
+    """Tokenizer byte-level senza merge: copre qualsiasi testo, nessun download"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    byte_chars = sorted(set(pre_tokenizers.ByteLevel.alphabet()))
+    vocab = {token: index for index, token in enumerate(SPECIAL_TOKENS + byte_chars)}
+
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<bos>",
+        eos_token="<eos>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+        additional_special_tokens=SPECIAL_TOKENS[4:],
+        extra_special_tokens={
+            "boi_token": "<start_of_image>",
+            "eoi_token": "<end_of_image>",
+            "image_token": "<image_soft_token>",
+        },
+        padding_side="left",
+    )
+    return tokenizer
+
+
+def _text_config(vocab_size, hidden_size, layers, tokenizer):
+    from transformers import Gemma3TextConfig
+
+    return Gemma3TextConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        head_dim=hidden_size // 2,
+        max_position_embeddings=4096,
+        sliding_window=512,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=[tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")],
+    )
+
+
+def create_tiny_model(path, hidden_size=64, layers=2, seed=0):
+    """Salva in path un modello + processor con la stessa interfaccia di MedGemma"""
+    import torch
+    from transformers import (
+        Gemma3Config, Gemma3ForConditionalGeneration, Gemma3ImageProcessor,
+        Gemma3Processor, SiglipVisionConfig
+    )
+
+    path = Path(path)
+    torch.manual_seed(seed)
+
+    tokenizer = _build_tokenizer()
+    vocab_size = len(tokenizer)
+
+    vision_config = SiglipVisionConfig(
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        image_size=IMAGE_SIZE,
+        patch_size=PATCH_SIZE,
+        vision_use_head=False,
+    )
+    config = Gemma3Config(
+        text_config=_text_config(vocab_size, hidden_size, layers, tokenizer).to_dict(),
+        vision_config=vision_config.to_dict(),
+        mm_tokens_per_image=IMAGE_TOKENS,
+        boi_token_index=tokenizer.convert_tokens_to_ids("<start_of_image>"),
+        eoi_token_index=tokenizer.convert_tokens_to_ids("<end_of_image>"),
+        image_token_index=tokenizer.convert_tokens_to_ids("<image_soft_token>"),
+    )
+
+    model = Gemma3ForConditionalGeneration(config).eval()
+    model.generation_config.eos_token_id = config.text_config.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+
+    image_processor = Gemma3ImageProcessor(size={"height": IMAGE_SIZE, "width": IMAGE_SIZE})
+    processor = Gemma3Processor(
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        chat_template=CHAT_TEMPLATE,
+        image_seq_length=IMAGE_TOKENS,
+    )
+
+    model.save_pretrained(path)
+    processor.save_pretrained(path)
+    (path / "tiny_model.json").write_text(
+        json.dumps({"hidden_size": hidden_size, "layers": layers, "seed": seed}, indent=2),
+        encoding="utf-8"
+    )
+    return path
+
+
+def create_tiny_draft_model(path, target_path, hidden_size=32, layers=1, seed=1):
+    """Modello di solo testo con lo stesso tokenizer, usabile come draft"""
+    import torch
+    from transformers import AutoTokenizer, Gemma3ForCausalLM
+
+    path = Path(path)
+    torch.manual_seed(seed)
+
+    tokenizer = AutoTokenizer.from_pretrained(target_path)
+    config = _text_config(len(tokenizer), hidden_size, layers, tokenizer)
+
+    model = Gemma3ForCausalLM(config).eval()
+    model.generation_config.eos_token_id = config.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
+
+
+def ensure_tiny_model(path, draft_path=None):
+    """Crea il modello in miniatura (ed eventualmente il draft) se mancano"""
+    path = Path(path)
+    if not (path / "tiny_model.json").exists():
+        print(f"Creazione modello in miniatura in {path}...")
+        create_tiny_model(path)
+    if draft_path is not None and not (Path(draft_path) / "config.json").exists():
+        print(f"Creazione draft in miniatura in {draft_path}...")
+        create_tiny_draft_model(draft_path, path)
+    return path
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Sessioni immagine MedGemma
+Vision encoder eseguito una volta per immagine, più domande sulle stesse feature
+"""
+
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from medgemma_cache import image_digest
+
+# Usata solo per generare i token segnaposto dell'immagine nel prompt:
+# senza pan & scan il loro numero non dipende dall'immagine
+PLACEHOLDER_IMAGE = Image.new("RGB", (1, 1))
+
+
+def image_token_id(model):
+    config = model.config
+    return getattr(config, "image_token_id", None) or getattr(config, "image_token_index")
+
+
+def encode_image(model, pixel_values):
+    """Feature visive proiettate nello spazio del modello di linguaggio"""
+    import torch
+
+    with torch.no_grad():
+        return model.get_image_features(pixel_values=pixel_values)
+
+
+def embed_with_image_features(model, input_ids, image_features):
+    """Embedding del prompt con le feature visive al posto dei token immagine"""
+    import torch
+
+    mask = input_ids == image_token_id(model)
+    ids = input_ids.clone()
+    # Come nel forward di Gemma 3: il token immagine può essere fuori vocabolario
+    ids[mask] = 0
+
+    with torch.no_grad():
+        embeds = model.get_input_embeddings()(ids)
+        features = image_features.to(embeds.device, embeds.dtype)
+        return embeds.masked_scatter(mask.unsqueeze(-1).expand_as(embeds), features)
+
+
+class VisionFeatureCache:
+    """LRU delle feature visive, indicizzate per hash dei pixel"""
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, features):
+        with self._lock:
+            self._entries[key] = features
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class ImageSession:
+    """Un'immagine aperta su cui fare più domande
+
+    Le feature visive sono calcolate all'apertura; ogni domanda paga
+    solo il prefill del testo e la generazione.
+    """
+
+    def __init__(self, medgemma, image, name=None):
+        self.medgemma = medgemma
+        self.image = image
+        self.name = name
+        self.digest = image_digest(image)
+        self.features = medgemma.image_features(image, digest=self.digest)
+        self.questions = 0
+
+    def ask(self, question):
+        """Risposta completa a una domanda sull'immagine"""
+        self.questions += 1
+        return self.medgemma.analyze_image(self.image, question, image_features=self.features)
+
+    def ask_stream(self, question):
+        """Come ask, ma restituisce il testo a pezzi"""
+        self.questions += 1
+        return self.medgemma.analyze_image_stream(self.image, question, image_features=self.features)
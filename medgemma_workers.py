@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Pool di worker CPU MedGemma
+Processi figli creati con fork dopo il caricamento: i pesi sono condivisi copy-on-write
+"""
+
+import gc
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from medgemma_cancel import CancelToken, activate, describe, truncation_note
+
+
+def _pin_worker(index, threads):
+    """Limita il worker ai suoi thread e core per non sovraccaricare la CPU"""
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Già impostato nel processo padre prima del fork
+        pass
+
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        assigned = cores[index * threads:(index + 1) * threads]
+        if len(assigned) == threads:
+            os.sched_setaffinity(0, assigned)
+
+
+def _worker_main(medgemma, index, threads, tasks, results, cancelled):
+    """Ciclo del processo worker: riceve (id, immagine o sorgente, domanda, deadline)
+
+    cancelled è l'id dell'ultima richiesta annullata dal padre per questo
+    worker, controllato a ogni passo di decodifica.
+    """
+    _pin_worker(index, threads)
+
+    # Pool di thread e sessioni HTTP non sopravvivono al fork: si ricreano
+    medgemma._setup_preprocessor()
+    medgemma._setup_fetcher()
+    # Anche il thread scrittore dell'archivio: ogni worker ha il suo (WAL)
+    medgemma._setup_results()
+    # Il file Prometheus resta del padre; i log JSON sono per riga e condivisibili
+    medgemma.metrics.prometheus_path = None
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            if medgemma.results is not None:
+                medgemma.results.close()
+            break
+
+        task_id, image, question, deadline = task
+        token = CancelToken(deadline, check=lambda task_id=task_id: cancelled.value == task_id)
+        try:
+            if token.cancelled:
+                # Scaduta o annullata mentre attendeva il worker
+                result = {"response": None, "error": f"Richiesta annullata: {describe(token.reason)}", "truncated": token.reason}
+            else:
+                if isinstance(image, str):
+                    image = medgemma.load_image(image)
+                with activate(token):
+                    response = medgemma.analyze_image(image, question)
+                if response.startswith("Errore durante analisi:"):
+                    result = {"response": None, "error": response, "truncated": None}
+                else:
+                    if token.truncated:
+                        # Il flag viaggia nel dict, non nel testo
+                        response = response[:-len(truncation_note(token.truncated))]
+                    result = {"response": response, "error": None, "truncated": token.truncated}
+        except Exception as e:
+            result = {"response": None, "error": f"Errore worker {index}: {e}", "truncated": None}
+
+        results.put((task_id, index, result))
+
+
+def on_cpu(model):
+    """True se tutti i pesi sono in RAM (anche con device_map)"""
+    device_map = getattr(model, "hf_device_map", None)
+    if device_map:
+        return all(str(device) in ("cpu", "disk") for device in device_map.values())
+    return model.device.type == "cpu"
+
+
+class WorkerPool:
+    """Dispatcher verso N processi che condividono i pesi del modello
+
+    Va creato subito dopo il caricamento del modello e prima di qualsiasi
+    generazione nel processo padre: il fork copia solo le pagine che i
+    figli modificano, e i pesi in inferenza non vengono mai scritti.
+    """
+
+    def __init__(self, medgemma, workers, threads_per_worker=0):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Il pool di worker richiede fork (Linux/macOS)")
+
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        self.workers = workers
+        self.threads = threads_per_worker or max(1, cpu_count // workers)
+
+        # Attende l'eventuale caricamento in background (FAST_START)
+        if medgemma.pipe is None:
+            raise RuntimeError("Modello non caricato")
+        if not on_cpu(medgemma.pipe.model):
+            # Un processo figlio non può riusare il contesto CUDA del padre
+            raise RuntimeError("Il pool di worker richiede il modello su CPU")
+
+        # Sposta gli oggetti esistenti fuori dal GC: le sue scansioni
+        # toccherebbero le pagine condivise causando copie inutili
+        gc.collect()
+        gc.freeze()
+
+        context = multiprocessing.get_context("fork")
+        self._results = context.Queue()
+        self._tasks = []
+        self._processes = []
+        self._cancelled = []
+        for index in range(workers):
+            tasks = context.Queue()
+            cancelled = context.Value("q", -1, lock=False)
+            process = context.Process(
+                target=_worker_main,
+                args=(medgemma, index, self.threads, tasks, self._results, cancelled),
+                name=f"medgemma-worker-{index}",
+                daemon=True
+            )
+            process.start()
+            self._tasks.append(tasks)
+            self._processes.append(process)
+            self._cancelled.append(cancelled)
+
+        gc.unfreeze()
+
+        self._ids = itertools.count()
+        self._pending = {}
+        self._inflight = [0] * workers
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._collector = threading.Thread(target=self._collect, daemon=True, name="medgemma-pool-collector")
+        self._collector.start()
+
+        print(f"Pool di {workers} worker avviato ({self.threads} thread ciascuno)")
+
+    def submit(self, image, question, deadline=None):
+        """Invia una richiesta al worker con meno richieste in corso
+
+        image può essere un'immagine PIL oppure un path/URL caricato dal
+        worker stesso; deadline è un istante time.time(). Ritorna un Future
+        con {"response", "error", "truncated"}, annullabile con cancel.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Pool chiuso")
+            index = min(range(self.workers), key=self._inflight.__getitem__)
+            if self._inflight[index] == float("inf"):
+                raise RuntimeError("Nessun worker attivo")
+            task_id = next(self._ids)
+            self._pending[task_id] = (future, index)
+            self._inflight[index] += 1
+
+        future.task_id = task_id
+        self._tasks[index].put((task_id, image, question, deadline))
+        return future
+
+    def cancel(self, future):
+        """Interrompe la richiesta: il worker restituisce la risposta parziale"""
+        with self._lock:
+            entry = self._pending.get(getattr(future, "task_id", None))
+            if entry is not None:
+                self._cancelled[entry[1]].value = future.task_id
+
+    def map(self, items):
+        """Analizza coppie (immagine, domanda), risultati nell'ordine dell'input"""
+        futures = [self.submit(image, question) for image, question in items]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "threads_per_worker": self.threads,
+                "inflight": list(self._inflight),
+                "alive": [process.is_alive() for process in self._processes],
+            }
+
+    def close(self):
+        """Chiude i worker dopo le richieste in corso (e i loro record di archivio)"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=30)
+
+    def _collect(self):
+        """Risolve i Future con i risultati dei worker e rileva worker morti"""
+        while True:
+            try:
+                task_id, index, result = self._results.get(timeout=1)
+            except queue.Empty:
+                self._fail_dead_workers()
+                if self._closed and not self._pending:
+                    return
+                continue
+
+            with self._lock:
+                entry = self._pending.pop(task_id, None)
+                if entry is not None:
+                    self._inflight[index] -= 1
+            # Risultato tardivo di una richiesta già chiusa (worker dato per morto)
+            if entry is not None:
+                entry[0].set_result(result)
+
+    def _fail_dead_workers(self):
+        dead = {index for index, process in enumerate(self._processes) if not process.is_alive()}
+        if not dead:
+            return
+
+        with self._lock:
+            failed = [(task_id, future) for task_id, (future, index) in self._pending.items() if index in dead]
+            for task_id, _ in failed:
+                self._pending.pop(task_id)
+            for index in dead:
+                # Un worker morto non riceve più richieste
+                self._inflight[index] = float("inf")
+
+        for _, future in failed:
+            future.set_result({"response": None, "error": "Errore worker: processo terminato"})
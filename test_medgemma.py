@@ -6,13 +6,46 @@ Analisi immagini mediche con AI specializzata
 
 import os
 import sys
+import time
+import asyncio
+import threading
+import io
+import atexit
+import signal
+import contextlib
 from pathlib import Path
 from dotenv import load_dotenv
-from huggingface_hub import login
-from transformers import pipeline
 from PIL import Image
-import requests
-import torch
+
+# torch, transformers e huggingface_hub sono importati al primo uso:
+# il solo import di torch costa secondi all'avvio
+
+from medgemma_cache import ResponseCache, image_digest, make_key
+from medgemma_preprocess import ImagePreprocessor, processor_target_size
+from medgemma_fetch import ImageFetcher
+from medgemma_snapshot import export_snapshot, load_snapshot, read_manifest
+from medgemma_quant import QUANTIZED_DTYPES, is_quantized, quantize_model, run_quant_report
+from medgemma_engine import PrefixCache, prefill
+from medgemma_vision import (
+    ImageSession, VisionFeatureCache, PLACEHOLDER_IMAGE, encode_image, embed_with_image_features
+)
+from medgemma_metrics import Metrics, StepClock
+from medgemma_dicom import DicomLoader, is_dicom_source, split_frame
+from medgemma_speculative import load_draft_model, speculative_generate
+from medgemma_cancel import (
+    CancelCriteria, CancelToken, activate as activate_token, current as current_token, describe, truncation_note
+)
+from medgemma_resources import MIN_NEW_TOKENS, ResourcePlanner, is_oom, model_parameters, release_memory
+from medgemma_compile import (
+    ATTN_IMPLEMENTATIONS, COMPILE_MODES, WARMUP_QUESTION, configure_cache_dir, enable_compile, load_cache_artifacts, supports_compile, warmup
+)
+from medgemma_conversation import Conversation, ConversationStore
+from medgemma_store import ResultStore
+
+SYSTEM_PROMPT = "You are an expert medical AI assistant. Provide detailed, accurate analysis of medical images. Always mention limitations and recommend professional consultation."
+
+# Token immagine stimati per Gemma 3 se il processor non li espone
+DEFAULT_IMAGE_TOKENS = 256
 
 class MedGemmaTest:
     def __init__(self):
@@ -20,21 +53,155 @@ class MedGemmaTest:
         print("INIZIALIZZAZIONE MEDGEMMA")
         print("=" * 50)
         
+        # Tempi dell'ultima richiesta in streaming
+        self.last_timings = {}
+        
+        # Statistiche dell'ultima decodifica assistita
+        self.last_assisted = {}
+        
+        # Tempi di avvio per fase
+        self.startup_timings = {}
+        self._startup_start = time.perf_counter()
+        
+        self._pipe = None
+        self.draft = None
+        self.compile_report = None
+        # Argomenti di generate() per la decodifica compilata (solo richieste senza cache propria)
+        self.compile_kwargs = {}
+        self.prefix_cache = PrefixCache()
+        self.session = None
+        self.conversation = None
+        self.worker_pool = None
+        self._model_thread = None
+        self._model_failed = False
+        self.preprocessor = None
+        
         # Carica configurazione
-        self._load_config()
+        self._timed("config", self._load_config)
+        self.vision_cache = VisionFeatureCache(self.vision_cache_size)
+        self.conversations = ConversationStore(
+            idle_seconds=self.conversation_idle_minutes * 60,
+            max_mb=self.conversation_memory_mb,
+            max_sessions=self.conversation_max
+        )
+        self._setup_metrics()
+        self.dicom = DicomLoader(
+            window=self.dicom_window,
+            frame=int(self.dicom_frame) if self.dicom_frame.isdigit() else self.dicom_frame
+        )
+        
+        # Autentica Hugging Face (saltata se il modello è già in cache)
+        if not self.offline:
+            self._timed("authenticate", self._authenticate)
+        elif self.debug:
+            print("Modello in cache locale: modalità offline, login saltato")
+        
+        if self.fast_start:
+            # Hardware e modello in background, il resto prosegue in parallelo
+            self._model_thread = threading.Thread(target=self._load_model_background, daemon=True)
+            self._model_thread.start()
+        else:
+            # Verifica hardware
+            self._timed("hardware", self._check_hardware)
+            
+            # Carica modello
+            self._timed("model", self._load_model)
+            self._timed("compile", self._setup_compile)
+        
+        # Cache risposte
+        self._timed("cache", self._setup_cache)
+        
+        # Archivio SQLite delle analisi
+        self._timed("results", self._setup_results)
         
-        # Autentica Hugging Face
-        self._authenticate()
+        # Preprocessing immagini
+        self._timed("preprocessor", self._setup_preprocessor)
         
-        # Verifica hardware
-        self._check_hardware()
+        # Download immagini
+        self._timed("fetcher", self._setup_fetcher)
         
-        # Carica modello
-        self._load_model()
+        self.startup_timings["ready"] = time.perf_counter() - self._startup_start
         
-        print("MedGemma pronto per l'uso!")
+        if self.fast_start:
+            print("MedGemma pronto, modello in caricamento in background...")
+        else:
+            print("MedGemma pronto per l'uso!")
+        if self.debug:
+            self.print_startup_timings()
         print("=" * 50)
 
+    @property
+    def pipe(self):
+        """Pipeline del modello; in fast start attende il caricamento"""
+        if self._model_thread is not None:
+            if self._model_thread.is_alive():
+                print("Attendo il caricamento del modello...")
+            self._model_thread.join()
+            self._model_thread = None
+            if self.debug:
+                self.print_startup_timings()
+        
+        if self._model_failed:
+            sys.exit(1)
+        return self._pipe
+
+    @pipe.setter
+    def pipe(self, value):
+        self._pipe = value
+
+    def _timed(self, name, step):
+        """Esegue una fase di avvio registrandone la durata"""
+        start = time.perf_counter()
+        try:
+            return step()
+        finally:
+            self.startup_timings[name] = time.perf_counter() - start
+
+    def _load_model_background(self):
+        """Verifica hardware e carica il modello fuori dal thread principale"""
+        try:
+            self._timed("hardware", self._check_hardware)
+            self._timed("model", self._load_model)
+            self._timed("compile", self._setup_compile)
+        except SystemExit:
+            # sys.exit in un thread non termina il processo: lo segnala pipe
+            self._model_failed = True
+        self.startup_timings["model_ready"] = time.perf_counter() - self._startup_start
+
+    def print_startup_timings(self):
+        """Stampa la ripartizione dei tempi di avvio"""
+        print("Tempi di avvio:")
+        for name, seconds in self.startup_timings.items():
+            print(f"  {name:<14} {seconds:6.2f}s")
+
+    def _cached_snapshot(self):
+        """Path dello snapshot locale del modello, se già scaricato
+        
+        Legge direttamente la cache di Hugging Face senza importare
+        huggingface_hub, così la modalità offline può essere impostata
+        prima dei grandi import.
+        """
+        if self._snapshot_manifest() is not None:
+            return self.snapshot_dir
+        
+        if os.path.isdir(self.model_name):
+            return self.model_name
+        
+        hub_cache = os.getenv("HF_HUB_CACHE") or os.path.join(
+            os.getenv("HF_HOME", os.path.join(Path.home(), ".cache", "huggingface")), "hub"
+        )
+        repo_dir = Path(hub_cache) / ("models--" + self.model_name.replace("/", "--"))
+        ref = repo_dir / "refs" / "main"
+        
+        try:
+            snapshot = repo_dir / "snapshots" / ref.read_text().strip()
+        except OSError:
+            return None
+        
+        if (snapshot / "config.json").exists():
+            return str(snapshot)
+        return None
+
     def _load_config(self):
         """Carica configurazione da .env"""
         load_dotenv()
@@ -42,12 +209,129 @@ class MedGemmaTest:
         self.hf_token = os.getenv("HF_TOKEN")
         self.model_name = os.getenv("MODEL_NAME", "google/medgemma-4b-it")
         self.device = os.getenv("DEVICE", "auto")
-        self.torch_dtype = os.getenv("TORCH_DTYPE", "bfloat16")
+        self.torch_dtype = os.getenv("TORCH_DTYPE", "auto")
+        self.snapshot_dir = os.getenv("SNAPSHOT_DIR", "")
         self.max_tokens = int(os.getenv("MAX_NEW_TOKENS", "500"))
         self.temperature = float(os.getenv("TEMPERATURE", "0.1"))
         self.debug = os.getenv("DEBUG", "true").lower() == "true"
+        self.streaming = os.getenv("STREAMING", "true").lower() == "true"
+        self.prefix_caching = os.getenv("PREFIX_CACHE", "true").lower() == "true"
+        self.vision_cache_size = int(os.getenv("VISION_CACHE_SIZE", "8"))
+        self.request_timeout = float(os.getenv("REQUEST_TIMEOUT", "0"))
+        
+        # Conversazioni a più turni (KV cache conservata fra i turni)
+        self.conversation_idle_minutes = float(os.getenv("CONVERSATION_IDLE_MINUTES", "30"))
+        self.conversation_memory_mb = int(os.getenv("CONVERSATION_MEMORY_MB", "1024"))
+        self.conversation_max = int(os.getenv("CONVERSATION_MAX", "16"))
+        
+        # Indice casi simili (embedding del vision encoder)
+        self.index_dir = os.getenv("INDEX_DIR", "results/index")
+        self.index_nprobe = int(os.getenv("INDEX_NPROBE", "8"))
+        
+        # Decodifica assistita (draft model)
+        self.draft_model_name = os.getenv("DRAFT_MODEL_NAME", "")
+        self.draft_tokens = int(os.getenv("DRAFT_TOKENS", "5"))
+        self.draft_verify = os.getenv("DRAFT_VERIFY", "false").lower() == "true"
+        
+        # Esecuzione
+        self.compile = os.getenv("COMPILE", "false").lower() == "true"
+        self.compile_mode = os.getenv("COMPILE_MODE", "default")
+        self.compile_cache_dir = os.getenv("COMPILE_CACHE_DIR", "results/compile_cache")
+        self.compile_warmup_tokens = int(os.getenv("COMPILE_WARMUP_TOKENS", "16"))
+        self.compile_compare = os.getenv("COMPILE_COMPARE", "true").lower() == "true"
+        self.attn_implementation = os.getenv("ATTN_IMPLEMENTATION", "auto")
+        self.torch_threads = int(os.getenv("TORCH_NUM_THREADS", "0"))
+        
+        # Avvio rapido
+        self.fast_start = os.getenv("FAST_START", "false").lower() == "true"
+        self.offline_mode = os.getenv("OFFLINE_MODE", "auto").lower()
+        
+        # Batching
+        self.batch_size = int(os.getenv("BATCH_SIZE", "4"))
+        self.batch_token_budget = int(os.getenv("BATCH_TOKEN_BUDGET", "8192"))
+        
+        # Cache risposte
+        self.cache_enabled = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+        self.cache_dir = os.getenv("CACHE_DIR", "results/cache")
+        self.cache_memory_mb = int(os.getenv("CACHE_MEMORY_MB", "64"))
+        self.cache_disk_mb = int(os.getenv("CACHE_DISK_MB", "512"))
+        
+        # Archivio risultati (SQLite)
+        self.results_db = os.getenv("RESULTS_DB", "results/results.db")
+        self.results_batch = int(os.getenv("RESULTS_BATCH", "256"))
+        self.results_flush_seconds = float(os.getenv("RESULTS_FLUSH_SECONDS", "1"))
+        
+        # DICOM
+        self.dicom_window = os.getenv("DICOM_WINDOW", "auto")
+        self.dicom_frame = os.getenv("DICOM_FRAME", "middle")
+        
+        # Preprocessing immagini
+        self.preprocess = os.getenv("PREPROCESS", "true").lower() == "true"
+        self.preprocess_workers = int(os.getenv("PREPROCESS_WORKERS", "4"))
+        self.prefetch = int(os.getenv("PREFETCH", "4"))
         
-        if not self.hf_token or self.hf_token.startswith("hf_xxx"):
+        # Download immagini
+        self.fetch_connect_timeout = float(os.getenv("FETCH_CONNECT_TIMEOUT", "5"))
+        self.fetch_read_timeout = float(os.getenv("FETCH_READ_TIMEOUT", "30"))
+        self.fetch_max_mb = int(os.getenv("FETCH_MAX_MB", "50"))
+        self.fetch_concurrency = int(os.getenv("FETCH_CONCURRENCY", "8"))
+        self.fetch_cache = os.getenv("FETCH_CACHE", "true").lower() == "true"
+        self.fetch_cache_dir = os.getenv("FETCH_CACHE_DIR", "results/downloads")
+        self.fetch_cache_mb = int(os.getenv("FETCH_CACHE_MB", "1024"))
+        
+        # Pool di worker CPU
+        self.workers = int(os.getenv("WORKERS", "0"))
+        self.threads_per_worker = int(os.getenv("THREADS_PER_WORKER", "0"))
+        
+        # Server HTTP
+        self.server_host = os.getenv("SERVER_HOST", "127.0.0.1")
+        self.server_port = int(os.getenv("SERVER_PORT", "8000"))
+        self.server_max_queue = int(os.getenv("SERVER_MAX_QUEUE", "64"))
+        self.server_batch_wait_ms = int(os.getenv("SERVER_BATCH_WAIT_MS", "10"))
+        self.server_max_upload_mb = int(os.getenv("SERVER_MAX_UPLOAD_MB", "50"))
+        
+        # Metriche
+        self.metrics_enabled = os.getenv("METRICS", "true").lower() == "true"
+        self.metrics_log = os.getenv("METRICS_LOG", "results/metrics.jsonl")
+        self.metrics_prom_file = os.getenv("METRICS_PROM_FILE", "results/metrics.prom")
+        self.slow_request_ms = int(os.getenv("SLOW_REQUEST_MS", "0"))
+        self.slow_request_log = os.getenv("SLOW_REQUEST_LOG", "results/slow_requests.jsonl")
+        
+        # Risorse: dtype, device e limiti dalla memoria misurata
+        self.auto_resources = os.getenv("AUTO_RESOURCES", "true").lower() == "true"
+        self._plan_resources()
+        
+        # Offline se richiesto, o in auto quando lo snapshot è già in cache
+        if self.offline_mode == "true":
+            self.offline = True
+        elif self.offline_mode == "auto":
+            self.offline = self._cached_snapshot() is not None
+        else:
+            self.offline = False
+        
+        if self.offline:
+            # Va impostato prima dell'import di transformers/huggingface_hub
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            os.environ["TRANSFORMERS_OFFLINE"] = "1"
+        
+        if self.attn_implementation not in ATTN_IMPLEMENTATIONS:
+            print(f"ATTN_IMPLEMENTATION={self.attn_implementation} non valido, uso auto")
+            self.attn_implementation = "auto"
+        if self.compile_mode not in COMPILE_MODES:
+            print(f"COMPILE_MODE={self.compile_mode} non valido, uso default")
+            self.compile_mode = "default"
+        
+        if self.compile:
+            if is_quantized(self.torch_dtype):
+                print(f"COMPILE non supportato con TORCH_DTYPE={self.torch_dtype}, esecuzione eager")
+                self.compile = False
+            else:
+                # Come l'offline, va impostato prima dell'import di torch
+                configure_cache_dir(self.compile_cache_dir)
+                # La KV cache dinamica del prefisso escluderebbe la decodifica compilata
+                self.prefix_caching = False
+        
+        if not self.offline and (not self.hf_token or self.hf_token.startswith("hf_xxx")):
             print("ERRORE: HF_TOKEN non configurato!")
             print("Vai su https://huggingface.co/settings/tokens")
             print("Crea un nuovo token e aggiorna il file .env")
@@ -57,10 +341,62 @@ class MedGemmaTest:
             print(f"Modello: {self.model_name}")
             print(f"Device: {self.device}")
             print(f"Dtype: {self.torch_dtype}")
+            if self.compile:
+                print(f"Esecuzione compilata: {self.compile_mode} (cache {self.compile_cache_dir})")
+
+    def _plan_resources(self):
+        """Risolve TORCH_DTYPE/DEVICE "auto" e limita batch e immagini alla memoria
+        
+        Non importa torch: la GPU è interrogata con nvidia-smi.
+        """
+        self.max_memory = None
+        self.resource_plan = None
+        self.resources = ResourcePlanner(model_parameters(self.snapshot_dir or self.model_name))
+        
+        if not self.auto_resources:
+            if self.torch_dtype == "auto":
+                self.torch_dtype = "bfloat16"
+            return
+        
+        manifest = read_manifest(self.snapshot_dir) if self.snapshot_dir else None
+        plan = self.resources.plan(
+            dtype=self.torch_dtype,
+            device=self.device,
+            batch_size=self.batch_size,
+            token_budget=self.batch_token_budget,
+            max_new_tokens=self.max_tokens,
+            preferred_dtype=(manifest or {}).get("dtype")
+        )
+        self.resource_plan = plan
+        self.torch_dtype, self.device, self.max_memory = plan.dtype, plan.device, plan.max_memory
+        self.batch_size, self.batch_token_budget = plan.batch_size, plan.token_budget
+        
+        if self.debug:
+            print("Piano risorse:")
+            for note in plan.notes:
+                print(f"  {note}")
+            print(f"  batch {plan.batch_size}, budget {plan.token_budget} token, "
+                  f"immagini fino a {plan.max_image_pixels / 1e6:.0f} Mpx")
+
+    def print_resources(self):
+        """Piano risorse e riduzioni applicate dopo gli out of memory"""
+        print(f"Dtype: {self.torch_dtype} | Device: {self.device}" + (" (offload su CPU)" if self.max_memory else ""))
+        print(f"Batch: {self.batch_size} | Budget token: {self.batch_token_budget} | Risposta: {self.max_tokens} token")
+        if self.resource_plan is not None:
+            for note in self.resource_plan.notes:
+                print(f"  {note}")
+        if not self.resources.downgrades:
+            print("Nessuna riduzione per memoria")
+            return
+        print("Riduzioni per memoria:")
+        for event in self.resources.downgrades:
+            print(f"  {event['time']} {event['what']}: {event['from']} -> {event['to']}")
 
     def _authenticate(self):
         """Autentica con Hugging Face"""
         try:
+            from huggingface_hub import login
+            
             print("Autenticazione Hugging Face...")
             login(token=self.hf_token, add_to_git_credential=False)
             print("Autenticazione riuscita")
@@ -70,6 +406,8 @@ class MedGemmaTest:
 
     def _check_hardware(self):
         """Verifica hardware disponibile"""
+        import torch
+        
         print("Controllo hardware...")
         
         # Check CUDA
@@ -98,118 +436,1284 @@ class MedGemmaTest:
             print("Installa psutil per monitoraggio RAM: pip install psutil")
 
     def _load_model(self):
-        """Carica il modello MedGemma"""
-        try:
-            print(f"Caricamento {self.model_name}...")
-            print("Questo può richiedere alcuni minuti la prima volta...")
-            
-            # Configura dtype
-            dtype_map = {
-                "bfloat16": torch.bfloat16,
-                "float16": torch.float16,
-                "float32": torch.float32
-            }
-            torch_dtype = dtype_map.get(self.torch_dtype, torch.bfloat16)
-            
+        """Carica il modello MedGemma
+        
+        Se la memoria non basta riprova con le configurazioni più leggere
+        del piano risorse (offload, poi CPU con dtype ridotti) invece di
+        terminare.
+        """
+        attempts = [(self.torch_dtype, self.device, self.max_memory)]
+        if self.auto_resources:
+            attempts += self.resources.fallbacks(self.torch_dtype, self.device, self.max_memory)
+        
+        for attempt, (dtype, device, max_memory) in enumerate(attempts):
+            self.torch_dtype, self.device, self.max_memory = dtype, device, max_memory
+            try:
+                self._load_pipeline()
+                print("Modello caricato con successo!")
+                return
+            except Exception as e:
+                out_of_memory = is_oom(e) or "memory" in str(e).lower()
+                if out_of_memory and attempt + 1 < len(attempts):
+                    next_dtype, next_device, _ = attempts[attempt + 1]
+                    self.resources.downgrade("modello", f"{dtype}/{device}", f"{next_dtype}/{next_device}", e)
+                    self._pipe = None
+                    release_memory()
+                    continue
+                
+                print(f"Errore caricamento modello: {e}")
+                
+                # Suggerimenti troubleshooting
+                if "gated" in str(e).lower():
+                    print("\nMODELLO GATED - RICHIEDI ACCESSO:")
+                    print(f"1. Vai su https://huggingface.co/{self.model_name}")
+                    print("2. Click 'Request access'")
+                    print("3. Compila il form e aspetta approvazione")
+                    
+                elif out_of_memory:
+                    print("\nERRORE MEMORIA anche con la configurazione più leggera:")
+                    print("1. Chiudi altre applicazioni")
+                    print("2. Libera RAM/VRAM o usa una macchina più grande")
+                    
+                sys.exit(1)
+
+    def _load_pipeline(self):
+        """Carica pipeline e pesi con dtype e device correnti"""
+        import torch
+        from transformers import pipeline
+        
+        print(f"Caricamento {self.model_name}...")
+        print("Questo può richiedere alcuni minuti la prima volta...")
+        
+        # Configura dtype
+        dtype_map = {
+            "bfloat16": torch.bfloat16,
+            "float16": torch.float16,
+            "float32": torch.float32
+        }
+        torch_dtype = dtype_map.get(self.torch_dtype, torch.bfloat16)
+        device_map = self.device
+        
+        model_kwargs = {}
+        if self.max_memory:
+            # Offload: layer in VRAM fin dove entrano, il resto in RAM
+            model_kwargs["max_memory"] = self.max_memory
+        
+        if self.torch_threads > 0:
+            torch.set_num_threads(self.torch_threads)
+        
+        attn_implementation = None if self.attn_implementation == "auto" else self.attn_implementation
+        if attn_implementation:
+            model_kwargs["attn_implementation"] = attn_implementation
+        
+        if is_quantized(self.torch_dtype):
+            # Quantizzazione dinamica: si parte dal float32 su CPU
+            torch_dtype = torch.float32
+            if device_map not in ("auto", "cpu"):
+                print(f"TORCH_DTYPE={self.torch_dtype} è solo CPU, ignoro DEVICE={self.device}")
+            device_map = "cpu"
+        
+        manifest = self._snapshot_manifest()
+        if manifest is not None:
+            # Snapshot locale: pesi in memory-map, nessuna risoluzione dal hub
+            print(f"Caricamento snapshot da {self.snapshot_dir}...")
+            self.pipe = load_snapshot(
+                self.snapshot_dir, device_map=device_map, attn_implementation=attn_implementation
+            )
+        else:
             # Carica pipeline
             self.pipe = pipeline(
                 "image-text-to-text",
                 model=self.model_name,
                 torch_dtype=torch_dtype,
-                device_map=self.device,
+                device_map=device_map,
+                model_kwargs=model_kwargs or None,
                 trust_remote_code=True  # Necessario per alcuni modelli
             )
+        
+        if is_quantized(self.torch_dtype):
+            print(f"Quantizzazione {self.torch_dtype}: {QUANTIZED_DTYPES[self.torch_dtype]}...")
+            layers = quantize_model(self._pipe.model, self.torch_dtype)
+            print(f"{layers} layer Linear quantizzati")
+        
+        if self.draft_model_name:
+            self._load_draft_model()
+        
+        # Tempi del vision encoder nelle metriche
+        self.metrics.instrument_vision(self._pipe.model)
+        
+        # Allinea il preprocessing alla risoluzione del processor
+        if self.preprocessor is not None:
+            self.preprocessor.target_size = processor_target_size(self._pipe.processor)
+
+    def _load_draft_model(self):
+        """Carica il draft per la decodifica assistita; se fallisce resta greedy"""
+        try:
+            print(f"Caricamento draft {self.draft_model_name}...")
+            self.draft = load_draft_model(self.draft_model_name, self._pipe.model, self._pipe.processor.tokenizer)
+            print(f"Decodifica assistita attiva ({self.draft_tokens} token per passo)")
+        except Exception as e:
+            self.draft = None
+            print(f"Draft non disponibile, decodifica greedy standard: {e}")
+
+    def _setup_compile(self):
+        """Attiva la decodifica compilata e la scalda prima delle richieste
+        
+        I grafi sono in COMPILE_CACHE_DIR: solo il primo avvio paga la
+        compilazione. Se qualcosa fallisce si resta in esecuzione eager.
+        """
+        if not self.compile or self._pipe is None:
+            return
+        
+        model = self._pipe.model
+        if not supports_compile():
+            print("COMPILE richiede transformers >= 4.51, esecuzione eager")
+            self.compile = False
+            return
+        
+        try:
+            cached = load_cache_artifacts(self.compile_cache_dir)
+            compile_kwargs = enable_compile(model, self.compile_mode)
+            if cached:
+                print("Warmup esecuzione compilata (grafi dalla cache)...")
+            else:
+                print("Warmup esecuzione compilata (prima compilazione, può richiedere minuti)...")
             
-            print("Modello caricato con successo!")
+            # Prompt lungo: la cache statica allocata qui basta alle richieste reali
+            inputs = self._pipe.processor.apply_chat_template(
+                self._build_messages(PLACEHOLDER_IMAGE, WARMUP_QUESTION),
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt"
+            ).to(model.device, dtype=model.dtype)
             
+            self.compile_report = warmup(
+                model,
+                inputs,
+                self.max_tokens,
+                compile_kwargs,
+                tokens=self.compile_warmup_tokens,
+                cache_dir=self.compile_cache_dir,
+                compare=self.compile_compare
+            )
         except Exception as e:
-            print(f"Errore caricamento modello: {e}")
-            
-            # Suggerimenti troubleshooting
-            if "gated" in str(e).lower():
-                print("\nMODELLO GATED - RICHIEDI ACCESSO:")
-                print(f"1. Vai su https://huggingface.co/{self.model_name}")
-                print("2. Click 'Request access'")
-                print("3. Compila il form e aspetta approvazione")
-                
-            elif "memory" in str(e).lower() or "cuda out of memory" in str(e).lower():
-                print("\nERRORE MEMORIA - SOLUZIONI:")
-                print("1. Chiudi altre applicazioni")
-                print("2. Cambia DEVICE=cpu nel .env")
-                print("3. Cambia TORCH_DTYPE=float16 nel .env")
-                
-            sys.exit(1)
+            model.generation_config.disable_compile = True
+            self.compile = False
+            print(f"Esecuzione compilata non disponibile, uso eager: {e}")
+            return
+        
+        self.compile_kwargs = compile_kwargs
+        report = self.compile_report
+        message = f"Warmup in {report['warmup_seconds']:.1f}s, decodifica {report['compiled_ms_per_token']:.1f} ms/token"
+        if "speedup" in report:
+            message += f" (eager {report['eager_ms_per_token']:.1f} ms/token, speedup {report['speedup']:.2f}x)"
+        print(message)
+
+    def _snapshot_manifest(self):
+        """Manifest dello snapshot in SNAPSHOT_DIR, se valido per la configurazione"""
+        if not self.snapshot_dir:
+            return None
+        
+        manifest = read_manifest(self.snapshot_dir)
+        if manifest is None:
+            return None
+        
+        if manifest.get("source_model") != self.model_name or manifest.get("dtype") != self.torch_dtype:
+            print(f"Snapshot {self.snapshot_dir} non corrisponde a {self.model_name}/{self.torch_dtype}, ignorato")
+            print("Riesporta con: python test_medgemma.py export")
+            return None
+        return manifest
+
+    def export_snapshot(self, path=None):
+        """Esporta il modello caricato in safetensors nel dtype configurato"""
+        path = path or self.snapshot_dir or "snapshot"
+        
+        if is_quantized(self.torch_dtype):
+            # I pesi int8 dinamici non sono serializzabili in safetensors
+            print(f"Snapshot non supportato con TORCH_DTYPE={self.torch_dtype}: esporta il modello float")
+            return False
+        
+        try:
+            print(f"Esportazione snapshot in {path}...")
+            export_snapshot(self.pipe, path, self.model_name, self.torch_dtype)
+            print("Snapshot esportato! Imposta SNAPSHOT_DIR nel .env per usarlo")
+            return True
+        except Exception as e:
+            print(f"Errore esportazione snapshot: {e}")
+            return False
+
+    def start_worker_pool(self, workers=None):
+        """Avvia N processi worker che condividono i pesi già caricati
+        
+        Da chiamare subito dopo l'inizializzazione, prima di generare nel
+        processo corrente. Le richieste vanno poi inviate al pool
+        (worker_pool.submit / worker_pool.map).
+        """
+        from medgemma_workers import WorkerPool, on_cpu
+        
+        workers = workers or self.workers
+        if workers < 1:
+            return None
+        
+        if self.pipe is not None and not on_cpu(self.pipe.model):
+            print(f"WORKERS={workers} ignorato: il pool richiede il modello su CPU, uso un solo processo")
+            return None
+        
+        self.worker_pool = WorkerPool(self, workers, self.threads_per_worker)
+        # Prima dell'archivio del padre (atexit è LIFO): i worker scrivono
+        # i record ancora in coda alla ricezione del segnale di chiusura
+        atexit.register(self.worker_pool.close)
+        return self.worker_pool
+
+    def _setup_metrics(self):
+        """Inizializza le metriche per fase delle richieste"""
+        self.metrics = Metrics(
+            enabled=self.metrics_enabled,
+            log_path=self.metrics_log or None,
+            prometheus_path=self.metrics_prom_file or None,
+            slow_ms=self.slow_request_ms,
+            slow_path=self.slow_request_log or None
+        )
+        if self.metrics_enabled and self.metrics_prom_file:
+            # Ultimo aggiornamento del file Prometheus all'uscita
+            atexit.register(self.metrics.write_prometheus)
+
+    def _setup_cache(self):
+        """Inizializza la cache delle risposte"""
+        self.cache = None
+        if not self.cache_enabled:
+            return
+        
+        try:
+            self.cache = ResponseCache(
+                cache_dir=self.cache_dir,
+                memory_bytes=self.cache_memory_mb * 1024**2,
+                disk_bytes=self.cache_disk_mb * 1024**2
+            )
+            if self.debug:
+                print(f"Cache risposte: {self.cache_dir}")
+        except OSError as e:
+            print(f"Cache disabilitata: {e}")
+
+    def _setup_results(self):
+        """Inizializza l'archivio SQLite delle analisi (RESULTS_DB)"""
+        self.results = None
+        if not self.results_db:
+            return
+        
+        try:
+            self.results = ResultStore(
+                self.results_db,
+                batch_size=self.results_batch,
+                flush_seconds=self.results_flush_seconds
+            )
+            # Scrive i record ancora in coda all'uscita
+            atexit.register(self.results.close)
+            if self.debug:
+                print(f"Archivio risultati: {self.results_db}")
+        except Exception as e:
+            print(f"Archivio risultati disabilitato: {e}")
+
+    def _image_hash(self, image):
+        """Hash dei pixel per cache risposte e archivio, uno per richiesta"""
+        if self.cache is None and self.results is None:
+            return None
+        return image_digest(image)
+
+    def _store_result(self, kind, trace, image, question, result, cached=False, image_hash=None):
+        """Accoda un'analisi nell'archivio con impostazioni e tempi per fase
+        
+        result è un dict {"response", "error", "truncated"} con
+        reduced_budget se un OOM ha ridotto i token di risposta.
+        image_hash è l'hash dei pixel già calcolato per la cache; senza,
+        lo calcola ResultStore.put.
+        """
+        if self.results is None:
+            return
+        
+        record = {
+            "kind": kind,
+            "image": image if image_hash is None else None,
+            "image_hash": image_hash,
+            "question": question,
+            "model": self.model_name,
+            "settings": {
+                "dtype": self.torch_dtype,
+                "device": self.device,
+                "max_new_tokens": result.get("reduced_budget") or self.max_tokens,
+                "do_sample": False,
+                "draft_model": self.draft_model_name or None,
+                "compile": self.compile,
+            },
+            "answer": result.get("response"),
+            "error": result.get("error"),
+            "truncated": result.get("truncated"),
+            "cached": cached,
+        }
+        if trace is not None:
+            record.update({
+                "request_id": trace.id,
+                "source": trace.attrs.get("source"),
+                "total_seconds": time.perf_counter() - trace.start,
+                "stages": dict(trace.stages),
+                "input_tokens": trace.counts.get("input_tokens"),
+                "output_tokens": trace.counts.get("output_tokens"),
+            })
+            if kind == "batch":
+                # Tempi e token di un batch sono dell'intero batch
+                record["settings"]["batch_size"] = trace.counts.get("images")
+        self.results.put(record)
+
+    def _setup_preprocessor(self):
+        """Inizializza decodifica ridotta e prefetch delle immagini"""
+        if not self.preprocess:
+            return
+        
+        # In fast start il processor potrebbe non essere ancora pronto:
+        # si parte dalla risoluzione di default, _load_model la aggiorna
+        target_size = processor_target_size(getattr(self._pipe, "processor", None))
+        self.preprocessor = ImagePreprocessor(
+            target_size=target_size,
+            workers=self.preprocess_workers,
+            prefetch=self.prefetch,
+            dicom=self.dicom,
+            # Il limite resta del progetto: Image.MAX_IMAGE_PIXELS vale per tutto il processo
+            max_pixels=self.resource_plan.max_image_pixels if self.resource_plan is not None else None
+        )
+        if self.debug:
+            print(f"Preprocessing: {target_size[0]}x{target_size[1]}, prefetch {self.prefetch}")
+
+    def _setup_fetcher(self):
+        """Inizializza il downloader con sessione condivisa"""
+        self.fetcher = ImageFetcher(
+            connect_timeout=self.fetch_connect_timeout,
+            read_timeout=self.fetch_read_timeout,
+            max_bytes=self.fetch_max_mb * 1024**2,
+            concurrency=self.fetch_concurrency,
+            cache_dir=self.fetch_cache_dir if self.fetch_cache else None,
+            cache_bytes=self.fetch_cache_mb * 1024**2
+        )
+
+    def _cache_key(self, image, question, digest=None):
+        """Chiave di cache per immagine, prompt e impostazioni"""
+        return make_key(
+            image,
+            question,
+            digest=digest,
+            system_prompt=SYSTEM_PROMPT,
+            model=self.model_name,
+            dtype=self.torch_dtype,
+            max_new_tokens=self.max_tokens
+        )
+
+    def load_image(self, source):
+        """Carica un'immagine preprocessata da path locale o URL, senza output"""
+        if source.startswith(("http://", "https://")):
+            image = self.fetcher.fetch_image(source)
+            return self.preprocessor.prepare(image) if self.preprocessor is not None else image
+        
+        if not os.path.exists(split_frame(source)[0]):
+            raise FileNotFoundError(f"File non trovato: {source}")
+        return self._read_image_file(source)
+
+    def _read_image_file(self, path):
+        """Decodifica un file immagine o DICOM (path#frame, cartella di serie)"""
+        if self.preprocessor is not None:
+            return self.preprocessor.load(path)
+        if is_dicom_source(path):
+            return self.dicom.load(path)
+        
+        image = Image.open(path)
+        image.load()
+        return image
+
+    def _open_image_url(self, image_url):
+        """Scarica un'immagine da URL"""
+        print(f"\nScaricamento immagine da: {image_url}")
+        
+        # Scarica immagine
+        with self.metrics.stage("download"):
+            image = self.fetcher.fetch_image(image_url)
+        print(f"Immagine caricata: {image.size}")
+        
+        if self.preprocessor is not None:
+            with self.metrics.stage("image_decode"):
+                image = self.preprocessor.prepare(image)
+        return image
+
+    def _open_image_file(self, image_path):
+        """Apre un'immagine da file locale"""
+        if not os.path.exists(split_frame(image_path)[0]):
+            raise FileNotFoundError(f"File non trovato: {image_path}")
+        
+        print(f"\nCaricamento da: {image_path}")
+        with self.metrics.stage("image_decode"):
+            image = self._read_image_file(image_path)
+        print(f"Immagine caricata: {image.size}")
+        return image
 
     def analyze_image_from_url(self, image_url, question="Describe this medical image"):
         """Analizza immagine da URL"""
-        try:
-            print(f"\nScaricamento immagine da: {image_url}")
-            
-            # Scarica immagine
-            headers = {"User-Agent": "MedGemma-Test/1.0"}
-            response = requests.get(image_url, headers=headers, stream=True)
-            response.raise_for_status()
-            
-            image = Image.open(response.raw)
-            print(f"Immagine caricata: {image.size}")
+        with self.metrics.trace("url") as trace:
+            trace.attrs["source"] = image_url
+            try:
+                image = self._open_image_url(image_url)
+            except Exception as e:
+                self.metrics.fail(e)
+                return f"Errore download immagine: {e}"
             
             return self.analyze_image(image, question)
-            
-        except Exception as e:
-            return f"Errore download immagine: {e}"
 
     def analyze_image_from_file(self, image_path, question="Describe this medical image"):
         """Analizza immagine da file locale"""
-        try:
-            if not os.path.exists(image_path):
-                return f"File non trovato: {image_path}"
-            
-            print(f"\nCaricamento da: {image_path}")
-            image = Image.open(image_path)
-            print(f"Immagine caricata: {image.size}")
+        with self.metrics.trace("file") as trace:
+            trace.attrs["source"] = image_path
+            try:
+                image = self._open_image_file(image_path)
+            except FileNotFoundError as e:
+                self.metrics.fail(e)
+                return str(e)
+            except Exception as e:
+                self.metrics.fail(e)
+                return f"Errore caricamento file: {e}"
             
             return self.analyze_image(image, question)
+
+    @contextlib.contextmanager
+    def _cancel_scope(self):
+        """Token della richiesta: quello già attivo o uno nuovo con REQUEST_TIMEOUT"""
+        token = current_token()
+        if token is not None:
+            yield token
+            return
+        with activate_token(CancelToken.with_timeout(self.request_timeout)) as token:
+            yield token
+
+    def analyze_image(self, image, question, image_features=None):
+        """Analizza immagine con MedGemma
+        
+        image_features: feature visive già calcolate (vedi open_image),
+        il vision encoder non viene rieseguito.
+        """
+        with self.metrics.trace("image") as trace, self._cancel_scope() as token:
+            digest = None
+            try:
+                print(f"Analisi in corso...")
+                print(f"Domanda: {question}")
+                
+                key = None
+                digest = self._image_hash(image)
+                if self.cache is not None:
+                    key = self._cache_key(image, question, digest)
+                    cached = self.cache.get(key)
+                    if cached is not None:
+                        trace.attrs["cached"] = True
+                        print("Risposta dalla cache")
+                        self._store_result(
+                            "image", trace, image, question, {"response": cached}, cached=True, image_hash=digest
+                        )
+                        return cached
+                
+                # Prepara messagi per MedGemma
+                with trace.stage("prompt"):
+                    inputs = self._prepare_request(image, question, image_features)
+                
+                # Genera risposta (fasi prefill e decode)
+                output_ids = self._generate(inputs, image_features=image_features)
+                
+                # Estrai risposta
+                input_len = inputs["input_ids"].shape[1]
+                with trace.stage("detokenize"):
+                    response = self.pipe.processor.decode(output_ids[0, input_len:], skip_special_tokens=True)
+                
+                self._store_result(
+                    "image", trace, image, question,
+                    {"response": response, "truncated": token.truncated, "reduced_budget": token.reduced_budget},
+                    image_hash=digest
+                )
+                
+                if token.truncated:
+                    # Risposta parziale: segnalata e mai messa in cache
+                    print(f"Analisi interrotta: {describe(token.truncated)}")
+                    return response + truncation_note(token.truncated)
+                
+                if token.reduced_budget:
+                    # Generata con meno token del previsto: non vale per la chiave in cache
+                    print(f"Risposta generata con {token.reduced_budget} token massimi (memoria insufficiente)")
+                elif key is not None:
+                    self.cache.put(key, response)
+                
+                print("Analisi completata!")
+                return response
+                
+            except Exception as e:
+                trace.fail(e)
+                self._store_result(
+                    "image", trace, image, question, {"error": f"Errore durante analisi: {e}"},
+                    image_hash=digest
+                )
+                return f"Errore durante analisi: {e}"
+
+    def analyze_image_stream(self, image, question, image_features=None):
+        """Analizza immagine restituendo il testo a pezzi durante la generazione
+        
+        Generatore di stringhe; i tempi della richiesta (primo token e
+        totale) sono in self.last_timings al termine.
+        """
+        start = time.perf_counter()
+        self.last_timings = {}
+        
+        # La richiesta non viene attivata in questo thread: tra un yield e
+        # l'altro il codice del chiamante non deve finire nelle sue fasi
+        outer = self.metrics.current()
+        trace = outer or self.metrics.begin("stream")
+        try:
+            yield from self._stream(image, question, image_features, start, trace)
+        finally:
+            if outer is None:
+                self.metrics.record(trace)
+
+    def _stream(self, image, question, image_features, start, trace):
+        key = cached = None
+        try:
+            digest = self._image_hash(image)
+            if self.cache is not None:
+                key = self._cache_key(image, question, digest)
+                cached = self.cache.get(key)
+        except Exception as e:
+            trace.fail(e)
+            yield f"Errore durante analisi: {e}"
+            return
+        if cached is not None:
+            elapsed = time.perf_counter() - start
+            self.last_timings = {"ttft": elapsed, "total": elapsed, "cached": True}
+            trace.attrs["cached"] = True
+            self._store_result("stream", trace, image, question, {"response": cached}, cached=True, image_hash=digest)
+            yield cached
+            return
+        
+        try:
+            from transformers import TextIteratorStreamer
             
+            with trace.stage("prompt"):
+                inputs = self._prepare_request(image, question, image_features)
+            streamer = TextIteratorStreamer(
+                self.pipe.processor.tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True
+            )
         except Exception as e:
-            return f"Errore caricamento file: {e}"
-
-    def analyze_image(self, image, question):
-        """Analizza immagine con MedGemma"""
+            trace.fail(e)
+            yield f"Errore durante analisi: {e}"
+            return
+        
+        errors = []
+        token = current_token() or CancelToken.with_timeout(self.request_timeout)
+        
+        def generate():
+            try:
+                with self.metrics.activate(trace), activate_token(token):
+                    self._generate(inputs, image_features=image_features, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                # Sblocca il consumatore in attesa sullo streamer
+                streamer.end()
+        
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        
+        chunks = []
+        ttft = None
         try:
-            print(f"Analisi in corso...")
-            print(f"Domanda: {question}")
+            for chunk in streamer:
+                if not chunk:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Il chiamante ha smesso di leggere: la generazione si ferma al prossimo passo
+            token.cancel("disconnected")
+            raise
+        thread.join()
+        
+        total = time.perf_counter() - start
+        self.last_timings = {"ttft": ttft, "total": total, "cached": False}
+        trace.attrs["ttft"] = ttft
+        
+        if errors:
+            trace.fail(errors[0])
+            self._store_result(
+                "stream", trace, image, question, {"error": f"Errore durante analisi: {errors[0]}"}, image_hash=digest
+            )
+            yield f"Errore durante analisi: {errors[0]}"
+            return
+        
+        self._store_result(
+            "stream", trace, image, question,
+            {"response": "".join(chunks), "truncated": token.truncated, "reduced_budget": token.reduced_budget},
+            image_hash=digest
+        )
+        
+        if token.truncated:
+            yield truncation_note(token.truncated)
+            return
+        
+        if key is not None and not token.reduced_budget:
+            self.cache.put(key, "".join(chunks))
+
+    async def analyze_image_astream(self, image, question):
+        """Versione async iterator di analyze_image_stream"""
+        loop = asyncio.get_running_loop()
+        chunks = self.analyze_image_stream(image, question)
+        done = object()
+        
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, done)
+            if chunk is done:
+                break
+            yield chunk
+
+    def analyze_text(self, prompt):
+        """Risposta a un prompt di solo testo (es. sintesi di più risultati)"""
+        with self.metrics.trace("text") as trace, self._cancel_scope() as token:
+            try:
+                with trace.stage("prompt"):
+                    inputs = self._prepare_inputs(self._build_messages(None, prompt))
+                output_ids = self._generate(inputs)
+                input_len = inputs["input_ids"].shape[1]
+                response = self.pipe.processor.decode(output_ids[0, input_len:], skip_special_tokens=True)
+                if token.truncated:
+                    response += truncation_note(token.truncated)
+                return response
+            except Exception as e:
+                trace.fail(e)
+                return f"Errore durante analisi: {e}"
+
+    def analyze_large_image(self, path, **options):
+        """Analisi a tile di un'immagine molto grande (vetrino, TIFF piramidale)
+        
+        Legge solo le regioni dei tile con contenuto, li analizza in batch e
+        ritorna un report con overview, sintesi e risultati per tile.
+        Opzioni: vedi medgemma_tiles.TiledAnalysis.
+        """
+        from medgemma_tiles import TiledAnalysis
+        
+        return TiledAnalysis(self, path, **options).run()
+
+    def open_image(self, image, name=None):
+        """Apre una sessione immagine per fare più domande
+        
+        Il vision encoder gira una sola volta; le feature restano nella
+        cache VISION_CACHE_SIZE e ogni session.ask(domanda) le riusa.
+        """
+        return ImageSession(self, image, name=name)
+
+    def start_conversation(self, image=None, name=None):
+        """Apre una conversazione a più turni, con immagine o di solo testo
+        
+        Ogni conversation.ask(domanda) vede le domande e risposte
+        precedenti; la KV cache resta fra un turno e l'altro, quindi il
+        prefill riguarda solo la nuova domanda. Le conversazioni inattive
+        per CONVERSATION_IDLE_MINUTES vengono chiuse.
+        """
+        return self.conversations.add(Conversation(self, image, name=name))
+
+    def image_features(self, image, digest=None):
+        """Feature visive di un'immagine, dalla cache se già calcolate"""
+        digest = digest or image_digest(image)
+        features = self.vision_cache.get(digest)
+        if features is not None:
+            return features
+        
+        model = self.pipe.model
+        pixel_values = self.pipe.processor.image_processor(images=image, return_tensors="pt")["pixel_values"]
+        features = encode_image(model, pixel_values.to(model.device, dtype=model.dtype))
+        self.vision_cache.put(digest, features)
+        return features
+
+    def image_embeddings(self, images):
+        """Embedding normalizzati (N, D) per l'indice dei casi simili"""
+        from medgemma_index import embed_images
+        
+        with self.metrics.stage("vision"):
+            return embed_images(self.pipe.model, self.pipe.processor, images)
+
+    def index_images(self, source, index_dir=None, batch_size=None, clusters=None):
+        """Aggiunge all'indice le immagini non ancora presenti
+        
+        source: manifest JSONL, cartella o glob come per i job batch.
+        clusters (numero o "auto") ricostruisce l'indice a cluster per
+        la ricerca approssimata sui corpus grandi.
+        """
+        from medgemma_index import EmbeddingIndex, IndexJob
+        
+        index = EmbeddingIndex(index_dir or self.index_dir)
+        ok = IndexJob(self, source, index, batch_size=batch_size).run()
+        if clusters is not None and index.count:
+            print("Costruzione cluster...")
+            print(f"Cluster: {index.build_clusters(clusters)}")
+        return ok
+
+    def find_similar(self, image, k=10, index_dir=None, nprobe=None, exact=False):
+        """Studi dell'indice più simili all'immagine, per similarità coseno
+        
+        Con l'indice a cluster visita i INDEX_NPROBE cluster più vicini,
+        salvo exact=True. Ritorna dict con path, score e same_image (stessi
+        pixel della query).
+        """
+        from medgemma_index import EmbeddingIndex
+        
+        index = EmbeddingIndex(index_dir or self.index_dir)
+        if not index.count:
+            raise ValueError(f"Indice vuoto: {index.path} (usa prima 'index')")
+        
+        query = self.image_embeddings([image])[0]
+        start = time.perf_counter()
+        hits = index.search(query, k=k, nprobe=None if exact else (nprobe or self.index_nprobe))
+        elapsed = time.perf_counter() - start
+        if self.debug:
+            print(f"Ricerca su {index.count} immagini in {elapsed * 1000:.1f} ms")
+        
+        digest = image_digest(image)
+        results = []
+        for (row, score), record in zip(hits, index.records([row for row, _ in hits])):
+            record.update({"row": row, "score": score, "same_image": record.get("digest") == digest})
+            results.append(record)
+        return results
+
+    def _prepare_request(self, image, question, image_features=None):
+        """Tensori di input per una richiesta singola
+        
+        Con feature già calcolate l'immagine serve solo a inserire i token
+        segnaposto: si usa un'immagine minima e si scartano i pixel.
+        """
+        if image_features is None:
+            return self._prepare_inputs(self._build_messages(image, question))
+        
+        inputs = self._prepare_inputs(self._build_messages(PLACEHOLDER_IMAGE, question))
+        inputs.pop("pixel_values", None)
+        return inputs
+
+    def _prepare_inputs(self, messages):
+        """Applica il chat template e prepara i tensori per model.generate"""
+        inputs = self.pipe.processor.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt"
+        )
+        return inputs.to(self.pipe.model.device, dtype=self.pipe.model.dtype)
+
+    def _generate(self, inputs, image_features=None, assisted=None, cache=None, cache_start=0, **generate_kwargs):
+        """model.generate per una singola richiesta, riusando il prefisso di sistema
+        
+        Con image_features il prompt viene elaborato come embedding con
+        le feature visive già inserite. Ritorna gli id completi (prompt +
+        risposta) come model.generate.
+        
+        Con un draft caricato (DRAFT_MODEL_NAME) la decodifica è assistita,
+        salvo assisted=False: stesso output greedy, statistiche in
+        self.last_assisted.
+        
+        Con una richiesta attiva nelle metriche registra le fasi prefill
+        (fino al primo token) e decode, e i token di input e output.
+        
+        cache è una KV cache che contiene già i primi cache_start token
+        del prompt (conversazioni): viene estesa sul posto e il prefisso
+        di sistema non viene cercato.
+        
+        Un out of memory prima del primo token (o senza streamer) libera
+        la memoria e riprova con metà dei token di risposta, annotati in
+        reduced_budget del token di annullamento attivo.
+        """
+        from transformers import LogitsProcessorList
+        
+        max_new_tokens = generate_kwargs.pop("max_new_tokens", self.max_tokens)
+        streamer = generate_kwargs.get("streamer")
+        
+        while True:
+            clock = StepClock()
+            kwargs = dict(generate_kwargs)
+            kwargs["logits_processor"] = LogitsProcessorList(generate_kwargs.get("logits_processor") or [])
+            if cache is not None:
+                # Un tentativo fallito può aver già esteso la cache
+                cache.crop(cache_start)
+            try:
+                return self._generate_once(
+                    inputs, image_features, assisted, clock, cache, cache_start,
+                    max_new_tokens=max_new_tokens, **kwargs
+                )
+            except Exception as e:
+                # Con testo già passato allo streamer non si può ricominciare
+                started_streaming = streamer is not None and clock.first is not None
+                if not is_oom(e) or started_streaming or max_new_tokens // 2 < MIN_NEW_TOKENS:
+                    raise
+                release_memory()
+                self.metrics.count("oom_retries")
+                self.resources.downgrade("token risposta", max_new_tokens, max_new_tokens // 2, e)
+                max_new_tokens //= 2
+                token = current_token()
+                if token is not None:
+                    # La risposta non è quella del budget pieno: niente cache
+                    token.reduced_budget = max_new_tokens
+                if hasattr(streamer, "next_tokens_are_prompt"):
+                    # generate ripasserà il prompt allo streamer
+                    streamer.next_tokens_are_prompt = True
+
+    def _generate_once(self, inputs, image_features, assisted, clock, cache, start, **generate_kwargs):
+        from transformers import DynamicCache, StoppingCriteriaList
+        
+        model = self.pipe.model
+        if assisted is None:
+            assisted = self.draft is not None
+        generate_kwargs["do_sample"] = False  # Deterministico per uso medico
+        
+        trace = self.metrics.current()
+        generate_kwargs["logits_processor"].append(clock)
+        
+        # Deadline e annullamento controllati a ogni passo di decodifica
+        token = current_token()
+        criteria = None
+        if token is not None:
+            if token.cancelled:
+                # Scaduta prima di iniziare: nessun calcolo, risposta vuota
+                token.truncated = token.reason
+                return inputs["input_ids"]
+            criteria = CancelCriteria([token], finished_ids=self._finished_token_ids())
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+        started = time.perf_counter()
+        
+        if cache is None:
+            cache, start = self._start_cache(inputs["input_ids"])
+        
+        if cache is None and image_features is None and not assisted:
+            # Solo qui generate alloca la cache: può essere quella statica compilata
+            output_ids = model.generate(**inputs, **self.compile_kwargs, **generate_kwargs)
+        else:
+            inputs_embeds = None
+            if image_features is not None:
+                inputs_embeds = embed_with_image_features(model, inputs["input_ids"], image_features)
             
-            # Prepara messagi per MedGemma
-            messages = [
-                {
-                    "role": "system",
-                    "content": [{"type": "text", "text": "You are an expert medical AI assistant. Provide detailed, accurate analysis of medical images. Always mention limitations and recommend professional consultation."}]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": question},
-                        {"type": "image", "image": image}
-                    ]
-                }
-            ]
+            if cache is None:
+                cache = DynamicCache()
             
-            # Genera risposta
-            output = self.pipe(
-                text=messages, 
-                max_new_tokens=self.max_tokens,
-                temperature=self.temperature,
-                do_sample=False  # Deterministico per uso medico
+            prefill(
+                model,
+                inputs["input_ids"],
+                inputs["attention_mask"],
+                cache,
+                start=start,
+                token_type_ids=inputs.get("token_type_ids"),
+                pixel_values=inputs.get("pixel_values"),
+                inputs_embeds=inputs_embeds
             )
             
-            # Estrai risposta
-            response = output[0]["generated_text"][-1]["content"]
+            if assisted:
+                output_ids = self._assisted_generate(
+                    inputs, image_features, cache, clock, started, generate_kwargs
+                )
+            else:
+                output_ids = model.generate(
+                    input_ids=inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    past_key_values=cache,
+                    **generate_kwargs
+                )
+        
+        if criteria is not None and criteria.stopped[0] is not None:
+            token.truncated = criteria.stopped[0]
+        
+        if trace is not None:
+            finished = time.perf_counter()
+            if assisted:
+                # La baseline di DRAFT_VERIFY non fa parte della decodifica
+                finished -= self.last_assisted.get("baseline_seconds", 0.0)
+            first = clock.first or finished
+            input_len = inputs["input_ids"].shape[1]
+            trace.add("prefill", first - started, start=started)
+            trace.add("decode", finished - first, start=first)
+            trace.count("input_tokens", input_len)
+            trace.count("output_tokens", output_ids.shape[1] - input_len)
+            trace.attrs["prefix_tokens"] = start
+            if assisted:
+                trace.attrs["assisted"] = self.last_assisted
+            if token is not None and token.truncated:
+                trace.attrs["truncated"] = token.truncated
+        
+        return output_ids
+
+    def _start_cache(self, input_ids):
+        """KV cache iniziale: copia del prefisso di sistema se il prompt lo contiene"""
+        if self.prefix_caching:
+            prefix = self.prefix_cache.get(
+                self.pipe.model, self.pipe.processor, lambda text: self._build_messages(None, text)
+            )
+            if prefix.matches(input_ids):
+                return prefix.copy_cache(), prefix.ids.shape[1]
+        return None, 0
+
+    def _finished_token_ids(self):
+        """Id con cui una sequenza termina normalmente (EOS e padding)"""
+        generation_config = self.pipe.model.generation_config
+        eos_token_id = generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        return list(eos_token_id or ()) + [generation_config.pad_token_id]
+
+    def _assisted_generate(self, inputs, image_features, cache, clock, started, generate_kwargs):
+        """Decodifica assistita dal draft su una cache già riempita col prompt
+        
+        Con DRAFT_VERIFY rigenera in greedy standard e confronta: misura
+        lo speedup reale e segnala se l'output differisce.
+        """
+        model = self.pipe.model
+        eos_token_id = model.generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        token = current_token()
+        
+        output_ids, stats = speculative_generate(
+            model,
+            self.draft,
+            inputs["input_ids"],
+            cache,
+            max_new_tokens=generate_kwargs["max_new_tokens"],
+            draft_tokens=self.draft_tokens,
+            eos_token_ids=eos_token_id or (),
+            streamer=generate_kwargs.get("streamer"),
+            clock=clock,
+            should_stop=(lambda: token.cancelled) if token is not None else None
+        )
+        stats["seconds"] = time.perf_counter() - started
+        if stats["stopped"]:
+            token.truncated = token.reason
+        
+        # Una risposta interrotta non è confrontabile con la baseline
+        if self.draft_verify and not stats["stopped"]:
+            # La baseline non entra nelle metriche della richiesta
+            with self.metrics.activate(None):
+                baseline_start = time.perf_counter()
+                baseline_ids = self._generate(
+                    inputs,
+                    image_features=image_features,
+                    assisted=False,
+                    max_new_tokens=generate_kwargs["max_new_tokens"]
+                )
+                stats["baseline_seconds"] = time.perf_counter() - baseline_start
+            stats["speedup"] = stats["baseline_seconds"] / stats["seconds"] if stats["seconds"] else 0.0
+            stats["identical"] = baseline_ids.shape == output_ids.shape and bool((baseline_ids == output_ids).all())
+            if not stats["identical"]:
+                print("ATTENZIONE: output assistito diverso dalla decodifica greedy")
+        
+        self.last_assisted = stats
+        if self.debug:
+            message = (
+                f"Decodifica assistita: accettati {stats['acceptance_rate']:.0%} "
+                f"({stats['accepted']}/{stats['proposed']}), "
+                f"{stats['tokens_per_forward']:.2f} token per forward"
+            )
+            if "speedup" in stats:
+                message += f", speedup {stats['speedup']:.2f}x vs greedy"
+            print(message)
+        return output_ids
+
+    def analyze_images(self, items, batch_size=None, token_budget=None, tokens=None):
+        """Analizza più immagini in batch
+        
+        items: lista di coppie (immagine PIL, domanda).
+        tokens: CancelToken per elemento (default: REQUEST_TIMEOUT da ora).
+        Ritorna una lista di dict {"response", "error", "truncated"} nello
+        stesso ordine dell'input; truncated è il motivo se la risposta è
+        parziale (deadline, annullamento).
+        """
+        batch_size = batch_size or self.batch_size
+        token_budget = token_budget or self.batch_token_budget
+        if tokens is None:
+            tokens = [CancelToken.with_timeout(self.request_timeout) for _ in items]
+        results = [None] * len(items)
+        keys = [None] * len(items)
+        digests = [None] * len(items)
+        
+        # Le richieste già in cache non entrano nei batch
+        pending = []
+        for i, (image, question) in enumerate(items):
+            try:
+                digests[i] = self._image_hash(image)
+            except Exception as e:
+                results[i] = {"response": None, "error": f"Errore lettura immagine: {e}"}
+                continue
+            if self.cache is not None:
+                keys[i] = self._cache_key(image, question, digests[i])
+                cached = self.cache.get(keys[i])
+                if cached is not None:
+                    results[i] = {"response": cached, "error": None}
+                    self._store_result("batch", None, image, question, results[i], cached=True, image_hash=digests[i])
+                    continue
+            pending.append(i)
+        
+        print(f"Analisi batch di {len(pending)} immagini (batch max {batch_size}, {len(items) - len(pending)} in cache)...")
+        
+        pending_items = [items[i] for i in pending]
+        pending_tokens = [tokens[i] for i in pending]
+        pending_results = [None] * len(pending)
+        pending_digests = [digests[i] for i in pending]
+        for batch in self._plan_batches(pending_items, batch_size, token_budget):
+            self._run_batch(pending_items, batch, pending_results, pending_tokens, pending_digests)
+        
+        for i, result in zip(pending, pending_results):
+            results[i] = result
+            if (keys[i] is not None and result["error"] is None and not result.get("truncated")
+                    and not result.get("reduced_budget")):
+                self.cache.put(keys[i], result["response"])
+        
+        for result in results:
+            result.setdefault("truncated", None)
+        
+        print("Analisi batch completata!")
+        return results
+
+    def analyze_image_files(self, items, batch_size=None):
+        """Analizza file locali decodificando in anticipo i successivi
+        
+        items: lista di coppie (path, domanda). Mentre un batch è in
+        generazione il pool di preprocessing decodifica i prossimi file.
+        Ritorna dict {"response", "error"} nell'ordine dell'input.
+        """
+        batch_size = batch_size or self.batch_size
+        questions = [question for _, question in items]
+        paths = [path for path, _ in items]
+        
+        if self.preprocessor is not None:
+            loaded = self.preprocessor.prefetch(paths)
+        else:
+            loaded = self._load_sequential(paths)
+        
+        results = []
+        chunk = []
+        for index, (path, image, error) in enumerate(loaded):
+            chunk.append((index, image, error))
+            if len(chunk) >= batch_size:
+                results.extend(self._analyze_loaded(chunk, questions))
+                chunk = []
+        if chunk:
+            results.extend(self._analyze_loaded(chunk, questions))
+        
+        return results
+
+    def analyze_image_urls(self, items, batch_size=None):
+        """Analizza immagini remote scaricandole in parallelo
+        
+        items: lista di coppie (URL, domanda). I download sono limitati
+        da FETCH_CONCURRENCY e proseguono mentre il batch corrente genera.
+        Ritorna dict {"response", "error"} nell'ordine dell'input.
+        """
+        batch_size = batch_size or self.batch_size
+        questions = [question for _, question in items]
+        
+        results = []
+        chunk = []
+        for index, (url, data, error) in enumerate(self.fetcher.fetch_many(url for url, _ in items)):
+            image = None
+            if error is None:
+                try:
+                    image = Image.open(io.BytesIO(data))
+                    if self.preprocessor is not None:
+                        image = self.preprocessor.prepare(image)
+                except Exception as e:
+                    error = e
+            chunk.append((index, image, error))
+            if len(chunk) >= batch_size:
+                results.extend(self._analyze_loaded(chunk, questions, "Errore download immagine"))
+                chunk = []
+        if chunk:
+            results.extend(self._analyze_loaded(chunk, questions, "Errore download immagine"))
+        
+        return results
+
+    def _load_sequential(self, paths):
+        for path in paths:
+            try:
+                yield path, self._read_image_file(path), None
+            except Exception as e:
+                yield path, None, e
+
+    def _analyze_loaded(self, chunk, questions, error_prefix="Errore caricamento file"):
+        """Analizza un gruppo di immagini già decodificate"""
+        results = [None] * len(chunk)
+        valid = []
+        for position, (index, image, error) in enumerate(chunk):
+            if error is not None:
+                results[position] = {"response": None, "error": f"{error_prefix}: {error}"}
+            else:
+                valid.append((position, (image, questions[index])))
+        
+        if valid:
+            outputs = self.analyze_images([item for _, item in valid])
+            for (position, _), output in zip(valid, outputs):
+                results[position] = output
+        return results
+
+    def _build_messages(self, image, question):
+        """Prepara i messaggi chat per una coppia immagine/domanda"""
+        content = [{"type": "text", "text": question}]
+        if image is not None:
+            content.append({"type": "image", "image": image})
+        
+        return [
+            {
+                "role": "system",
+                "content": [{"type": "text", "text": SYSTEM_PROMPT}]
+            },
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+
+    def _estimate_tokens(self, question):
+        """Stima i token (prompt + generazione) di una richiesta"""
+        processor = getattr(self.pipe, "processor", None)
+        tokenizer = getattr(processor, "tokenizer", None) or self.pipe.tokenizer
+        image_tokens = getattr(processor, "image_seq_length", DEFAULT_IMAGE_TOKENS)
+        
+        if tokenizer is not None:
+            text_tokens = len(tokenizer(SYSTEM_PROMPT + "\n\n" + question).input_ids)
+        else:
+            text_tokens = len(SYSTEM_PROMPT + question) // 3
+        
+        return text_tokens + image_tokens + self.max_tokens
+
+    def _plan_batches(self, items, batch_size, token_budget):
+        """Raggruppa gli indici in batch rispettando dimensione e budget token
+        
+        Le richieste sono ordinate per lunghezza stimata, così il padding
+        dentro ogni batch resta minimo. Il costo di un batch è
+        len(batch) * richiesta più lunga, come dopo il padding.
+        """
+        costs = {}
+        for i, (_, question) in enumerate(items):
+            try:
+                costs[i] = self._estimate_tokens(question)
+            except Exception:
+                costs[i] = self.max_tokens + DEFAULT_IMAGE_TOKENS
+        
+        batch = []
+        longest = 0
+        for i in sorted(costs, key=costs.get):
+            candidate = max(longest, costs[i])
+            if batch and (len(batch) >= batch_size or candidate * (len(batch) + 1) > token_budget):
+                yield batch
+                batch, candidate = [], costs[i]
+            batch.append(i)
+            longest = candidate
+        
+        if batch:
+            yield batch
+
+    def _run_batch(self, items, batch, results, tokens, digests):
+        """Esegue un batch sul pipeline e salva i risultati per indice"""
+        with self.metrics.trace("batch") as trace:
+            trace.count("images", len(batch))
+            self._run_pipeline_batch(items, batch, results, trace, tokens)
+            for i in batch:
+                if results[i] is not None:
+                    self._store_result("batch", trace, *items[i], results[i], image_hash=digests[i])
+
+    def _run_pipeline_batch(self, items, batch, results, trace, tokens, max_new_tokens=None):
+        from transformers import StoppingCriteriaList
+        
+        max_new_tokens = max_new_tokens or self.max_tokens
+        
+        # Le richieste già scadute o annullate non occupano posti nel batch
+        live = []
+        for i in batch:
+            reason = tokens[i].reason if tokens[i] is not None else None
+            if reason is None:
+                live.append(i)
+            else:
+                trace.count("cancelled")
+                results[i] = {"response": None, "error": f"Richiesta annullata: {describe(reason)}", "truncated": reason}
+        batch = live
+        if not batch:
+            return
+        
+        with trace.stage("prompt"):
+            conversations = [self._build_messages(*items[i]) for i in batch]
+        
+        try:
+            tokenizer = getattr(getattr(self.pipe, "processor", None), "tokenizer", None)
+            if tokenizer is not None:
+                # Padding a sinistra per la generazione in batch
+                tokenizer.padding_side = "left"
+            
+            # Ogni riga si ferma quando la sua richiesta viene annullata
+            criteria = CancelCriteria([tokens[i] for i in batch], finished_ids=self._finished_token_ids())
             
-            print("Analisi completata!")
-            return response
+            with trace.stage("generate"):
+                outputs = self.pipe(
+                    text=conversations,
+                    batch_size=len(batch),
+                    max_new_tokens=max_new_tokens,
+                    temperature=self.temperature,
+                    do_sample=False,  # Deterministico per uso medico
+                    generate_kwargs={"stopping_criteria": StoppingCriteriaList([criteria]), **self.compile_kwargs}
+                )
             
+            for i, output, reason in zip(batch, outputs, criteria.stopped):
+                if isinstance(output, list):
+                    output = output[0]
+                results[i] = {"response": output["generated_text"][-1]["content"], "error": None, "truncated": reason}
+                if max_new_tokens < self.max_tokens:
+                    results[i]["reduced_budget"] = max_new_tokens
+                    if tokens[i] is not None:
+                        tokens[i].reduced_budget = max_new_tokens
+                if reason is not None:
+                    tokens[i].truncated = reason
+                    trace.count("truncated")
+        
         except Exception as e:
-            return f"Errore durante analisi: {e}"
+            if is_oom(e):
+                release_memory()
+                trace.count("oom_retries")
+                self._retry_smaller(items, batch, results, trace, tokens, max_new_tokens, e)
+                return
+            
+            if len(batch) == 1:
+                trace.fail(e)
+                results[batch[0]] = {"response": None, "error": f"Errore durante analisi: {e}"}
+                return
+            
+            # Isola l'elemento problematico rieseguendo uno alla volta
+            print(f"Errore batch ({e}), riprovo singolarmente...")
+            for i in batch:
+                self._run_pipeline_batch(items, [i], results, trace, tokens, max_new_tokens)
+
+    def _retry_smaller(self, items, batch, results, trace, tokens, max_new_tokens, error):
+        """Dopo un OOM riprova a metà batch, poi con metà dei token di risposta
+        
+        La riduzione del batch resta per i batch successivi.
+        """
+        if len(batch) > 1:
+            half = len(batch) // 2
+            if half < self.batch_size:
+                self.resources.downgrade("batch", self.batch_size, half, error)
+                self.batch_token_budget = max(1, self.batch_token_budget * half // self.batch_size)
+                self.batch_size = half
+            self._run_pipeline_batch(items, batch[:half], results, trace, tokens, max_new_tokens)
+            self._run_pipeline_batch(items, batch[half:], results, trace, tokens, max_new_tokens)
+            return
+        
+        if max_new_tokens // 2 < MIN_NEW_TOKENS:
+            trace.fail(error)
+            results[batch[0]] = {"response": None, "error": f"Memoria insufficiente: {error}"}
+            return
+        
+        self.resources.downgrade("token risposta", max_new_tokens, max_new_tokens // 2, error)
+        self._run_pipeline_batch(items, batch, results, trace, tokens, max_new_tokens // 2)
 
     def interactive_mode(self):
         """Modalità interattiva per test"""
@@ -219,6 +1723,19 @@ class MedGemmaTest:
         print("  url <URL> <domanda>     - Analizza immagine da URL")
         print("  file <path> <domanda>   - Analizza file locale")
         print("  test                    - Test con radiografia di esempio")
+        print("  open <path>             - Apre un'immagine per più domande")
+        print("  dicom <path>            - Metadati DICOM (frame, finestra) senza leggere i pixel")
+        print("  index <path|glob>       - Aggiunge immagini all'indice dei casi simili")
+        print("  similar <path> [k]      - Studi indicizzati più simili all'immagine")
+        print("  ask <domanda>           - Domanda sull'immagine aperta")
+        print("  chat [path]             - Nuova conversazione (con immagine o solo testo)")
+        print("  say <messaggio>         - Turno nella conversazione corrente")
+        print("  sessions [id]           - Elenca le conversazioni o riprende quella indicata")
+        print("  close                   - Chiude la conversazione corrente")
+        print("  cache                   - Statistiche cache risposte e prefisso")
+        print("  metrics                 - Tempo medio per fase delle richieste")
+        print("  resources               - Piano risorse e riduzioni per memoria")
+        print("  export [dir]            - Esporta snapshot locale del modello")
         print("  quit                    - Esci")
         print("=" * 50)
         
@@ -235,8 +1752,64 @@ class MedGemmaTest:
                     test_url = "https://upload.wikimedia.org/wikipedia/commons/c/c8/Chest_Xray_PA_3-8-2010.png"
                     question = "Describe this chest X-ray. What can you observe?"
                     
-                    result = self.analyze_image_from_url(test_url, question)
-                    print(f"\nRISPOSTA MEDGEMMA:\n{result}")
+                    self._cancellable(self._answer, test_url, question, True)
+                
+                elif command.lower() == "cache":
+                    if self.cache is None:
+                        print("Cache disabilitata (CACHE_ENABLED=false)")
+                    else:
+                        for name, value in self.cache.stats().items():
+                            print(f"  {name}: {value}")
+                    print("Feature visive:")
+                    for name, value in self.vision_cache.stats().items():
+                        print(f"  {name}: {value}")
+                    if self.prefix_caching:
+                        print("Prefisso di sistema:")
+                        for name, value in self.prefix_cache.stats().items():
+                            print(f"  {name}: {value}")
+                    print("Conversazioni:")
+                    for name, value in self.conversations.stats().items():
+                        print(f"  {name}: {value}")
+                    if self.results is not None:
+                        print("Archivio risultati:")
+                        for name, value in self.results.stats().items():
+                            print(f"  {name}: {value}")
+                
+                elif command.lower() == "metrics":
+                    self._print_metrics()
+                
+                elif command.lower() == "resources":
+                    self.print_resources()
+                
+                elif command.startswith("open "):
+                    self._open_session(command[5:].strip())
+                
+                elif command.startswith("dicom "):
+                    self._print_dicom_info(command[6:].strip())
+                
+                elif command.startswith("index "):
+                    self.index_images(command[6:].strip())
+                
+                elif command.startswith("similar "):
+                    self._print_similar(command[8:].strip())
+                
+                elif command.startswith("ask "):
+                    self._cancellable(self._ask_session, command[4:].strip())
+                
+                elif command == "chat" or command.startswith("chat "):
+                    self._start_chat(command[5:].strip())
+                
+                elif command.startswith("say "):
+                    self._cancellable(self._say, command[4:].strip())
+                
+                elif command == "sessions" or command.startswith("sessions "):
+                    self._sessions(command[9:].strip())
+                
+                elif command == "close":
+                    self._close_chat()
+                
+                elif command == "export" or command.startswith("export "):
+                    self.export_snapshot(command[7:].strip() or None)
                 
                 elif command.startswith("url "):
                     parts = command[4:].split(" ", 1)
@@ -246,8 +1819,7 @@ class MedGemmaTest:
                         url = parts[0]
                         question = "Describe this medical image in detail"
                     
-                    result = self.analyze_image_from_url(url, question)
-                    print(f"\nRISPOSTA MEDGEMMA:\n{result}")
+                    self._cancellable(self._answer, url, question, True)
                 
                 elif command.startswith("file "):
                     parts = command[5:].split(" ", 1)
@@ -257,11 +1829,10 @@ class MedGemmaTest:
                         filepath = parts[0]
                         question = "Describe this medical image in detail"
                     
-                    result = self.analyze_image_from_file(filepath, question)
-                    print(f"\nRISPOSTA MEDGEMMA:\n{result}")
+                    self._cancellable(self._answer, filepath, question, False)
                 
                 else:
-                    print("Comando non riconosciuto. Usa 'test', 'url', 'file' o 'quit'")
+                    print("Comando non riconosciuto. Usa 'test', 'url', 'file', 'open', 'ask', 'chat', 'say', 'sessions', 'close', 'dicom', 'index', 'similar', 'cache', 'metrics', 'resources', 'export' o 'quit'")
                     
             except KeyboardInterrupt:
                 print("\nInterruzione utente. Arrivederci!")
@@ -269,6 +1840,219 @@ class MedGemmaTest:
             except Exception as e:
                 print(f"Errore: {e}")
 
+    def _print_metrics(self):
+        """Comando metrics: media per fase ed esportazione Prometheus"""
+        if not self.metrics_enabled:
+            print("Metriche disabilitate (METRICS=false)")
+            return
+        
+        summary = self.metrics.summary()
+        if not summary:
+            print("Nessuna richiesta registrata")
+            return
+        
+        print(f"{'fase':<12} {'richieste':>9} {'media':>9}")
+        for name, stats in summary.items():
+            print(f"{name:<12} {stats['count']:>9} {stats['mean']:8.3f}s")
+        if self.metrics_prom_file:
+            self.metrics.write_prometheus()
+            print(f"Metriche Prometheus in {self.metrics_prom_file}")
+
+    def _print_dicom_info(self, path):
+        """Comando dicom: header del file o della serie"""
+        try:
+            info = self.dicom.info(path)
+        except Exception as e:
+            print(f"Errore lettura DICOM: {e}")
+            return
+        
+        for name, value in info.items():
+            if value is not None:
+                print(f"  {name}: {value}")
+        print("Per scegliere frame o slice: file <path>#<indice> <domanda>")
+
+    def _print_similar(self, args):
+        """Comando similar: path dell'immagine e numero di risultati opzionale"""
+        parts = args.rsplit(" ", 1)
+        k = 5
+        if len(parts) == 2 and parts[1].isdigit():
+            args, k = parts[0], int(parts[1])
+        try:
+            results = self.find_similar(self._open_image_file(args), k=k)
+        except (FileNotFoundError, ValueError) as e:
+            print(e)
+            return
+        except Exception as e:
+            print(f"Errore ricerca: {e}")
+            return
+        
+        for rank, result in enumerate(results, 1):
+            marker = " (stessa immagine)" if result["same_image"] else ""
+            print(f"  {rank:>2}. {result['score']:.4f}  {result['path']}{marker}")
+
+    def _cancellable(self, action, *args):
+        """Esegue un comando interattivo: Ctrl+C annulla la richiesta, non la sessione
+        
+        La generazione si ferma al passo successivo e la risposta parziale
+        viene mostrata come incompleta; un secondo Ctrl+C esce.
+        """
+        token = CancelToken.with_timeout(self.request_timeout)
+        
+        def interrupt(signum, frame):
+            if token.reason == "interrupted":
+                raise KeyboardInterrupt
+            token.cancel("interrupted")
+            print("\nRichiesta annullata (Ctrl+C di nuovo per uscire)")
+        
+        previous = signal.signal(signal.SIGINT, interrupt)
+        try:
+            with activate_token(token):
+                action(*args)
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+    def _open_session(self, filepath):
+        """Comando open: carica l'immagine ed esegue il vision encoder"""
+        try:
+            image = self._open_image_file(filepath)
+            print("Codifica immagine...")
+            self.session = self.open_image(image, name=filepath)
+            print(f"Immagine aperta. Usa 'ask <domanda>' per interrogarla")
+        except FileNotFoundError as e:
+            print(e)
+        except Exception as e:
+            print(f"Errore apertura immagine: {e}")
+
+    def _ask_session(self, question):
+        """Comando ask: domanda sull'immagine aperta con open"""
+        if self.session is None:
+            print("Nessuna immagine aperta. Usa prima 'open <path>'")
+            return
+        
+        question = question or "Describe this medical image in detail"
+        print(f"\nImmagine: {self.session.name}")
+        print(f"Domanda: {question}")
+        
+        if not self.streaming:
+            print(f"\nRISPOSTA MEDGEMMA:\n{self.session.ask(question)}")
+            return
+        
+        print("\nRISPOSTA MEDGEMMA:")
+        for chunk in self.session.ask_stream(question):
+            print(chunk, end="", flush=True)
+        print()
+        
+        if self.debug and self.last_timings.get("ttft") is not None:
+            print(f"\nPrimo token: {self.last_timings['ttft']:.2f}s | Totale: {self.last_timings['total']:.2f}s")
+
+    def _start_chat(self, filepath):
+        """Comando chat: apre una conversazione e la rende corrente"""
+        try:
+            image = None
+            if filepath:
+                image = self._open_image_file(filepath)
+                print("Codifica immagine...")
+            self.conversation = self.start_conversation(image, name=filepath or None)
+            print(f"Conversazione {self.conversation.id} aperta. Usa 'say <messaggio>' per scrivere")
+        except FileNotFoundError as e:
+            print(e)
+        except Exception as e:
+            print(f"Errore apertura conversazione: {e}")
+
+    def _say(self, message):
+        """Comando say: turno nella conversazione corrente"""
+        conversation = self.conversation
+        if conversation is None or self.conversations.get(conversation.id) is None:
+            self.conversation = None
+            print("Nessuna conversazione aperta (o scaduta). Usa prima 'chat [path]'")
+            return
+        if not message:
+            print("Uso: say <messaggio>")
+            return
+        
+        if not self.streaming:
+            print(f"\nRISPOSTA MEDGEMMA:\n{conversation.ask(message)}")
+        else:
+            print("\nRISPOSTA MEDGEMMA:")
+            for chunk in conversation.ask_stream(message):
+                print(chunk, end="", flush=True)
+            print()
+        
+        if self.debug:
+            info = conversation.info()
+            print(
+                f"\nTurno {info['turns']} | token in cache {info['cached_tokens']} "
+                f"({info['cache_mb']} MB) | prefill totale {info['prefilled_tokens']}, "
+                f"riusati {info['reused_tokens']}"
+            )
+            if self.streaming and self.last_timings.get("ttft") is not None:
+                print(f"Primo token: {self.last_timings['ttft']:.2f}s | Totale: {self.last_timings['total']:.2f}s")
+
+    def _sessions(self, conversation_id):
+        """Comando sessions: elenco delle conversazioni o cambio di quella corrente"""
+        if conversation_id:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                print(f"Conversazione {conversation_id} non trovata (chiusa o scaduta)")
+                return
+            self.conversation = conversation
+            print(f"Conversazione corrente: {conversation.id} ({conversation.name}, {conversation.turns} turni)")
+            return
+        
+        sessions = self.conversations.list()
+        if not sessions:
+            print("Nessuna conversazione aperta")
+            return
+        current = self.conversation.id if self.conversation is not None else None
+        for info in sessions:
+            marker = "*" if info["id"] == current else " "
+            print(
+                f"{marker} {info['id']}  {info['name']}  turni {info['turns']}  "
+                f"cache {info['cached_tokens']} token ({info['cache_mb']} MB)  inattiva {info['idle_seconds']}s"
+            )
+
+    def _close_chat(self):
+        """Comando close: chiude la conversazione corrente"""
+        if self.conversation is None:
+            print("Nessuna conversazione aperta")
+            return
+        self.conversations.remove(self.conversation.id)
+        print(f"Conversazione {self.conversation.id} chiusa")
+        self.conversation = None
+
+    def _answer(self, source, question, from_url):
+        """Risponde a un comando interattivo, in streaming se abilitato"""
+        if not self.streaming:
+            if from_url:
+                result = self.analyze_image_from_url(source, question)
+            else:
+                result = self.analyze_image_from_file(source, question)
+            print(f"\nRISPOSTA MEDGEMMA:\n{result}")
+            return
+        
+        with self.metrics.trace("url" if from_url else "file") as trace:
+            trace.attrs["source"] = source
+            try:
+                image = self._open_image_url(source) if from_url else self._open_image_file(source)
+            except FileNotFoundError as e:
+                self.metrics.fail(e)
+                print(f"\nRISPOSTA MEDGEMMA:\n{e}")
+                return
+            except Exception as e:
+                self.metrics.fail(e)
+                kind = "download immagine" if from_url else "caricamento file"
+                print(f"\nRISPOSTA MEDGEMMA:\nErrore {kind}: {e}")
+                return
+            
+            print(f"Domanda: {question}")
+            print("\nRISPOSTA MEDGEMMA:")
+            for chunk in self.analyze_image_stream(image, question):
+                print(chunk, end="", flush=True)
+            print()
+        
+        if self.debug and self.last_timings.get("ttft") is not None:
+            print(f"\nPrimo token: {self.last_timings['ttft']:.2f}s | Totale: {self.last_timings['total']:.2f}s")
+
 
 def main():
     """Funzione principale"""
@@ -291,5 +2075,243 @@ def main():
             print("pip install -r requirements.txt")
 
 
+def serve():
+    """Avvia MedGemma in modalità server HTTP"""
+    print("MEDGEMMA SERVER")
+    print("=" * 50)
+    
+    try:
+        from medgemma_server import InferenceServer
+    except ImportError:
+        print("Installa aiohttp per la modalità server: pip install aiohttp")
+        sys.exit(1)
+    
+    try:
+        # Il modello viene caricato una sola volta e condiviso
+        medgemma = MedGemmaTest()
+        if medgemma.workers:
+            medgemma.start_worker_pool()
+        
+        server = InferenceServer(
+            medgemma,
+            host=medgemma.server_host,
+            port=medgemma.server_port,
+            max_queue=medgemma.server_max_queue,
+            batch_wait_ms=medgemma.server_batch_wait_ms,
+            max_upload_mb=medgemma.server_max_upload_mb
+        )
+        server.run()
+        
+    except KeyboardInterrupt:
+        print("\nServer arrestato. Arrivederci!")
+    except Exception as e:
+        print(f"Errore fatale: {e}")
+
+
+def export(args):
+    """Esporta uno snapshot locale del modello e termina"""
+    print("MEDGEMMA EXPORT SNAPSHOT")
+    print("=" * 50)
+    
+    try:
+        medgemma = MedGemmaTest()
+        if not medgemma.export_snapshot(args[0] if args else None):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        print("\nEsportazione interrotta.")
+
+
+def quant_report(args):
+    """Confronta le modalità quantizzate con il baseline float"""
+    print("MEDGEMMA REPORT QUANTIZZAZIONE")
+    print("=" * 50)
+    
+    image_dir = Path(args[0]) if args else Path("images")
+    image_paths = sorted(
+        p for p in image_dir.iterdir()
+        if p.suffix.lower() in (".jpg", ".jpeg", ".png")
+    ) if image_dir.is_dir() else []
+    if not image_paths:
+        print(f"Nessuna immagine in {image_dir}")
+        sys.exit(1)
+    
+    # Le variabili d'ambiente hanno la precedenza sul .env dei processi di misura
+    env = {"DEVICE": "cpu", "CACHE_ENABLED": "false", "SNAPSHOT_DIR": "", "RESULTS_DB": "", "FAST_START": "false"}
+    
+    try:
+        run_quant_report(image_paths, modes=tuple(args[1:]) or ("int8", "int8-text"), env=env)
+    except KeyboardInterrupt:
+        print("\nReport interrotto.")
+
+
+def batch(args):
+    """Esegue un job batch non interattivo su manifest JSONL o glob"""
+    from medgemma_batch import BatchJob, default_output, parse_args
+    
+    options = parse_args(args)
+    output = options.output or default_output(options.input)
+    
+    print("MEDGEMMA BATCH")
+    print("=" * 50)
+    
+    try:
+        medgemma = MedGemmaTest()
+        job = BatchJob(
+            medgemma,
+            options.input,
+            output,
+            question=options.question,
+            batch_size=options.batch_size,
+            restart=options.restart
+        )
+        if options.workers or medgemma.workers:
+            medgemma.start_worker_pool(options.workers)
+        if not job.run():
+            sys.exit(2)
+    except KeyboardInterrupt:
+        print("\nJob interrotto: rilancia lo stesso comando per riprendere")
+        sys.exit(130)
+
+
+def tiles(args):
+    """Analisi a tile di un'immagine molto grande con report unico"""
+    from medgemma_tiles import default_output, parse_args, save_report
+    
+    options = parse_args(args)
+    output = options.output or default_output(options.path)
+    
+    print("MEDGEMMA TILES")
+    print("=" * 50)
+    
+    if not os.path.exists(options.path):
+        print(f"File non trovato: {options.path}")
+        sys.exit(1)
+    
+    try:
+        medgemma = MedGemmaTest()
+        report = medgemma.analyze_large_image(
+            options.path,
+            question=options.question,
+            level=options.level,
+            tile_size=options.tile_size,
+            max_tiles=options.max_tiles,
+            filter_mode=options.filter,
+            min_score=options.min_score,
+            batch_size=options.batch_size
+        )
+    except KeyboardInterrupt:
+        print("\nAnalisi interrotta.")
+        sys.exit(130)
+    except (ImportError, ValueError) as e:
+        print(f"Errore: {e}")
+        sys.exit(1)
+    
+    save_report(report, output)
+    print(f"\nREPORT ({report['tiles_analyzed']} tile su {report['tiles_total']}, {report['elapsed']:.0f}s):")
+    print(report["summary"])
+    print(f"\nReport salvato in {output}")
+
+
+def index(args):
+    """Indicizza immagini per la ricerca dei casi simili"""
+    from medgemma_index import parse_index_args
+    
+    options = parse_index_args(args)
+    
+    print("MEDGEMMA INDEX")
+    print("=" * 50)
+    
+    try:
+        medgemma = MedGemmaTest()
+        if not medgemma.index_images(
+            options.input,
+            index_dir=options.index,
+            batch_size=options.batch_size,
+            clusters=options.clusters
+        ):
+            sys.exit(2)
+    except KeyboardInterrupt:
+        print("\nIndicizzazione interrotta: rilancia lo stesso comando per riprendere")
+        sys.exit(130)
+
+
+def similar(args):
+    """Studi indicizzati più simili a un'immagine"""
+    from medgemma_index import parse_similar_args
+    
+    options = parse_similar_args(args)
+    
+    print("MEDGEMMA SIMILAR")
+    print("=" * 50)
+    
+    medgemma = MedGemmaTest()
+    try:
+        image = medgemma.load_image(options.image)
+        results = medgemma.find_similar(
+            image, k=options.k, index_dir=options.index, nprobe=options.nprobe, exact=options.exact
+        )
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Errore: {e}")
+        sys.exit(1)
+    
+    for rank, result in enumerate(results, 1):
+        marker = " (stessa immagine)" if result["same_image"] else ""
+        print(f"{rank:>3}. {result['score']:.4f}  {result['path']}{marker}")
+
+
+def results(args):
+    """Interroga l'archivio SQLite delle analisi senza caricare il modello"""
+    from medgemma_store import parse_args, run_query
+    
+    load_dotenv()
+    options = parse_args(args)
+    db_path = options.db or os.getenv("RESULTS_DB", "results/results.db")
+    
+    try:
+        if not run_query(options, db_path):
+            sys.exit(1)
+    except ValueError as e:
+        print(f"Errore: {e}")
+        sys.exit(1)
+
+
+def bench(args):
+    """Benchmark di prestazioni, offline con il modello in miniatura"""
+    from medgemma_bench import parse_args, run_benchmark
+    
+    options = parse_args(args)
+    
+    print("MEDGEMMA BENCHMARK")
+    print("=" * 50)
+    
+    try:
+        if not run_benchmark(MedGemmaTest, options):
+            sys.exit(2)
+    except KeyboardInterrupt:
+        print("\nBenchmark interrotto.")
+        sys.exit(130)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    
+    if command == "serve":
+        serve()
+    elif command == "export":
+        export(sys.argv[2:])
+    elif command == "batch":
+        batch(sys.argv[2:])
+    elif command == "quant-report":
+        quant_report(sys.argv[2:])
+    elif command == "bench":
+        bench(sys.argv[2:])
+    elif command == "tiles":
+        tiles(sys.argv[2:])
+    elif command == "index":
+        index(sys.argv[2:])
+    elif command == "similar":
+        similar(sys.argv[2:])
+    elif command == "results":
+        results(sys.argv[2:])
+    else:
+        main()
\ No newline at end of file